@@ -1,5 +1,6 @@
 from util.zipper import Zipper
 import datetime
+import threading
 from ocgis import env
 from django.http import HttpResponse
 from urlparse import parse_qs
@@ -8,6 +9,7 @@ import exc
 from ocgis.exc import InterpreterNotRecognized
 from ocgis.api.interpreter import Interpreter, OcgInterpreter
 from ocgis.api.operations import OcgOperations
+from ocgis.api.pool import WorkerPool
 from ocgis.api.definition import OcgParameter
 from ocgis.util.helpers import reduce_query
 
@@ -53,11 +55,28 @@ def _get_interface_overload_(query):
         
     return(name_map)
     
+## worker pool owned by the service process and shared across requests
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_worker_pool_():
+    global _pool
+    if env.SERIAL:
+        return(None)
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(processes=env.CORES)
+    ## unresponsive workers are replaced before the request is executed. the
+    ## check is skipped while other requests have tasks in flight.
+    _pool.check()
+    return(_pool)
+
 def _get_interpreter_return_(ops):
+    pool = _get_worker_pool_()
     try:
-        interp = Interpreter.get_interpreter(ops)
+        interp = Interpreter.get_interpreter(ops,pool=pool)
     except InterpreterNotRecognized:
-        interp = OcgInterpreter(ops)
+        interp = OcgInterpreter(ops,pool=pool)
     ret = interp.execute()
     return(ret)
 
@@ -1,30 +1,43 @@
 from collections import OrderedDict
 import numpy as np
 from ocgis.api.dataset.collection.dimension import TemporalDimension,\
-    SpatialDimension
+    SpatialDimension, TemporalGroupDimension
 from shapely.geometry.multipoint import MultiPoint
 from shapely.geometry.point import Point
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.ops import cascaded_union
-from shapely import prepared
-from ocgis.util.helpers import iter_array, keep
+from ocgis.util.helpers import iter_array, keep, spatial_average
 from ocgis.exc import UniqueIdNotFound
+from ocgis.util.spatial.index import QuadTree
+from ocgis.util.spatial.select import clip_cells, union_cells
 from collections import deque
+from copy import copy
 import itertools
 
 
 class OcgVariable(object):
+    '''Variable data for a subset.
     
-    def __init__(self,name,value,temporal,spatial,level=None,uri=None,alias=None):
-        assert(value.shape[0] == len(temporal.value))
-        if len(value) > 0:
-            if level is None:
-                assert(value.shape[1] == 1)
-            assert(np.all(value.shape[2:] == spatial.value.shape))
+    chunks=None :: iterable :: Streamed variables are created with a `value`
+        of `None`. Iterating `chunks` yields the index of the first time step
+        and the data for consecutive time chunks (see
+        :class:`~ocgis.api.dataset.dataset.TimeChunks`).'''
+    
+    def __init__(self,name,value,temporal,spatial,level=None,uri=None,alias=None,
+                 chunks=None):
+        if value is None:
+            assert(chunks is not None)
+        else:
+            assert(value.shape[0] == len(temporal.value))
+            if len(value) > 0:
+                if level is None:
+                    assert(value.shape[1] == 1)
+                assert(np.all(value.shape[2:] == spatial.shape))
         
         self._name = name
         self.alias = alias
         self.value = value
+        self.chunks = chunks
         self.temporal = temporal
         self.spatial = spatial
         self.level = level
@@ -58,69 +71,143 @@ class OcgVariable(object):
         ret._is_empty = True
         return(ret)
         
+    @classmethod
+    def concatenate(cls,variables):
+        '''Concatenate variables computed for consecutive time partitions of the
+        same subset. Partitions may not split temporal groups.
+        
+        variables :: sequence of OcgVariable :: Variables in time order.
+        
+        returns
+        
+        OcgVariable'''
+        
+        arch = variables[0]
+        ret = copy(arch)
+        ret.temporal = copy(arch.temporal)
+        ret.temporal.storage = np.concatenate([var.temporal.storage for var in variables])
+        ret.value = _concatenate_([var.value for var in variables])
+        ret.raw_value = _concatenate_([var.raw_value for var in variables])
+        if ret.value is None:
+            ret.chunks = ConcatenatedChunks([var.chunks for var in variables],
+                                            [len(var.temporal) for var in variables])
+        if arch.temporal_group is not None:
+            ret.temporal_group = TemporalGroupDimension.concatenate(
+                                  [var.temporal_group for var in variables])
+        ret.calc_value = OrderedDict()
+        for key in arch.calc_value:
+            ret.calc_value[key] = _concatenate_([var.calc_value[key] for var in variables])
+        return(ret)
+        
     def group(self,*args,**kwds):
         self.temporal_group = self.temporal.group(*args,**kwds)
         
-    def aggregate(self,new_id=1):
+    def aggregate(self,new_id=1,geom=None,union=True):
+        '''Aggregate the variable's geometries and values.
+        
+        new_id=1 :: int :: Identifier of the aggregated geometry.
+        geom=None :: Shapely geometry :: Aggregated geometry if already
+            constructed (see :meth:`get_aggregate_geom`).
+        union=True :: bool :: If False and `geom` is not provided, the
+            aggregated geometry is not constructed and is set to `None`.'''
+        
         ## will hold the unioned geometry
         new_geometry = np.empty((1,1),dtype=object)
-        ## get the masked geometries
-        geoms = self.spatial.value.compressed()
-        if self.spatial.geomtype == 'point':
+        if geom is None and union:
+            geom = self.get_aggregate_geom()
+        new_geometry[0,0] = geom
+        ## overwrite the original geometry
+        self.spatial._value = new_geometry
+        self.spatial._value_mask = np.array([[False]])
+        self.spatial._uid = np.ma.array([[new_id]],mask=False)
+        ## aggregate the values. streamed values are aggregated chunk by chunk
+        ## during calculation.
+        if self.value is not None:
+            self.raw_value = self.value.copy()
+            self.value = self._union_sum_()
+            
+    def get_aggregate_geom(self):
+        '''Return the union of the unmasked geometries. The union of grid cells
+        is constructed from the selection mask (see
+        :func:`~ocgis.util.spatial.select.union_cells`).'''
+        
+        spatial = self.spatial
+        if spatial.geomtype == 'point':
+            geoms = spatial.value.compressed()
             pts = MultiPoint([pt for pt in geoms.flat])
-            new_geometry[0,0] = Point(pts.centroid.x,pts.centroid.y)
+            ret = Point(pts.centroid.x,pts.centroid.y)
+        elif spatial.bounds is not None:
+            ret = union_cells(spatial.bounds,np.invert(spatial._value_mask),
+                              polygon=spatial.clip_geom)
         else:
             ## break out the MultiPolygon objects. inextricable geometry errors
             ## sometimes occur otherwise
             ugeom = []
-            for geom in geoms:
+            for geom in spatial.value.compressed():
                 if isinstance(geom,MultiPolygon):
                     for poly in geom:
                         ugeom.append(poly)
                 else:
                     ugeom.append(geom)
             ## execute the union
-            new_geometry[0,0] = cascaded_union(ugeom)
-        ## overwrite the original geometry
-        self.spatial._value = new_geometry
-        self.spatial._value_mask = np.array([[False]])
-        self.spatial._uid = np.ma.array([[new_id]],mask=False)
-        ## aggregate the values
-        self.raw_value = self.value.copy()
-        self.value = self._union_sum_()
+            ret = cascaded_union(ugeom)
+        return(ret)
             
     def _union_sum_(self):
-        value = self.raw_value
-        weight = self.spatial.weights
-        
-        ## make the output array
-        wshape = (value.shape[0],value.shape[1],1,1)
-        weighted = np.ma.array(np.empty(wshape,dtype=float),
-                                mask=np.zeros(wshape,dtype=bool))
-        ## next, weight and sum the data accordingly
-        for dim_time in range(value.shape[0]):
-            for dim_level in range(value.shape[1]):
-                weighted[dim_time,dim_level,0,0] = np.ma.average(value[dim_time,dim_level,:,:],weights=weight)
-        return(weighted)
+        ## weight and sum the data for all time steps and levels at once
+        return(spatial_average(self.raw_value,self.spatial.weights))
     
-    def clip(self,igeom):
+    def clip(self,igeom,overlay=None):
+        '''Clip the variable's geometries to `igeom` and weight them by
+        their clipped area.
+        
+        igeom :: Shapely Polygon or MultiPolygon
+        overlay=None :: Overlay :: Overlay of `igeom` with the variable's
+            grid. Cached clip results are used if present. Otherwise, the
+            clip results are stored on the overlay.'''
+        
         ## logic for convenience. just return the provided collection if a NoneType
         ## is passed for the 'igeom' arugment
         if igeom is not None:
-            ## take advange of shapely speedups
-            prep_igeom = prepared.prep(igeom)
-            ## the weight array
-            weights = np.empty(self.spatial.shape,dtype=float)
-            weights = np.ma.array(weights,mask=self.spatial._value_mask)
-            ## do the spatial operation
-            for idx,geom in iter_array(self.spatial.value,return_value=True):
-                if not prep_igeom.contains(geom):
-#                if keep(prep_igeom,igeom,geom):
-                    new_geom = igeom.intersection(geom)
-                    weights[idx] = new_geom.area
-                    self.spatial._value[idx] = new_geom
+            spatial = self.spatial
+            value_mask = spatial._value_mask
+            if overlay is not None and overlay.area is not None:
+                weights = overlay.area.copy()
+                for idx,geom in overlay.iter_geoms():
+                    spatial.set_geom(idx,geom)
+            elif spatial.bounds is not None and spatial.geomtype == 'polygon':
+                ## cells inside the clip geometry are classified in bulk and
+                ## keep their lazily constructed geometries. only the boundary
+                ## cells are intersected. overlays are clipped for all
+                ## selected cells so they do not depend on the data mask.
+                if overlay is None:
+                    select = np.invert(value_mask)
+                else:
+                    select = overlay.get_select()
+                weights,geoms = clip_cells(igeom,spatial.bounds,select=select)
+                for idx,geom in geoms.iteritems():
+                    spatial.set_geom(idx,geom)
+                if overlay is not None:
+                    overlay.set_clip(weights,geoms)
+            else:
+                ## decompose the clip geometry so each cell only operates on
+                ## the part of the geometry near it
+                tree = QuadTree(igeom)
+                weights = np.zeros(spatial.shape,dtype=float)
+                for idx,geom in iter_array(spatial.value,return_value=True):
+                    if tree.contains(geom):
+                        weights[idx] = geom.area
+                    else:
+                        new_geom = tree.intersection(geom)
+                        weights[idx] = new_geom.area
+                        spatial._value[idx] = new_geom
+            ## the union of the clipped cells is constructed from the cell
+            ## bounds and the clip geometry
+            if spatial.bounds is not None:
+                spatial.clip_geom = igeom
             ## set maximum weight to one
-            self.spatial.weights = weights/weights.max()
+            weights = np.ma.array(weights,mask=value_mask)
+            spatial.weights = weights/weights.max()
 
 
 class OcgMultivariateCalculationVariable(OcgVariable):
@@ -174,9 +261,45 @@ class OcgCollection(object):
     def _arch(self):
         return(self.variables[self.variables.keys()[0]])
     
-    def aggregate(self,*args,**kwds):
-        for var in self.variables.itervalues():
-            var.aggregate(*args,**kwds)
+    @classmethod
+    def concatenate(cls,colls):
+        '''Concatenate collections computed for consecutive time partitions of
+        the same selection geometry.
+        
+        colls :: sequence of OcgCollection :: Collections in time order.
+        
+        returns
+        
+        OcgCollection'''
+        
+        ret = colls[0]
+        if not ret.is_empty:
+            for key,var in ret.variables.iteritems():
+                ret.variables[key] = var.concatenate([coll.variables[key] for coll in colls])
+        return(ret)
+    
+    def aggregate(self,new_id=1,union=True):
+        '''Aggregate the variables. Variables holding the same grid cells share
+        the aggregated geometry.
+        
+        new_id=1 :: int :: Identifier of the aggregated geometries.
+        union=True :: bool :: If False, aggregated geometries are not
+            constructed (i.e. the output format does not write them).'''
+        
+        variables = self.variables.values()
+        geoms = []
+        for ii,var in enumerate(variables):
+            geom = None
+            if union:
+                for jj in range(ii):
+                    if var.spatial.is_same_selection(variables[jj].spatial):
+                        geom = geoms[jj]
+                        break
+                else:
+                    geom = var.get_aggregate_geom()
+            geoms.append(geom)
+        for var,geom in itertools.izip(variables,geoms):
+            var.aggregate(new_id=new_id,geom=geom,union=union)
             
     def clip(self,*args,**kwds):
         for var in self.variables.itervalues():
@@ -211,6 +334,36 @@ class OcgCollection(object):
         self.cid.add(var.name)
 
 
+class ConcatenatedChunks(object):
+    '''Time chunks of a variable concatenated from time partitions.
+    
+    chunks :: sequence :: Time chunks of each partition.
+    lengths :: sequence of int :: Number of time steps in each partition.'''
+    
+    def __init__(self,chunks,lengths):
+        self.chunks = chunks
+        self.lengths = lengths
+        
+    def __len__(self):
+        return(sum([len(chunks) for chunks in self.chunks]))
+    
+    def __iter__(self):
+        offset = 0
+        for chunks,length in itertools.izip(self.chunks,self.lengths):
+            for start,value in chunks:
+                yield(offset+start,value)
+            offset += length
+
+
+def _concatenate_(arrs):
+    if any([arr is None for arr in arrs]):
+        ret = None
+    else:
+        ret = np.ma.concatenate(arrs)
+        ret.set_fill_value(np.ma.array(arrs[0]).fill_value)
+    return(ret)
+
+
 class StringIdentifier(object):
     
     def __init__(self):
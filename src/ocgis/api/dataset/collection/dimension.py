@@ -1,8 +1,7 @@
 from ocgis.util.helpers import get_bounded, iter_array
 import numpy as np
 from shapely.geometry.point import Point
-from collections import deque
-import itertools
+from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely import wkb
 
@@ -55,21 +54,51 @@ class LevelDimension(OcgDimension):
     
 
 class SpatialDimension(OcgDimension):
+    '''Spatial dimension holding the dataset geometries for a subset window.
+    
+    Geometries may be supplied directly through `value` or constructed on
+    demand from `bounds`. In the latter case, a geometry is only created when
+    it is first requested and is cached afterwards.
+    
+    :param uid: Unique geometry identifiers.
+    :type uid: :class:`numpy.ma.MaskedArray`
+    :param value: Geometry objects or `None` if `bounds` is provided.
+    :type value: object :class:`numpy.ndarray`
+    :param value_mask: Geometry mask.
+    :type value_mask: bool :class:`numpy.ndarray`
+    :param bounds: Cell coordinates with the last dimension ordered as (min_col,min_row,max_col,max_row). Point abstractions repeat the point coordinates.
+    :type bounds: float :class:`numpy.ndarray` with shape (nrow,ncol,4)
+    :param abstraction: Either "point" or "polygon". Required with `bounds`.
+    :type abstraction: str
+    
+    If the geometries constructed from `bounds` are clipped, the clip geometry
+    is stored in `clip_geom`.
+    '''
     _name_value = 'geom'
     _name_uid = 'gid'
     
-    def __init__(self,uid,value,value_mask,weights=None):
+    def __init__(self,uid,value,value_mask,weights=None,bounds=None,
+                 abstraction=None):
         self._uid = uid
-        self._value = value
         self._value_mask = value_mask
+        self._bounds = bounds
+        self._abstraction = abstraction
+        self.clip_geom = None
+        if value is None:
+            assert(bounds is not None and abstraction is not None)
+            self._geoms = np.empty(bounds.shape[0:2],dtype=object)
+            self._is_complete = False
+        else:
+            self._geoms = value
+            self._is_complete = True
         
         if weights is None:
-            if len(value) > 0:
+            if len(self._geoms) > 0:
                 weights = self._get_weights_()
             else:
                 weights = None
         else:
-            assert(weights.shape == value.shape)
+            assert(weights.shape == self.shape)
         self.weights = weights
     
     @property
@@ -80,53 +109,125 @@ class SpatialDimension(OcgDimension):
         return(np.ma.array(self._value,mask=self._value_mask))
     @property
     def bounds(self):
-        raise(NotImplementedError)
+        return(self._bounds)
     @property
     def geomtype(self):
-        if isinstance(self._value[0,0],Point):
+        if self._bounds is not None:
+            ret = self._abstraction
+        elif isinstance(self._geoms[0,0],Point):
             ret = 'point'
         else:
             ret = 'polygon'
         return(ret)
     @property
     def shape(self):
-        return(self._value.shape)
+        return(self._geoms.shape)
+    @property
+    def _value(self):
+        ## construct any geometries not yet requested
+        if not self._is_complete:
+            get_geom = self.get_geom
+            for idx in iter_array(self._geoms,use_mask=False):
+                get_geom(idx)
+            self._is_complete = True
+        return(self._geoms)
+    @_value.setter
+    def _value(self,value):
+        ## geometries set directly no longer correspond to the cell bounds
+        self._geoms = value
+        self._bounds = None
+        self._is_complete = True
     
     def __len__(self):
-        return(self.value.compressed().shape[0])
+        return(np.invert(self._value_mask).sum())
     
     def __iter__(self):
         _name_uid = self._name_uid
         _name_value = self._name_value
         uid = self.uid
+        get_geom = self.get_geom
         _conv_to_multi_ = self._conv_to_multi_
         
-        for idx,geom in iter_array(self.value,return_value=True):
+        for idx in self._iter_unmasked_():
             row = {_name_uid:uid[idx],
-                   _name_value:_conv_to_multi_(geom)}
+                   _name_value:_conv_to_multi_(get_geom(idx))}
             yield(idx,row)
             
+    def get_geom(self,idx):
+        '''Return the geometry at index `idx` constructing it from the cell
+        bounds if necessary.
+        
+        :param idx: Two-dimensional index.
+        :type idx: tuple
+        :rtype: :class:`shapely.geometry.Polygon` or :class:`shapely.geometry.Point`
+        '''
+        ret = self._geoms[idx]
+        if ret is None and self._bounds is not None:
+            min_col,min_row,max_col,max_row = self._bounds[idx]
+            if self._abstraction == 'point':
+                ret = Point(min_col,min_row)
+            else:
+                ret = Polygon(((min_col,min_row),
+                               (max_col,min_row),
+                               (max_col,max_row),
+                               (min_col,max_row)))
+            self._geoms[idx] = ret
+        return(ret)
+    
+    def set_geom(self,idx,geom):
+        '''Replace the geometry at index `idx`.'''
+        self._geoms[idx] = geom
+        
+    def is_same_selection(self,other):
+        '''Return `True` if `other` holds the same unmasked grid cells clipped
+        to the same geometry. Only dimensions constructed from cell bounds are
+        compared.
+        
+        :type other: :class:`SpatialDimension`
+        :rtype: bool
+        '''
+        if self._bounds is None or other._bounds is None:
+            return(False)
+        if self._abstraction != other._abstraction or \
+           self._bounds.shape != other._bounds.shape or \
+           not np.array_equal(self._value_mask,other._value_mask) or \
+           not np.array_equal(self._bounds,other._bounds):
+            return(False)
+        if self.clip_geom is None or other.clip_geom is None:
+            ret = self.clip_geom is other.clip_geom
+        else:
+            ret = self.clip_geom.equals_exact(other.clip_geom,0.0)
+        return(ret)
+    
+    def _iter_unmasked_(self):
+        return(iter_array(np.ma.array(self._geoms,mask=self._value_mask)))
+            
     def _get_weights_(self):
-        value = self._value
         value_mask = self._value_mask
         
-        if isinstance(self._value[0,0],Point):
-            weights = np.ones(value.shape,dtype=float)
+        if self.geomtype == 'point':
+            weights = np.ones(self.shape,dtype=float)
             weights = np.ma.array(weights,mask=value_mask)
         else:
-            weights = np.empty(value.shape,dtype=float)
-            masked = self.value
-            for idx,geom in iter_array(masked,return_value=True):
-                weights[idx] = geom.area
-            weights = weights/weights.max()
+            if self._bounds is not None:
+                bounds = self._bounds
+                weights = np.abs((bounds[:,:,2]-bounds[:,:,0])*
+                                 (bounds[:,:,3]-bounds[:,:,1]))
+            else:
+                weights = np.empty(self.shape,dtype=float)
+                get_geom = self.get_geom
+                for idx in self._iter_unmasked_():
+                    weights[idx] = get_geom(idx).area
             weights = np.ma.array(weights,mask=value_mask)
+            weights = weights/weights.max()
         return(weights)
     
     @staticmethod
     def _conv_to_multi_(geom):
         '''Geometry conversion to single type.'''
         
-        if isinstance(geom,Point):
+        ## aggregated geometries are not constructed for some output formats
+        if geom is None or isinstance(geom,Point):
             pass
         else:
             try:
@@ -157,52 +258,89 @@ class TemporalDimension(OcgDimension):
     def _group_part_(self,groups):
         
         date_parts = ('year','month','day','hour','minute','second','microsecond')
-        group_map = dict(zip(range(0,7),date_parts,))
-        group_map_rev = dict(zip(date_parts,range(0,7),))
-        value = self.value
-
-        def _get_attrs_(dt):
-            return([dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second,dt.microsecond])
-        parts = np.empty((len(self.value),len(date_parts)),dtype=int)
-        for row in range(parts.shape[0]):
-            parts[row,:] = _get_attrs_(value[row,1])
-        
-        unique = deque()
-        for idx in range(parts.shape[1]):
-            if group_map[idx] in groups:
-                fill = np.unique(parts[:,idx])
-            else:
-                fill = np.array([0])
-            unique.append(fill)
-
-        select = deque()
-        idx2_seq = range(len(date_parts))
-        for idx in itertools.product(*[range(len(u)) for u in unique]):
-            select.append([unique[idx2][idx[idx2]] for idx2 in idx2_seq])
-        select = np.array(select)
-        
-        dgroups = deque()
-        idx_cmp = [group_map_rev[group] for group in groups]
-        keep_select = []
-        for idx in range(select.shape[0]):
-            match = select[idx,idx_cmp] == parts[:,idx_cmp]
-            dgrp = match.all(axis=1)
-            if dgrp.any():
-                keep_select.append(idx)
-                dgroups.append(dgrp)
-        select = select[keep_select,:]
-        assert(len(dgroups) == select.shape[0])
-        
-        new_value = np.empty((len(dgroups),len(date_parts)),dtype=object)
-        new_bounds = np.empty((len(dgroups),2),dtype=object)
-
-        for idx,dgrp in enumerate(dgroups):
-            new_value[idx] = select[idx]
-            sel = value[dgrp][:,(0,2)]
-            new_bounds[idx,:] = [sel.min(),sel.max()]
+        ## lower, center, and upper time values as microseconds
+        value = self.value.astype('datetime64[us]')
+        
+        ## integer date parts for the time values
+        parts = self._get_date_parts_(value[:,1])
+        ## combine the grouped date parts into a single integer key. parts are
+        ## combined in date part order so groups sort by year first regardless
+        ## of the order requested.
+        idx_cmp = [date_parts.index(part) for part in date_parts if part in groups]
+        key = np.zeros(parts.shape[0],dtype=np.int64)
+        for idx in idx_cmp:
+            col = parts[:,idx] - parts[:,idx].min()
+            key = key*(col.max()+1) + col
+        _,first,labels = np.unique(key,return_index=True,return_inverse=True)
+        dgroups = TemporalGroups(labels,first.shape[0])
+        
+        new_value = np.zeros((first.shape[0],len(date_parts)),dtype=int)
+        new_value[:,idx_cmp] = parts[first][:,idx_cmp]
+        new_value = new_value.astype(object)
+        
+        ## group bounds are the extrema of the time step bounds
+        bnds = value[dgroups.order][:,(0,2)]
+        starts = dgroups.offsets[:-1]
+        new_bounds = np.empty((first.shape[0],2),dtype=object)
+        new_bounds[:,0] = np.minimum.reduceat(bnds.min(axis=1),starts).astype(object)
+        new_bounds[:,1] = np.maximum.reduceat(bnds.max(axis=1),starts).astype(object)
 
         return(new_value,new_bounds,dgroups)
     
+    @staticmethod
+    def _get_date_parts_(value):
+        '''Return (year,month,day,hour,minute,second,microsecond) for a
+        `datetime64` array.'''
+        
+        dt = value.astype('datetime64[us]')
+        years = dt.astype('datetime64[Y]')
+        months = dt.astype('datetime64[M]')
+        days = dt.astype('datetime64[D]')
+        us = (dt - days).astype(np.int64)
+        parts = np.empty((value.shape[0],7),dtype=int)
+        parts[:,0] = years.astype(int) + 1970
+        parts[:,1] = months.astype(int) % 12 + 1
+        parts[:,2] = (days - months).astype(int) + 1
+        parts[:,3] = us // 3600000000
+        parts[:,4] = (us // 60000000) % 60
+        parts[:,5] = (us // 1000000) % 60
+        parts[:,6] = us % 1000000
+        return(parts)
+    
+    
+class TemporalGroups(object):
+    '''Compact representation of temporal groups. Group membership is stored
+    as a label per time step. Iteration and indexing return the time indices
+    for each group in ascending order.
+    
+    :param labels: Group index for each time step.
+    :type labels: int :class:`numpy.ndarray`
+    :param ngroups: Number of groups.
+    :type ngroups: int
+    '''
+    
+    def __init__(self,labels,ngroups):
+        self.labels = labels
+        ## time indices sorted by group. the sort is stable so indices remain
+        ## ordered within each group.
+        self.order = np.argsort(labels,kind='mergesort')
+        self.offsets = np.zeros(ngroups+1,dtype=int)
+        self.offsets[1:] = np.cumsum(np.bincount(labels,minlength=ngroups))
+        
+    def __len__(self):
+        return(self.offsets.shape[0]-1)
+    
+    def __getitem__(self,idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise(IndexError(idx))
+        return(self.order[self.offsets[idx]:self.offsets[idx+1]])
+    
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield(self[idx])
+    
 
 class TemporalGroupDimension(OcgDimension):
     _name_value = None
@@ -229,6 +367,25 @@ class TemporalGroupDimension(OcgDimension):
     def __len__(self):
         return(self.value.shape[0])
         
+    @classmethod
+    def concatenate(cls,dims):
+        '''Concatenate the group dimensions of consecutive time partitions.
+        Groups may not be split between partitions.
+        
+        :param dims: Group dimensions in time order.
+        :type dims: sequence of :class:`TemporalGroupDimension`
+        :rtype: :class:`TemporalGroupDimension`
+        '''
+        labels = []
+        ngroups = 0
+        for dim in dims:
+            labels.append(dim.dgroups.labels + ngroups)
+            ngroups += len(dim)
+        dgroups = TemporalGroups(np.concatenate(labels),ngroups)
+        return(cls(np.concatenate([dim.value for dim in dims]),
+                   np.concatenate([dim.bounds for dim in dims]),
+                   dgroups,dims[0].groups))
+        
     def __iter__(self):
         value = self.value
 #        bounds = self.bounds
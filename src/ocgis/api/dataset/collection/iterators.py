@@ -175,7 +175,7 @@ class KeyedIterator(AbstractOcgIterator):
         ## TODO: optimize
         if len(var.calc_value) > 0:
             for k,v in var.calc_value.iteritems():
-                for gidx0,gidx1 in iter_array(var.spatial.value):
+                for gidx0,gidx1 in iter_array(var.spatial.uid):
                     for tidx,lidx in itertools.product(range(v.shape[0]),range(v.shape[1])):
                         value = v[tidx,lidx,gidx0,gidx1]
                         tgid = var.temporal_group.uid[tidx]
@@ -187,7 +187,7 @@ class KeyedIterator(AbstractOcgIterator):
 #                    tgid = self.tgid.get(to_get)
 #                    yield(tidx,lidx,gidx0,gidx1,value,k,tgid)
         elif type(var) == OcgMultivariateCalculationVariable:
-            for gidx0,gidx1 in iter_array(var.spatial.value):
+            for gidx0,gidx1 in iter_array(var.spatial.uid):
                 for tidx,lidx in itertools.product(range(var.value.shape[0]),range(var.value.shape[1])):
                     value = var.value[tidx,lidx,gidx0,gidx1]
                     if var.temporal_group is None:
@@ -196,7 +196,7 @@ class KeyedIterator(AbstractOcgIterator):
                         tgid = var.temporal_group.uid[tidx]
                     yield(tidx,lidx,gidx0,gidx1,value,var.name,tgid)
         elif self.mode == 'raw':
-            for gidx0,gidx1 in iter_array(var.spatial.value):
+            for gidx0,gidx1 in iter_array(var.spatial.uid):
                 for tidx,lidx in itertools.product(range(var.value.shape[0]),range(var.value.shape[1])):
                     value = var.value[tidx,lidx,gidx0,gidx1]
                     yield(tidx,lidx,gidx0,gidx1,value,None,None)
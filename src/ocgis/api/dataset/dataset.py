@@ -1,40 +1,42 @@
-import netCDF4 as nc
 from shapely import prepared
-from ocgis.interface.interface import GlobalInterface
-from ocgis.util.helpers import keep, sub_range, iter_array
+from ocgis.interface.cache import get_interface
+from ocgis.util.helpers import keep, sub_range, vprint
 import numpy as np
 import ocgis.exc as exc
 from ocgis.api.dataset.collection.collection import OcgVariable
 from ocgis.api.dataset.collection.dimension import TemporalDimension,\
     LevelDimension, SpatialDimension
+from ocgis.util.ncpool import get_handle
+from ocgis.util.readplan import ReadPlan
+from ocgis.util.weights import WeightMatrix
 
 
 class OcgDataset(object):
     """
     Wraps and netCDF4-python Dataset object providing extraction methods by 
-    spatial and temporal queries.
+    spatial and temporal queries. The underlying handle is borrowed from the
+    process-local handle pool and is never stored on the instance.
     
     interface_overload -- dictionary containing overloaded parameters for interface
         objects
     """
+    ## approximate number of chunk-sized arrays alive at once while a time
+    ## chunk is read and calculated
+    _chunk_copies = 4
     
     def __init__(self,dataset,interface_overload={}):
         self.uri = dataset['uri']
         self.variable = dataset['variable']
 
-        ## construct interface
-        self.dataset = self.connect(self.uri)
-        try:
-            self.i = GlobalInterface(self.dataset,self.variable,overload=interface_overload)
-        finally:
-            self.dataset.close()
+        ## construct interface or load it from the interface cache
+        self.i = get_interface(self.uri,self.variable,overload=interface_overload)
+    
+    @property
+    def dataset(self):
+        return(self.connect(self.uri))
     
     def connect(self,uri):
-        try:
-            ret = nc.Dataset(uri,'r')
-        except TypeError:
-            ret = nc.MFDataset(uri)
-        return(ret)
+        return(get_handle(uri))
     
     def check_extent(self,target):
         extent = self.i.spatial.extent()
@@ -64,58 +66,101 @@ class OcgDataset(object):
 #        if show: plt.show()
     
     def get_numpy_data(self,var,args):
-        if len(args) == 3:
-            npd = var[args[0],args[1],args[2]]
-        if len(args) == 4:
-            npd = var[args[0],args[1],args[2],args[3]]
+        npd = var[tuple(args)]
         
-        ## resize the data to match returned counts
-        new_shape = [len(a) for a in args]
-        try:
-            npd.resize(new_shape)
-        except ValueError:
-            npd = np.ma.resize(npd,new_shape)
-        ## ensure we have four-dimensional data.
-        if len(npd.shape) == 3:
-            new_shape = (npd.shape[0],1,npd.shape[1],npd.shape[2])
-            try:
-                npd.resize(new_shape)
-            except ValueError:
-                npd = np.ma.resize(npd,new_shape)
+        ## reshape the data to match returned counts. data is always
+        ## four-dimensional with a level dimension of length one inserted for
+        ## three-dimensional variables. the reshape does not copy the data.
+        new_shape = [a.stop-a.start if isinstance(a,slice) else len(a) for a in args]
+        if len(new_shape) == 3:
+            new_shape.insert(1,1)
+        npd = npd.reshape(new_shape)
         
         return(npd)
     
-    def _subset_(self,polygon=None,time_range=None,level_range=None,
-                 allow_empty=False): ## intersects + touches
+    def get_read_plan(self,var,args,select):
         """
-        polygon -- shapely Polygon object
-        return -- SubOcgDataset
+        Plan reading the selected cells of the grid window in `args` as
+        rectangular blocks.
+        
+        select -- boolean array (row,col) that is `True` for selected cells in
+            the grid window
+        return -- ReadPlan or None if the window is best read at once
         """
-        try:
-            ## do a quick extent check if a polygon is passed
-            if polygon is not None:
-                if not self.check_extent(polygon):
-                    raise(exc.ExtentError)
-                
-            ## the initial selection
-            geom,row,col = self.i.spatial.select(polygon)
-            if len(row) == 0 and len(col) == 0:
-                raise(exc.ExtentError)
-        except exc.ExtentError:
-            if allow_empty:
-                return(OcgVariable.get_empty(self.variable,self.uri))
+        shape = [a.stop-a.start if isinstance(a,slice) else len(a) for a in args[:-2]]
+        plan = ReadPlan(select,np.prod(shape)*var.dtype.itemsize)
+        if len(plan) == 1 and plan.nbytes_saved == 0:
+            ret = None
+        else:
+            vprint('read plan for "{0}": {1} blocks, {2} bytes saved'.\
+                   format(self.variable,len(plan),plan.nbytes_saved))
+            ret = plan
+        return(ret)
+    
+    def read_data(self,var,args,plan=None):
+        """
+        Read the grid window in `args` using the blocks of `plan` if provided.
+        Cells outside the blocks are masked.
+        """
+        if plan is None:
+            ret = self.get_numpy_data(var,args)
+        else:
+            def _get_block_(rslice,cslice):
+                return(self.get_numpy_data(var,args[:-2]+[args[-2][rslice],args[-1][cslice]]))
+            ret = plan.read(_get_block_)
+        return(ret)
+    
+    def get_time_chunks(self,var,args,memory_budget):
+        """
+        Split the time selection in `args` into consecutive chunks whose data
+        fits within `memory_budget` megabytes.
+        
+        return -- list of time indices (slices or index arrays) or None if the
+            selection fits or no budget is provided
+        """
+        if memory_budget is None:
+            return(None)
+        shape = [a.stop-a.start if isinstance(a,slice) else len(a) for a in args]
+        ## values and mask for a single time step including calculation
+        ## temporaries
+        step = np.prod(shape[1:])*(var.dtype.itemsize+1)*self._chunk_copies
+        nstep = max(int(memory_budget*1024**2)//step,1)
+        if nstep >= shape[0]:
+            return(None)
+        timeidx = args[0]
+        ret = []
+        for start in range(0,shape[0],nstep):
+            stop = min(start+nstep,shape[0])
+            if isinstance(timeidx,slice):
+                ret.append(slice(timeidx.start+start,timeidx.start+stop))
             else:
-                raise
+                ret.append(timeidx[start:stop])
+        return(ret)
+    
+    def _get_indices_(self,time_range,level_range,time_slice=None):
+        """
+        Convert time and level ranges to indices.
         
+        return -- number of variable dimensions, time indices, level indices
+            (`None` if the variable has no levels)
+        """
         ## get the number of dimensions of the target variable
         ndim = len(self.dataset.variables[self.variable].dimensions)
                 
         ## get the time indices
+        ## the time indices are a slice for monotonic time axes
         timeidx = self.i.temporal.subset_timeidx(time_range)
-        if len(timeidx) == 0:
+        if time_slice is not None:
+            if isinstance(timeidx,slice):
+                timeidx = slice(timeidx.start+time_slice.start,
+                                min(timeidx.start+time_slice.stop,timeidx.stop))
+            else:
+                timeidx = timeidx[time_slice]
+        if len(self.i.temporal.tid[timeidx]) == 0:
             raise(IndexError('time range returned no data.'))
 
         ## convert the level indices
+        levelidx = None
         try:
             levelidx = self.i.level.levelidx
             if ndim == 4:
@@ -133,7 +178,100 @@ class OcgDataset(object):
                 pass
             else:
                 raise
-
+        return(ndim,timeidx,levelidx)
+    
+    def _get_dimensions_(self,timeidx,levelidx):
+        """
+        return -- temporal and level dimensions for the selected indices
+        """
+        if self.i.temporal.bounds is None:
+            timevec_bounds = None
+        else:
+            timevec_bounds = self.i.temporal.bounds[timeidx,:]
+        d_temporal = TemporalDimension(self.i.temporal.tid[timeidx],
+                                       self.i.temporal.value[timeidx],
+                                       timevec_bounds)
+        
+        if self.i.level is None:
+            d_level = None
+#            d_level = LevelDimension(is_dummy=True)
+        else:
+            if self.i.level.bounds is None:
+                levelvec_bounds = None
+            else:
+                levelvec_bounds = self.i.level.bounds[levelidx]
+            d_level = LevelDimension(self.i.level.lid[levelidx],
+                                     self.i.level.value[levelidx],
+                                                levelvec_bounds)
+            
+        return(d_temporal,d_level)
+    
+    def get_cell_bytes(self,time_range=None,level_range=None):
+        """
+        return -- approximate bytes of data and mask read for a grid cell
+        """
+        ndim,timeidx,levelidx = self._get_indices_(time_range,level_range)
+        var = self.dataset.variables[self.variable]
+        nlevel = 1 if ndim == 3 else len(self.i.level.lid[levelidx])
+        return(len(self.i.temporal.tid[timeidx])*nlevel*(var.dtype.itemsize+1))
+    
+    def read_window(self,rowidx,colidx,time_range=None,level_range=None):
+        """
+        Read the data of a grid window once for the subsets of all selection
+        geometries within it.
+        
+        rowidx -- consecutive native row indices
+        colidx -- consecutive native column indices
+        return -- WindowBuffer
+        """
+        ndim,timeidx,levelidx = self._get_indices_(time_range,level_range)
+        if ndim == 3:
+            args = [timeidx,rowidx,colidx]
+        else:
+            args = [timeidx,levelidx,rowidx,colidx]
+        var = self.dataset.variables[self.variable]
+        vprint('shared window for "{0}": {1} rows, {2} columns'.\
+               format(self.variable,len(rowidx),len(colidx)))
+        return(WindowBuffer(rowidx,colidx,self.get_numpy_data(var,args)))
+    
+    def _subset_(self,polygon=None,time_range=None,level_range=None,
+                 allow_empty=False,memory_budget=None,time_slice=None,
+                 select=None,buffer=None): ## intersects + touches
+        """
+        polygon -- shapely Polygon object
+        memory_budget -- approximate megabytes of data to read at once. If the
+            selection is larger, the returned variable has no values and
+            its data is read in time chunks through `OcgVariable.chunks`.
+        time_slice -- slice of the time steps selected by `time_range`. Used
+            to partition work along the time axis.
+        select -- native row and column indices of the cells selected by
+            `polygon` if already known (e.g. from the overlay cache).
+        buffer -- WindowBuffer read for the same time and level ranges. If
+            it covers the subset, the data is copied from the buffer.
+        return -- SubOcgDataset
+        """
+        try:
+            ## do a quick extent check if a polygon is passed. the check also
+            ## applies to known selections.
+            if polygon is not None:
+                if not self.check_extent(polygon):
+                    raise(exc.ExtentError)
+                
+            ## the initial selection
+            if select is None:
+                row,col = self.i.spatial.select(polygon)
+            else:
+                row,col = select
+            if len(row) == 0 and len(col) == 0:
+                raise(exc.ExtentError)
+        except exc.ExtentError:
+            if allow_empty:
+                return(OcgVariable.get_empty(self.variable,self.uri))
+            else:
+                raise
+        
+        ndim,timeidx,levelidx = self._get_indices_(time_range,level_range,
+                                                   time_slice=time_slice)
             
         ## extract the data ####################################################
         
@@ -150,75 +288,263 @@ class OcgDataset(object):
             args = [timeidx,levelidx,rowidx,colidx]
         else:
             raise(NotImplementedError('cannot hold dimension count of "{0}"'.format(ndim)))
-        ## actually get the data
-        npd = self.get_numpy_data(var,args)
-
-        ## we need to remove the unwanted data and reshape in the process. first,
-        ## construct the relative indices.
-        rel_mask = np.ones(npd.shape,dtype=bool)
-        min_row = row.min()
-        min_col = col.min()
-        ## now iterate and remove the data
-        for ii in iter_array(row,use_mask=False):
-            rel_mask[:,:,row[ii]-min_row,col[ii]-min_col] = False
-        
-        ## test for masked data
-        if hasattr(npd,'mask'):
-            ## if all the data values are masked, raise an error.
-            if npd.mask.all():
-                if allow_empty:
-                    return(OcgVariable.get_empty(self.variable,self.uri))
-                else:
-                    raise(exc.MaskedDataError)
-            else:
-                npd.mask = np.logical_or(npd.mask,rel_mask)
+        ## the relative mask is True for cells of the grid window outside the
+        ## selection. it is two-dimensional and broadcasts over time and level.
+        rel_mask = np.ones((len(rowidx),len(colidx)),dtype=bool)
+        rel_mask[row-rowidx[0],col-colidx[0]] = False
+        
+        ## actually get the data. only the first time chunk is read when
+        ## streaming. subsets within a shared window copy their data from it.
+        npd = None
+        if buffer is not None and time_slice is None:
+            npd = buffer.get(rowidx,colidx)
+        if npd is not None:
+            plan,chunks = None,None
         else:
-            npd = np.ma.array(npd,mask=rel_mask)
+            plan = self.get_read_plan(var,args,np.invert(rel_mask))
+            chunks = self.get_time_chunks(var,args,memory_budget)
+            if chunks is None:
+                npd = self.read_data(var,args,plan=plan)
+            else:
+                npd = self.read_data(var,[chunks[0]]+args[1:],plan=plan)
+        
+        ## test for masked data. when streaming, only the first time chunk is
+        ## tested.
+        if np.ma.getmask(npd).all():
+            if allow_empty:
+                return(OcgVariable.get_empty(self.variable,self.uri))
+            else:
+                raise(exc.MaskedDataError)
+        npd = np.ma.array(npd,mask=np.logical_or(np.ma.getmaskarray(npd),rel_mask),
+                          copy=False)
         
         ## create geometry identifier
-        gid = self.i.spatial.gid[rowidx][:,colidx].\
-              reshape((npd.shape[2],npd.shape[3]))
+        gid = self.i.spatial.gid[np.ix_(rowidx,colidx)]
         gid = np.ma.array(gid,mask=npd.mask[0,0,:,:])
         
         ## keeping the geometry mask separate is necessary related to this error:
         ## http://projects.scipy.org/numpy/ticket/897
-        geom = geom[rowidx][:,colidx].reshape((npd.shape[2],npd.shape[3]))
         geom_mask = npd.mask[0,0,:,:]
+        ## geometries are constructed from the cell bounds only when requested
+        geom_bounds = self.i.spatial.get_cell_bounds(rowidx,colidx)
         
         ## make dimensions #####################################################
         
-        if self.i.temporal.bounds is None:
-            timevec_bounds = None
-        else:
-            timevec_bounds = self.i.temporal.bounds[timeidx,:]
-        d_temporal = TemporalDimension(self.i.temporal.tid[timeidx],
-                                       self.i.temporal.value[timeidx],
-                                       timevec_bounds)
-        
-        if self.i.level is None:
-            d_level = None
-#            d_level = LevelDimension(is_dummy=True)
-        else:
-            if self.i.level.bounds is None:
-                levelvec_bounds = None
-            else:
-                levelvec_bounds = self.i.level.bounds[levelidx]
-            d_level = LevelDimension(self.i.level.lid[levelidx],
-                                     self.i.level.value[levelidx],
-                                                levelvec_bounds)
+        d_temporal,d_level = self._get_dimensions_(timeidx,levelidx)
             
-        d_spatial = SpatialDimension(gid,geom,geom_mask,weights=None)
+        d_spatial = SpatialDimension(gid,None,geom_mask,bounds=geom_bounds,
+                                     abstraction=self.i.spatial.abstraction)
         
         ########################################################################
         
-        ocg_variable = OcgVariable(self.variable,npd,d_temporal,
-                                        d_spatial,level=d_level,uri=self.uri)
+        if chunks is None:
+            ocg_variable = OcgVariable(self.variable,npd,d_temporal,
+                                       d_spatial,level=d_level,uri=self.uri)
+        else:
+            time_chunks = TimeChunks(self,args[1:],chunks,rel_mask,first=npd,
+                                     plan=plan)
+            ocg_variable = OcgVariable(self.variable,None,d_temporal,
+                                       d_spatial,level=d_level,uri=self.uri,
+                                       chunks=time_chunks)
         
         return(ocg_variable)
     
     def subset(self,*args,**kwds):
-        try:
-            self.dataset = self.connect(self.uri)
-            return(self._subset_(*args,**kwds))
-        finally:
-            self.dataset.close()
+        return(self._subset_(*args,**kwds))
+    
+    def subset_batch(self,geom_dicts,time_range=None,level_range=None,
+                     allow_empty=False,memory_budget=None,clip=False,
+                     overlays=None,union=True):
+        """
+        Aggregate the data for many selection geometries in a single pass.
+        Area weights of every geometry are collected in a sparse weight matrix
+        and the grid window covering all geometries is read once in time
+        chunks. Each chunk is aggregated for all geometries at once.
+        
+        geom_dicts -- sequence of geometry dictionaries with keys "ugid" and
+            "geom"
+        clip -- if True, weight cells by their area clipped to the geometry
+        overlays -- Overlay (or None) for each geometry providing the cell
+            selection and clip results (see `ocgis.interface.overlay`)
+        union -- if False, aggregated geometries are not constructed
+        return -- list of aggregated OcgVariable for each geometry. Variables
+            of geometries without data are empty if `allow_empty` is True.
+        """
+        if overlays is None:
+            overlays = [None]*len(geom_dicts)
+        ndim,timeidx,levelidx = self._get_indices_(time_range,level_range)
+        var = self.dataset.variables[self.variable]
+        
+        ## select the cells for each geometry
+        selects = []
+        for geom_dict,overlay in zip(geom_dicts,overlays):
+            polygon = geom_dict['geom']
+            if polygon is not None and not self.check_extent(polygon):
+                row,col = [],[]
+            elif overlay is not None:
+                row,col = overlay.row,overlay.col
+            else:
+                row,col = self.i.spatial.select(polygon)
+            if len(row) == 0:
+                if not allow_empty:
+                    raise(exc.ExtentError)
+                row,col = None,None
+            selects.append((row,col))
+        ret = [OcgVariable.get_empty(self.variable,self.uri) for geom_dict in geom_dicts]
+        rows = [row for row,col in selects if row is not None]
+        if len(rows) == 0:
+            return(ret)
+        
+        ## the grid window covering all geometries
+        rowidx = sub_range(np.concatenate(rows))
+        colidx = sub_range(np.concatenate([col for row,col in selects if col is not None]))
+        if ndim == 3:
+            args = [timeidx,rowidx,colidx]
+        elif ndim == 4:
+            args = [timeidx,levelidx,rowidx,colidx]
+        else:
+            raise(NotImplementedError('cannot hold dimension count of "{0}"'.format(ndim)))
+        select = np.zeros((len(rowidx),len(colidx)),dtype=bool)
+        for row,col in selects:
+            if row is not None:
+                select[row-rowidx[0],col-colidx[0]] = True
+        plan = self.get_read_plan(var,args,select)
+        chunks = self.get_time_chunks(var,args,memory_budget)
+        if chunks is None:
+            chunks = [timeidx]
+        ## the first time step provides the data mask of the geometries
+        first = self.read_data(var,[chunks[0]]+args[1:],plan=plan)
+        data_mask = np.ma.getmaskarray(first)[0,0,:,:]
+        
+        ## build the aggregated variables and the weight matrix
+        matrix = WeightMatrix(select.size)
+        variables = []
+        for idx,(geom_dict,overlay,(row,col)) in enumerate(zip(geom_dicts,overlays,selects)):
+            if row is None:
+                continue
+            wrowidx = sub_range(row)
+            wcolidx = sub_range(col)
+            window = np.ix_(wrowidx-rowidx[0],wcolidx-colidx[0])
+            if data_mask[window].all():
+                if allow_empty:
+                    continue
+                else:
+                    raise(exc.MaskedDataError)
+            rel_mask = np.ones((len(wrowidx),len(wcolidx)),dtype=bool)
+            rel_mask[row-wrowidx[0],col-wcolidx[0]] = False
+            geom_mask = np.logical_or(data_mask[window],rel_mask)
+            gid = np.ma.array(self.i.spatial.gid[np.ix_(wrowidx,wcolidx)],mask=geom_mask)
+            d_spatial = SpatialDimension(gid,None,geom_mask,
+                                         bounds=self.i.spatial.get_cell_bounds(wrowidx,wcolidx),
+                                         abstraction=self.i.spatial.abstraction)
+            d_temporal,d_level = self._get_dimensions_(timeidx,levelidx)
+            ## values are set once all geometries are aggregated
+            ocg_variable = OcgVariable(self.variable,None,d_temporal,d_spatial,
+                                       level=d_level,uri=self.uri,chunks=[])
+            if clip:
+                ocg_variable.clip(geom_dict['geom'],overlay=overlay)
+            weights = ocg_variable.spatial.weights
+            ii,jj = np.nonzero(np.invert(np.ma.getmaskarray(weights)))
+            cells = (wrowidx[ii]-rowidx[0])*len(colidx) + (wcolidx[jj]-colidx[0])
+            matrix.add(cells,np.ma.filled(weights,0)[ii,jj])
+            ## only the geometry is aggregated
+            ocg_variable.aggregate(new_id=geom_dict['ugid'],union=union)
+            ret[idx] = ocg_variable
+            variables.append(ocg_variable)
+        if len(variables) == 0:
+            return(ret)
+        vprint('batch aggregation of "{0}": {1} geometries, {2} weights'.\
+               format(self.variable,len(matrix),matrix.nnz))
+        
+        ## aggregate the time chunks
+        values = []
+        for idx,chunk in enumerate(chunks):
+            if idx == 0:
+                npd = first
+                first = None
+            else:
+                npd = self.read_data(var,[chunk]+args[1:],plan=plan)
+            npd = np.ma.asarray(npd)
+            values.append(matrix.average(npd.reshape(npd.shape[0:2]+(-1,))))
+        values = np.ma.concatenate(values)
+        mask = np.ma.getmaskarray(values)
+        shape = values.shape[0:2]+(1,1)
+        for idx,ocg_variable in enumerate(variables):
+            ocg_variable.value = np.ma.array(values.data[:,:,idx].reshape(shape),
+                                             mask=mask[:,:,idx].reshape(shape))
+            ocg_variable.chunks = None
+        return(ret)
+
+
+class TimeChunks(object):
+    """
+    Reads the data for a subset in chunks of consecutive time steps. Iteration
+    yields the time index of each chunk's first time step relative to the
+    subset and the masked chunk data.
+    
+    ocg_dataset -- OcgDataset the subset was created from
+    args -- level (if present), row, and column indices of the subset
+    chunks -- time indices for each chunk
+    rel_mask -- two-dimensional mask for cells outside the selection
+    first=None -- already read data for the first chunk
+    plan=None -- ReadPlan used to read each chunk
+    """
+    
+    def __init__(self,ocg_dataset,args,chunks,rel_mask,first=None,plan=None):
+        self.ocg_dataset = ocg_dataset
+        self.args = args
+        self.chunks = chunks
+        self.rel_mask = rel_mask
+        self.plan = plan
+        self._first = first
+        
+    def __len__(self):
+        return(len(self.chunks))
+    
+    def __iter__(self):
+        ods = self.ocg_dataset
+        var = ods.dataset.variables[ods.variable]
+        start = 0
+        for idx,timeidx in enumerate(self.chunks):
+            if idx == 0 and self._first is not None:
+                npd = self._first
+                ## the first chunk is only held until it is first used
+                self._first = None
+            else:
+                npd = ods.read_data(var,[timeidx]+self.args,plan=self.plan)
+                mask = np.logical_or(np.ma.getmaskarray(npd),self.rel_mask)
+                npd = np.ma.array(npd,mask=mask,copy=False)
+            yield(start,npd)
+            start += npd.shape[0]
+
+
+class WindowBuffer(object):
+    """
+    Data of a grid window shared by the subsets of neighbouring selection
+    geometries.
+    
+    rowidx -- consecutive native row indices of the window
+    colidx -- consecutive native column indices of the window
+    data -- four-dimensional masked data of the window
+    """
+    
+    def __init__(self,rowidx,colidx,data):
+        self.rowidx = rowidx
+        self.colidx = colidx
+        self.data = data
+        
+    def get(self,rowidx,colidx):
+        """
+        return -- copy of the data for consecutive row and column indices or
+            None if they are not within the window. subsets do not share
+            memory with the buffer or each other.
+        """
+        r0 = rowidx[0]-self.rowidx[0]
+        r1 = rowidx[-1]-self.rowidx[0]+1
+        c0 = colidx[0]-self.colidx[0]
+        c1 = colidx[-1]-self.colidx[0]+1
+        if r0 < 0 or c0 < 0 or r1 > len(self.rowidx) or c1 > len(self.colidx):
+            ret = None
+        else:
+            ret = self.data[:,:,r0:r1,c0:c1].copy()
+        return(ret)
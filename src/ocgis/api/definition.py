@@ -1,5 +1,5 @@
 from datetime import datetime
-from copy import deepcopy
+from copy import deepcopy, copy
 from types import NoneType
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.polygon import Polygon
@@ -586,6 +586,20 @@ class RequestDataset(object):
         ret = {attr:getattr(self,attr) for attr in attrs}
         return(ret)
         
+    def to_plan(self):
+        '''Return a copy of the request without its loaded
+        :class:`~ocgis.api.dataset.dataset.OcgDataset`. Used when pickling
+        operations for pool workers which rebuild the dataset from the request.
+        
+        returns
+        
+        :class:`~ocgis.RequestDataset`'''
+        
+        ret = copy(self)
+        ret.ocg_dataset = None
+        ret._use_for_id = list(self._use_for_id)
+        return(ret)
+        
     def __eq__(self,other):
         if isinstance(other,self.__class__):
             return(self.__dict__ == other.__dict__)
@@ -870,6 +884,30 @@ class AllowEmpty(BooleanParameter,AttributedOcgParameter):
         return(msg)
     
     
+class MemoryBudget(AttributedOcgParameter):
+    _name = 'memory_budget'
+    _nullable = True
+    _default = None
+    _dtype = float
+    
+    def _format_(self,value):
+        return(float(value))
+    
+    def _format_string_element_(self,value):
+        return(float(value))
+    
+    def validate_all(self,values):
+        self._assert_(values[0] > 0,'Memory budget must be greater than zero.')
+    
+    def message(self):
+        if self.value is None:
+            msg = 'Data for each selection geometry is read at once.'
+        else:
+            msg = ('Grouped calculations read data in time chunks using '
+                   'approximately {0} megabytes.'.format(self.value))
+        return(msg)
+    
+    
 class PrimeMeridian(AttributedOcgParameter):
     _name = 'pm'
     _nullable = True
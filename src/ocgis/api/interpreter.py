@@ -10,18 +10,21 @@ from ocgis.util.helpers import union_geoms
 class Interpreter(object):
     '''Superclass for custom interpreter frameworks.
     
-    ops :: OcgOperations'''
+    ops :: OcgOperations
+    pool=None :: WorkerPool :: Long-lived worker pool used to execute the
+        operations in parallel.'''
     
-    def __init__(self,ops):
+    def __init__(self,ops,pool=None):
         self.ops = ops
+        self.pool = pool
         
     @classmethod
-    def get_interpreter(cls,ops):
+    def get_interpreter(cls,ops,pool=None):
         '''Select interpreter class.'''
         
         imap = {'ocg':OcgInterpreter}
         try:
-            return(imap[ops.backend](ops))
+            return(imap[ops.backend](ops,pool=pool))
         except KeyError:
             raise(exc.InterpreterNotRecognized)
         
@@ -68,6 +71,9 @@ class OcgInterpreter(Interpreter):
         ## aggregated.
         if self.ops.output_format == 'nc' or self.ops.agg_selection is True:
             self.ops.geom = union_geoms(self.ops.geom)
+            ## the unioned geometry is not a shapefile geometry. its cells may
+            ## not be taken from the overlay cache of the shapefile.
+            self.ops._get_object_('geom')._shp_key = None
             
         ## limited operations available for netcdf
         if self.ops.output_format == 'nc':
@@ -84,7 +90,8 @@ class OcgInterpreter(Interpreter):
         ## this is the standard request for other output types.
         else:
             ## the operations object performs subsetting and calculations
-            so = SubsetOperation(self.ops,serial=env.SERIAL,nprocs=7)
+            so = SubsetOperation(self.ops,serial=env.SERIAL,nprocs=env.CORES,
+                                 pool=self.pool)
             ## if there is no grouping on the output files, a singe converter is
             ## is needed
             if self.ops.output_grouping is None:
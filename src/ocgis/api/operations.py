@@ -56,13 +56,15 @@ class OcgOperations(object):
     :type vector_wrap: bool
     :param allow_empty: If `True`, do not raise an exception in the case of an empty geometric selection.
     :type allow_empty: bool
+    :param memory_budget: Approximate megabytes of data to read at once for grouped calculations. Larger selections are streamed in time chunks.
+    :type memory_budget: float
     """
     
     def __init__(self, dataset=None, spatial_operation='intersects', geom=None, aggregate=False,
                  calc=None, calc_grouping=None, calc_raw=False, abstraction='polygon',
                  snippet=False, backend='ocg', prefix='ocgis',
                  output_format='numpy', agg_selection=False, select_ugid=None, 
-                 vector_wrap=True, allow_empty=False):
+                 vector_wrap=True, allow_empty=False, memory_budget=None):
         
         # # Tells "__setattr__" to not perform global validation until all
         # # values are set initially.
@@ -84,6 +86,7 @@ class OcgOperations(object):
         self.select_ugid = SelectUgid(select_ugid)
         self.vector_wrap = VectorWrap(vector_wrap)
         self.allow_empty = AllowEmpty(allow_empty)
+        self.memory_budget = MemoryBudget(memory_budget)
         
         ## these values are left in to perhaps be added back in at a later date.
         self.output_grouping = None
@@ -128,7 +131,8 @@ class OcgOperations(object):
         # # TODO: hack
         parms = [SpatialOperation, Geom, Aggregate, Calc, CalcGrouping, CalcRaw,
                  Abstraction, Snippet, Backend, Prefix, OutputFormat,
-                 AggregateSelection, SelectUgid, VectorWrap, AllowEmpty]
+                 AggregateSelection, SelectUgid, VectorWrap, AllowEmpty,
+                 MemoryBudget]
         
         kwds = {}
         ds = Dataset.parse_query(query)
@@ -0,0 +1,133 @@
+import os
+import time
+import threading
+from multiprocessing import Pool, Value
+from ocgis import env
+
+
+## number of workers that received a ping during the current check. set in
+## each worker by the pool initializer.
+_checkins = None
+
+def _init_worker_(checkins):
+    global _checkins
+    _checkins = checkins
+
+def _ping_((n,timeout)):
+    ## hold the worker until `n` workers checked in. a waiting worker cannot
+    ## take another ping so each ping is answered by a different worker.
+    with _checkins.get_lock():
+        _checkins.value += 1
+    end = time.time() + timeout
+    while _checkins.value < n:
+        if time.time() > end:
+            return(None)
+        time.sleep(0.01)
+    return(os.getpid())
+
+
+class WorkerPool(object):
+    '''Long-lived pool of worker processes shared across operations. Workers
+    keep their NetCDF handles, interfaces and rebuilt operations warm between
+    requests. Workers are replaced after completing `maxtasks` tasks to
+    contain leaks. The pool may be shared by concurrent threads.
+    
+    >>> pool = WorkerPool(processes=4)
+    >>> ret = OcgInterpreter(ops,pool=pool).execute()
+    >>> pool.close()
+    
+    processes=None :: int :: Number of worker processes. Defaults to
+        `env.CORES`.
+    maxtasks=None :: int :: Defaults to `env.WORKER_MAX_TASKS`.
+    '''
+    
+    def __init__(self,processes=None,maxtasks=None):
+        self.processes = processes or env.CORES
+        self.maxtasks = maxtasks or env.WORKER_MAX_TASKS
+        self.restarts = 0
+        self._pool = None
+        self._checkins = None
+        ## results of submitted tasks that may not be finished
+        self._results = []
+        self._lock = threading.Lock()
+        
+    @property
+    def pool(self):
+        with self._lock:
+            return(self._get_pool_())
+            
+    @property
+    def busy(self):
+        '''`True` if submitted tasks are not finished.'''
+        
+        with self._lock:
+            return(self._get_busy_())
+            
+    def apply_async(self,func,args=()):
+        with self._lock:
+            ret = self._get_pool_().apply_async(func,args)
+            ## drop finished results
+            self._get_busy_()
+            self._results.append(ret)
+        return(ret)
+        
+    def check(self,timeout=5.0):
+        '''Check that each worker responds within `timeout` seconds. An
+        unresponsive pool is restarted. Busy workers delay the response, so
+        the check is skipped while tasks are in flight. Tasks submitted by
+        other threads wait for the check to finish.
+        
+        returns
+        
+        bool or None :: True if the pool was healthy. None if the pool was
+            busy and not checked.'''
+        
+        with self._lock:
+            if self._get_busy_():
+                return(None)
+            pool = self._get_pool_()
+            self._checkins.value = 0
+            results = [pool.apply_async(_ping_,((self.processes,timeout),))
+                       for ii in range(self.processes)]
+            try:
+                pids = [result.get(timeout) for result in results]
+                ret = None not in pids and len(set(pids)) == self.processes
+            except Exception:
+                ret = False
+            if not ret:
+                self._restart_()
+        return(ret)
+        
+    def restart(self):
+        '''Terminate the workers. New workers start with the next task.'''
+        
+        with self._lock:
+            self._restart_()
+            
+    def close(self):
+        with self._lock:
+            self._close_()
+            
+    def _get_busy_(self):
+        self._results = [result for result in self._results if not result.ready()]
+        return(len(self._results) > 0)
+        
+    def _get_pool_(self):
+        if self._pool is None:
+            self._checkins = Value('i',0)
+            self._pool = Pool(processes=self.processes,
+                              maxtasksperchild=self.maxtasks,
+                              initializer=_init_worker_,
+                              initargs=(self._checkins,))
+        return(self._pool)
+        
+    def _restart_(self):
+        self._close_()
+        self.restarts += 1
+        
+    def _close_(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._results = []
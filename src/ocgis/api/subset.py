@@ -1,4 +1,5 @@
 import itertools
+import numpy as np
 from multiprocessing import Pool
 from ocgis.calc.engine import OcgCalculationEngine
 from ocgis.interface.interface import SpatialInterfacePolygon,\
@@ -7,9 +8,18 @@ from ocgis.api.dataset.dataset import OcgDataset
 from ocgis.util.spatial.wrap import unwrap_geoms, wrap_coll
 from ocgis.api.dataset.collection.collection import OcgCollection
 from ocgis.api.dataset.collection.dimension import TemporalDimension
-from copy import deepcopy
+from copy import deepcopy, copy
+from collections import deque, OrderedDict
+import cPickle
 from ocgis.api.dataset.mappers import EqualSpatialDimensionMapper,\
     EqualTemporalDimensionMapper, EqualLevelDimensionMapper
+from shapely import wkb
+from ocgis import env
+from ocgis.api.definition import Geom, Dataset, RequestDatasetCollection
+from ocgis.util.helpers import make_poly
+from ocgis.interface.overlay import Overlay, get_overlay, put_overlay
+from ocgis.conv.converter import OcgConverter
+from ocgis.util.ncpool import NcHandlePool
 
 
 class SubsetOperation(object):
@@ -18,14 +28,62 @@ class SubsetOperation(object):
     
     desc :: dict :: Operational arguments for the interpreter to execute.
     serial=True :: bool :: Set to False to run in parallel.
-    nprocs=1 :: int :: Number of processes to use when executing parallel
-        operations.
+    nprocs=None :: int :: Number of processes to use when executing parallel
+        operations. Defaults to `env.CORES`.
+    window=None :: int :: Maximum number of geometries in flight when
+        executing in parallel. Defaults to `env.PARALLEL_WINDOW`.
+    ordered=None :: bool :: If True, parallel operations return collections
+        in the order of the selection geometries. Defaults to
+        `env.PARALLEL_ORDERED`.
+    pool=None :: WorkerPool :: Long-lived worker pool. If provided, the
+        operation is executed in parallel by the pool's workers which rebuild
+        it from a compact plan.
+    time_partitions=None :: int :: Number of time partitions each selection
+        geometry is split into when executing in parallel. Defaults to
+        `env.TIME_PARTITIONS`.
+    batch=None :: bool :: If True, serial operations aggregating many
+        selection geometries read and aggregate each dataset once for all
+        geometries. Defaults to `env.AGGREGATE_BATCH`.
+    shared_window=None :: bool :: If True, serial operations read the grid
+        window of neighbouring selection geometries once and subset each
+        geometry from it. Collections are returned in cluster order. Defaults
+        to `env.SHARED_WINDOW`.
     '''
     
-    def __init__(self,ops,serial=True,nprocs=1):
+    def __init__(self,ops,serial=True,nprocs=None,window=None,ordered=None,
+                 pool=None,time_partitions=None,batch=None,shared_window=None):
         self.ops = ops
         self.serial = serial
-        self.nprocs = nprocs
+        self.pool = pool
+        self.time_partitions = time_partitions or env.TIME_PARTITIONS
+        if pool is None:
+            self.nprocs = nprocs or env.CORES
+        else:
+            self.nprocs = pool.processes
+        self.window = window or env.PARALLEL_WINDOW or 2*self.nprocs
+        self.ordered = env.PARALLEL_ORDERED if ordered is None else ordered
+        ## selection geometries loaded from the shapefile cabinet may use the
+        ## overlay cache
+        geom = self.ops._get_object_('geom')
+        self.shp_key = geom._shp_key if geom._bounds is None else None
+        ## aggregated values for many selection geometries may be computed
+        ## from a single read of the data. raw values are not kept.
+        batch = env.AGGREGATE_BATCH if batch is None else batch
+        self.batch = (batch and self.ops.aggregate and not self.ops.calc_raw and
+                      len(self.ops.geom) > 1 and
+                      all([geom_dict['geom'] is not None for geom_dict in self.ops.geom]))
+        ## neighbouring selection geometries may share a single read of their
+        ## grid window
+        shared_window = env.SHARED_WINDOW if shared_window is None else shared_window
+        self.shared_window = (shared_window and len(self.ops.geom) > 1 and
+                              all([geom_dict['geom'] is not None for geom_dict in self.ops.geom]))
+        
+        ## aggregated geometries are only constructed if the output format
+        ## writes them
+        if self.ops.output_format in ('meta',None):
+            self.use_geometry = True
+        else:
+            self.use_geometry = OcgConverter.get_converter(self.ops.output_format)._use_geometry
         
         ## construct OcgDataset objects
 #        uri_map = {}
@@ -52,6 +110,9 @@ class SubsetOperation(object):
             self.itype = SpatialInterfacePoint
         else:
             raise(ValueError('Input datasets must have same geometry types. Perhaps overload "s_abstraction"?'))
+        ## envelope windows are only available from the polygon cell index
+        if self.itype != SpatialInterfacePolygon:
+            self.shared_window = False
 
         ## create the calculation engine
         if self.ops.calc is None:
@@ -113,22 +174,178 @@ class SubsetOperation(object):
         OcgCollection'''
         
         ## simple iterator for serial operations
-        if self.serial:
-            it = itertools.imap(get_collection,self._iter_proc_args_())
-        ## use a multiprocessing pool returning unordered geometries
-        ## for the parallel case
+        if self.serial and self.pool is None:
+            if self.batch:
+                colls = get_batch_collections(self)
+            elif self.shared_window:
+                colls = self._iter_shared_()
+            else:
+                colls = itertools.imap(get_collection,self._iter_proc_args_())
+            for coll in colls:
+                yield(coll)
+            return
+        
+        partitions = self.get_time_partitions()
+        ## a shared pool's workers rebuild the operation from its plan. the pool
+        ## outlives the operation.
+        if self.pool is not None:
+            plan = self.get_plan()
+            tasks = ((plan,)+task for task in self._iter_tasks_(partitions))
+            results = imap_bounded(self.pool,_get_planned_collection_,tasks,
+                                   self.window,ordered=self.ordered)
+            for coll in self._iter_concatenated_(results,partitions):
+                yield(coll)
+        ## use a multiprocessing pool for the parallel case. workers receive
+        ## the operation once when they start and tasks only carry the
+        ## selection geometry.
         else:
-            pool = Pool(processes=self.nprocs)
-            it = pool.imap_unordered(get_collection,
-                                     self._iter_proc_args_())
-        ## the iterator return from the Pool requires calling its 'next'
-        ## method and catching the StopIteration exception
-        while True:
+            pool = Pool(processes=self.nprocs,initializer=_init_worker_,
+                        initargs=(self,))
             try:
-                yld = it.next()
-                yield(yld)
-            except StopIteration:
-                break
+                results = imap_bounded(pool,_get_worker_collection_,
+                                       self._iter_tasks_(partitions),self.window,
+                                       ordered=self.ordered)
+                for coll in self._iter_concatenated_(results,partitions):
+                    yield(coll)
+            finally:
+                pool.terminate()
+                pool.join()
+                
+    def get_time_partitions(self):
+        '''Return slices partitioning the selected time steps for each
+        selection geometry or `None` if work is not partitioned. Partitions
+        are aligned to the calculation groups and are only created if each
+        group is contiguous in time (e.g. groupings including "year").
+        
+        returns
+        
+        list of slice'''
+        
+        nparts = self.time_partitions
+        if nparts is None or nparts < 2 or self.ops.snippet:
+            return(None)
+        ## partitions index the selected time steps which must be the same
+        ## for all datasets
+        dims = []
+        for dataset in self.ops.dataset:
+            ref = dataset.ocg_dataset.i.temporal
+            timeidx = ref.subset_timeidx(dataset.time_range)
+            bounds = None if ref.bounds is None else ref.bounds[timeidx,:]
+            dims.append(TemporalDimension(ref.tid[timeidx],ref.value[timeidx],
+                                          bounds=bounds))
+        for dim in dims[1:]:
+            if not np.array_equal(dim.value,dims[0].value):
+                return(None)
+        ntime = len(dims[0])
+        ## time steps where a partition may start
+        if self.cengine is None or self.cengine.grouping is None:
+            starts = np.arange(ntime)
+        else:
+            tgdim = dims[0].group(self.cengine.grouping)
+            labels = tgdim.dgroups.labels
+            starts = np.concatenate(([0],np.flatnonzero(np.diff(labels) != 0)+1))
+            if len(starts) != len(tgdim):
+                return(None)
+        ## start partitions at the first group boundary following equal splits
+        targets = np.arange(1,nparts)*ntime/float(nparts)
+        idx = np.searchsorted(starts,targets)
+        cuts = np.unique(starts[idx[idx < len(starts)]])
+        edges = [0] + [int(cut) for cut in cuts if 0 < cut < ntime] + [ntime]
+        if len(edges) <= 2:
+            ret = None
+        else:
+            ret = [slice(start,stop) for start,stop in zip(edges[:-1],edges[1:])]
+        return(ret)
+        
+    def get_window_clusters(self,budget=None):
+        '''Group the selection geometries into clusters of neighbours whose
+        grid windows are read once. Geometries are visited in Z-order of their
+        window centres and join the current cluster while the union window of
+        every dataset is no larger than the members' separate windows and fits
+        within the budget.
+        
+        budget=None :: float :: Megabytes of data held for a cluster. Defaults
+            to :attr:`~ocgis.OcgOperations.memory_budget` or
+            `env.SHARED_WINDOW_BUDGET`.
+        
+        returns
+        
+        list of tuple :: (geometry indices,windows) where windows is a list of
+            (row_start,row_stop,col_start,col_stop) native windows for each
+            dataset or `None` if the geometries are read individually.'''
+        
+        budget = budget or self.ops.memory_budget or env.SHARED_WINDOW_BUDGET
+        budget = budget*1024**2
+        cell_bytes = [dataset.ocg_dataset.get_cell_bytes(dataset.time_range,
+                                                         dataset.level_range)
+                      for dataset in self.ops.dataset]
+        ## envelope window of each geometry for each dataset
+        windows = []
+        for geom_dict in self.ops.geom:
+            geom_windows = []
+            for dataset in self.ops.dataset:
+                spatial = dataset.ocg_dataset.i.spatial
+                geom_copy = deepcopy(geom_dict)
+                if spatial.is_360:
+                    unwrap_geoms([geom_copy],spatial.pm)
+                geom_windows.append(_get_native_window_(spatial,geom_copy['geom']))
+            if any([window is None for window in geom_windows]):
+                geom_windows = None
+            windows.append(geom_windows)
+        _cost_ = lambda wins: sum([(w[1]-w[0])*(w[3]-w[2])*nbytes
+                                   for w,nbytes in zip(wins,cell_bytes)])
+        
+        def _key_(idx):
+            if windows[idx] is None:
+                return(-1)
+            r0,r1,c0,c1 = windows[idx][0]
+            return(_morton_((r0+r1)//2,(c0+c1)//2))
+        
+        ret = []
+        members,union,separate = [],None,0
+        for idx in sorted(range(len(windows)),key=_key_):
+            wins = windows[idx]
+            if wins is not None and len(members) > 0:
+                merged = [(min(u[0],w[0]),max(u[1],w[1]),min(u[2],w[2]),max(u[3],w[3]))
+                          for u,w in zip(union,wins)]
+                cost = _cost_(merged)
+                if cost <= budget and cost <= separate+_cost_(wins):
+                    members.append(idx)
+                    union,separate = merged,separate+_cost_(wins)
+                    continue
+            if len(members) > 0:
+                ret.append((members,union if len(members) > 1 else None))
+                members,union,separate = [],None,0
+            if wins is None or _cost_(wins) > budget:
+                ret.append(([idx],None))
+            else:
+                members,union,separate = [idx],wins,_cost_(wins)
+        if len(members) > 0:
+            ret.append((members,union if len(members) > 1 else None))
+        return(ret)
+        
+    def get_plan(self):
+        '''Return a compact pickled plan used by shared pool workers to rebuild
+        the operation. Dataset objects are not pickled and the selection
+        geometries are replaced by the envelope of the first geometry since
+        tasks carry their own geometry.
+        
+        returns
+        
+        str'''
+        
+        ops = copy(self.ops)
+        geom_dict = self.ops.geom[0]
+        if geom_dict['geom'] is not None:
+            minx,miny,maxx,maxy = geom_dict['geom'].bounds
+            geom_dict = {'ugid':geom_dict['ugid'],
+                         'geom':make_poly((miny,maxy),(minx,maxx))}
+        geom = Geom([geom_dict])
+        geom._shp_key = self.shp_key
+        object.__setattr__(ops,'geom',geom)
+        dataset = Dataset(RequestDatasetCollection([rd.to_plan() for rd in self.ops.dataset]))
+        object.__setattr__(ops,'dataset',dataset)
+        return(cPickle.dumps(ops,cPickle.HIGHEST_PROTOCOL))
         
     def _iter_proc_args_(self):
         '''Generate arguments for the extraction function.
@@ -144,12 +361,174 @@ class SubsetOperation(object):
         for geom_dict in self.ops.geom:
             yield(self,geom_dict)
             
-def get_collection((so,geom_dict)):
+    def _iter_shared_(self):
+        '''Generate collections reading the grid window of each cluster of
+        selection geometries once (see :meth:`get_window_clusters`).'''
+        
+        for members,windows in self.get_window_clusters():
+            if windows is None:
+                buffers = None
+            else:
+                buffers = []
+                for dataset,(r0,r1,c0,c1) in itertools.izip(self.ops.dataset,windows):
+                    buffers.append(dataset.ocg_dataset.read_window(
+                                        np.arange(r0,r1),np.arange(c0,c1),
+                                        time_range=dataset.time_range,
+                                        level_range=dataset.level_range))
+            for idx in members:
+                yield(get_collection((self,self.ops.geom[idx]),buffers=buffers))
+            
+    def _iter_tasks_(self,partitions=None):
+        '''Generate compact tasks for pool workers.
+        
+        partitions=None :: list of slice :: Time partitions for each
+            selection geometry.
+        
+        yields
+        
+        ugid :: int
+        geom :: str or None :: WKB of the selection geometry
+        time_slice :: slice or None
+        '''
+        
+        for geom_dict in self.ops.geom:
+            geom = geom_dict['geom']
+            if geom is not None:
+                geom = geom.wkb
+            for time_slice in partitions or [None]:
+                yield(geom_dict['ugid'],geom,time_slice)
+                
+    def _iter_concatenated_(self,results,partitions):
+        '''Concatenate the time partitions of each selection geometry as the
+        last partition finishes.'''
+        
+        if partitions is None:
+            for _,coll in results:
+                yield(coll)
+            return
+        finished = {}
+        for time_slice,coll in results:
+            ugid = coll.ugeom['ugid']
+            finished.setdefault(ugid,{})[time_slice.start] = coll
+            if len(finished[ugid]) == len(partitions):
+                colls = finished.pop(ugid)
+                yield(OcgCollection.concatenate([colls[key] for key in sorted(colls)]))
+            
+def imap_bounded(pool,func,tasks,window,ordered=False,poll=0.01):
+    '''Apply `func` to `tasks` using `pool` with at most `window` tasks in
+    flight. A new task is only submitted after a result is consumed, so
+    finished results never accumulate beyond the window when the consumer is
+    slower than the workers.
+    
+    pool :: multiprocessing.Pool
+    func :: function
+    tasks :: iterable
+    window :: int
+    ordered=False :: bool :: If True, results are returned in task order.
+        Otherwise, results are returned as they finish.
+    poll=0.01 :: float :: Seconds to wait for a result before checking the
+        other tasks in flight.
+    
+    yields
+    
+    object :: Result of `func` for each task.'''
+    
+    tasks = iter(tasks)
+    in_flight = deque()
+    def _fill_():
+        for task in itertools.islice(tasks,window-len(in_flight)):
+            in_flight.append(pool.apply_async(func,(task,)))
+    _fill_()
+    while len(in_flight) > 0:
+        if ordered:
+            result = in_flight.popleft()
+        else:
+            result = None
+            while result is None:
+                for result in in_flight:
+                    if result.ready():
+                        break
+                else:
+                    in_flight[0].wait(poll)
+                    result = None
+            in_flight.remove(result)
+        ## raises the worker's exception if the task failed
+        ret = result.get()
+        _fill_()
+        yield(ret)
+            
+## operation executed by a pool worker process
+_worker_so = None
+
+def _init_worker_(so):
+    global _worker_so
+    _worker_so = so
+    
+def _get_worker_collection_((ugid,geom,time_slice)):
+    coll = get_collection((_worker_so,_get_geom_dict_(ugid,geom)),
+                          time_slice=time_slice)
+    return(time_slice,coll)
+
+## operations rebuilt from plans by shared pool workers. the most recently used
+## operations are kept so consecutive tasks of a request reuse their datasets.
+## entries are stamped with the state of their dataset files and rebuilt when a
+## file is modified.
+_worker_plans = OrderedDict()
+_worker_plans_size = 4
+
+def _get_planned_collection_((plan,ugid,geom,time_slice)):
+    try:
+        so,stamps = _worker_plans.pop(plan)
+        if stamps != _get_plan_stamps_(so):
+            raise(KeyError(plan))
+    except KeyError:
+        so = SubsetOperation(cPickle.loads(plan))
+        stamps = _get_plan_stamps_(so)
+    _worker_plans[plan] = (so,stamps)
+    while len(_worker_plans) > _worker_plans_size:
+        _worker_plans.popitem(last=False)
+    coll = get_collection((so,_get_geom_dict_(ugid,geom)),time_slice=time_slice)
+    return(time_slice,coll)
+
+def _get_plan_stamps_(so):
+    return([NcHandlePool._get_stamp_(rd.uri) for rd in so.ops.dataset])
+
+def _get_geom_dict_(ugid,geom):
+    if geom is not None:
+        geom = wkb.loads(geom)
+    return({'ugid':ugid,'geom':geom})
+            
+def _get_native_window_(spatial,geom):
+    '''Return the native window (row_start,row_stop,col_start,col_stop) of
+    grid cells overlapping the envelope of `geom` or `None`.'''
+    
+    window = spatial.index.get_window(geom)
+    if window is None:
+        return(None)
+    rstart,rstop,cstart,cstop = window
+    rows = spatial.index.row_axis.order[rstart:rstop]
+    cols = spatial.index.col_axis.order[cstart:cstop]
+    return(int(rows.min()),int(rows.max())+1,int(cols.min()),int(cols.max())+1)
+
+def _morton_(row,col,bits=16):
+    '''Interleave the bits of a row and column index. Windows close in the
+    grid have close keys.'''
+    
+    ret = 0
+    for bit in range(bits):
+        ret |= ((row >> bit) & 1) << (2*bit+1)
+        ret |= ((col >> bit) & 1) << (2*bit)
+    return(ret)
+            
+def get_collection((so,geom_dict),time_slice=None,buffers=None):
     '''Execute requested operations.
     
     so :: SubsetOperation
     geom_dict :: dict :: Geometry dictionary with the following structure:
         {'id':int,'geom':Shapely Polygon or MultiPolygon}
+    time_slice=None :: slice :: Time partition of the selected time steps.
+    buffers=None :: list of WindowBuffer :: Shared window data for each
+        dataset.
         
     returns
     
@@ -163,6 +542,15 @@ def get_collection((so,geom_dict)):
     ## store geoms for later clipping. needed because some may be wrapped while
     ## others unwrapped.
     geom_copys = []
+    ## overlays of the selection geometry with each dataset's grid. new
+    ## overlays are cached once the spatial operation is complete.
+    overlays = []
+    new_overlays = []
+    ## stream the data in time chunks if the calculations allow it
+    if so.cengine is not None and so.cengine.mergeable:
+        memory_budget = so.ops.memory_budget
+    else:
+        memory_budget = None
     for dataset in so.ops.dataset:
         ## use a copy of the geometry dictionary, since it may be modified
         geom_copy = deepcopy(geom_dict)
@@ -172,12 +560,19 @@ def get_collection((so,geom_dict)):
         ## wrap the geometry dictionary if needed
         if ref.i.spatial.is_360 and so.ops._get_object_('geom').is_empty is False:
             unwrap_geoms([geom_copy],ref.i.spatial.pm)
+        ## select the cells from a cached overlay if one exists
+        overlay = _get_overlay_(so,ref.i.spatial,geom_copy,new_overlays)
+        overlays.append(overlay)
         ## perform the data subset
         ocg_variable = ref.subset(
                             polygon=geom_copy['geom'],
                             time_range=dataset.time_range,
                             level_range=dataset.level_range,
-                            allow_empty=so.ops.allow_empty)
+                            allow_empty=so.ops.allow_empty,
+                            memory_budget=memory_budget,
+                            time_slice=time_slice,
+                            select=None if overlay is None else (overlay.row,overlay.col),
+                            buffer=None if buffers is None else buffers[len(geom_copys)-1])
         ## tell the keyed iterator if this should be used for identifiers.
         ocg_variable._use_for_id = dataset._use_for_id
         ## update the variable's alias
@@ -193,19 +588,89 @@ def get_collection((so,geom_dict)):
 
     ## skip other operations if the dataset is empty
     if coll.is_empty:
+        for args in new_overlays:
+            put_overlay(*args)
         return(coll)
     
     ## clipping operation
     if so.ops.spatial_operation == 'clip':
         if so.itype == SpatialInterfacePolygon:
-            for geom_copy,var in itertools.izip(geom_copys,
-                                                coll.variables.itervalues()):
-                var.clip(geom_copy['geom'])
+            for geom_copy,var,overlay in itertools.izip(geom_copys,
+                                                coll.variables.itervalues(),
+                                                overlays):
+                var.clip(geom_copy['geom'],overlay=overlay)
+    for args in new_overlays:
+        put_overlay(*args)
             
     ## data aggregation.
     if so.ops.aggregate:
-        coll.aggregate(new_id=coll.ugeom['ugid'])
+        coll.aggregate(new_id=coll.ugeom['ugid'],union=so.use_geometry)
+    
+    return(_finish_collection_(so,coll))
+
+def get_batch_collections(so):
+    '''Execute requested operations aggregating the data of each dataset for
+    all selection geometries in a single pass (see
+    :meth:`~ocgis.api.dataset.dataset.OcgDataset.subset_batch`).
+    
+    so :: SubsetOperation
+    
+    yields
+    
+    OcgCollection'''
+    
+    clip = so.ops.spatial_operation == 'clip' and so.itype == SpatialInterfacePolygon
+    ## aggregated variables for each dataset
+    variables = []
+    new_overlays = []
+    for dataset in so.ops.dataset:
+        ref = dataset.ocg_dataset
+        geom_copys = deepcopy(list(so.ops.geom))
+        if ref.i.spatial.is_360 and so.ops._get_object_('geom').is_empty is False:
+            unwrap_geoms(geom_copys,ref.i.spatial.pm)
+        overlays = [_get_overlay_(so,ref.i.spatial,geom_copy,new_overlays)
+                    for geom_copy in geom_copys]
+        variables.append(ref.subset_batch(geom_copys,
+                                          time_range=dataset.time_range,
+                                          level_range=dataset.level_range,
+                                          allow_empty=so.ops.allow_empty,
+                                          memory_budget=so.ops.memory_budget,
+                                          clip=clip,
+                                          overlays=overlays,
+                                          union=so.use_geometry))
+    for args in new_overlays:
+        put_overlay(*args)
+    
+    for idx,geom_dict in enumerate(so.ops.geom):
+        coll = OcgCollection(ugeom=geom_dict)
+        for dataset,dataset_variables in itertools.izip(so.ops.dataset,variables):
+            ocg_variable = dataset_variables[idx]
+            ocg_variable._use_for_id = dataset._use_for_id
+            ocg_variable.alias = dataset.alias
+            ocg_variable._i = dataset.ocg_dataset.i
+            coll.projection = dataset.ocg_dataset.i.spatial.projection
+            coll.add_variable(ocg_variable)
+        if not coll.is_empty:
+            coll = _finish_collection_(so,coll)
+        yield(coll)
         
+def _get_overlay_(so,spatial,geom_dict,new_overlays):
+    '''Return the overlay of a selection geometry with a grid or `None` if
+    overlays are not cached for the operation. New overlays are appended to
+    `new_overlays` as arguments for `put_overlay`.'''
+    
+    if so.shp_key is None or geom_dict['geom'] is None:
+        return(None)
+    key = (so.shp_key,geom_dict['ugid'],so.ops.spatial_operation)
+    ret = get_overlay(spatial,*key)
+    if ret is None:
+        ret = Overlay(*spatial.select(geom_dict['geom']))
+        new_overlays.append((ret,spatial)+key)
+    return(ret)
+
+def _finish_collection_(so,coll):
+    '''Wrap and calculate a subset and aggregated collection.'''
+    
     ## if it is a vector output, wrap the data (if requested).
     ## TODO: every variable may not need to be wrapped
     for dataset in so.ops.dataset:
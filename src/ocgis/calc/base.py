@@ -1,9 +1,10 @@
 import re
 import json
-from ocgis.util.helpers import itersubclasses
+from ocgis.util.helpers import itersubclasses, spatial_average
 import groups
 import numpy as np
 import itertools
+from ocgis.api.dataset.collection.dimension import TemporalGroups
 
 
 class OcgFunctionTree(object):
@@ -72,6 +73,13 @@ class OcgFunction(object):
     Group = None
     nargs = 0
     dtype = None
+    #: If `True`, the function implements :meth:`_reduce_` and is calculated
+    #: for all temporal groups at once.
+    reducible = False
+    #: If `True`, the function implements :meth:`_partial_`, :meth:`_merge_`,
+    #: and :meth:`_finalize_` and may be calculated from consecutive chunks of
+    #: time steps using :meth:`update` and :meth:`finalize`.
+    mergeable = False
     
     def __init__(self,values=None,groups=None,agg=False,weights=None,kwds={}):
         self.values = values
@@ -79,6 +87,10 @@ class OcgFunction(object):
         self.agg = agg
         self.weights = weights
         self.kwds = kwds
+        ## running partial results when calculating from time chunks
+        self._partial = None
+        self._seen = None
+        self._template = None
         
         if self.text is None:
             self.text = self.__class__.__name__
@@ -91,24 +103,69 @@ class OcgFunction(object):
     def calculate(self):
         ## holds output from calculation
         fill = self._get_fill_(self.values)
-        ## iterate over temporal groups and levels
-        for idx,group in enumerate(self.groups):
-            value_slice = self.values[group,:,:,:]
-            calc = self._calculate_(value_slice,**self.kwds)
-            fill[idx] = calc
+        if self.reducible and isinstance(self.groups,TemporalGroups):
+            ## sort the time steps by group and reduce each segment
+            groups = self.groups
+            values = self.values[groups.order]
+            fill[:] = self._reduce_(values,groups.offsets[:-1],np.diff(groups.offsets),
+                                    **self.kwds)
+        else:
+            ## iterate over temporal groups and levels
+            for idx,group in enumerate(self.groups):
+                value_slice = self.values[group,:,:,:]
+                calc = self._calculate_(value_slice,**self.kwds)
+                fill[idx] = calc
         ## if data is calculated on raw values, but area-weighting is required
         ## aggregate the data using provided weights.
         ret = self.aggregate_spatial(fill)
         return(ret)
     
+    def update(self,values,start):
+        '''Merge the partial results for a chunk of consecutive time steps
+        into the running calculation. `groups` must be the
+        :class:`TemporalGroups` for the complete time series.
+        
+        values :: masked ndarray :: four-dimensional chunk of time steps
+        start :: int :: time index of the chunk's first time step'''
+        
+        labels = self.groups.labels[start:start+values.shape[0]]
+        present,labels = np.unique(labels,return_inverse=True)
+        groups = TemporalGroups(labels,present.shape[0])
+        part = self._partial_(values[groups.order],groups.offsets[:-1],
+                              np.diff(groups.offsets),**self.kwds)
+        if self._partial is None:
+            ngroups = len(self.groups)
+            self._partial = [np.empty((ngroups,)+p.shape[1:],dtype=p.dtype) for p in part]
+            self._seen = np.zeros(ngroups,dtype=bool)
+            ## the first time step provides the output mask
+            self._template = values[0:1]
+        ## groups first encountered in this chunk take the partial results
+        ## directly. others are merged with the earlier results.
+        seen = self._seen[present]
+        new = np.invert(seen)
+        for full,p in itertools.izip(self._partial,part):
+            full[present[new]] = p[new]
+        if seen.any():
+            idx = present[seen]
+            merged = self._merge_([full[idx] for full in self._partial],
+                                  [p[seen] for p in part])
+            for full,m in itertools.izip(self._partial,merged):
+                full[idx] = m
+        self._seen[present] = True
+        
+    def finalize(self):
+        '''Return the calculation for all time chunks passed to
+        :meth:`update`.'''
+        
+        fill = self._get_fill_(self._template)
+        fill[:] = self._finalize_(self._partial)
+        ret = self.aggregate_spatial(fill)
+        return(ret)
+    
     def aggregate_spatial(self,fill):
         if self.agg:
-            ##TODO: possible speed-up with array operations
-            aw = np.empty((fill.shape[0],fill.shape[1],1,1),dtype=fill.dtype)
-            aw = np.ma.array(aw,mask=False)
-            for tidx,lidx in itertools.product(range(fill.shape[0]),range(fill.shape[1])):
-                aw[tidx,lidx,:] = self._aggregate_spatial_(fill[tidx,lidx,:],self.weights)
-            ret = aw
+            ## aggregate all time groups and levels at once
+            ret = self._aggregate_spatial_(fill,self.weights).astype(fill.dtype)
         else:
             ret = fill
         return(ret)
@@ -117,9 +174,45 @@ class OcgFunction(object):
     def _calculate_(values,**kwds):
         raise(NotImplementedError)
     
+    @classmethod
+    def _reduce_(cls,values,starts,counts,**kwds):
+        '''Calculate the function for all temporal groups at once. Mergeable
+        functions finalize their partial results by default.
+        
+        values :: masked ndarray :: time steps sorted by group
+        starts :: int ndarray :: index of each group's first time step
+        counts :: int ndarray :: number of time steps in each group
+        
+        returns
+        
+        masked ndarray with the group count as the leading dimension'''
+        if not cls.mergeable:
+            raise(NotImplementedError)
+        return(cls._finalize_(cls._partial_(values,starts,counts,**kwds)))
+    
+    @staticmethod
+    def _partial_(values,starts,counts,**kwds):
+        '''Return a sequence of arrays with the group count as the leading
+        dimension holding mergeable partial results. Arguments match
+        :meth:`_reduce_`.'''
+        raise(NotImplementedError)
+    
+    @staticmethod
+    def _merge_(a,b):
+        '''Combine partial results for the same groups where `a` precedes
+        `b` in time.'''
+        raise(NotImplementedError)
+    
+    @staticmethod
+    def _finalize_(partial):
+        '''Convert partial results to the calculated values.'''
+        raise(NotImplementedError)
+    
     @staticmethod
     def _aggregate_spatial_(values,weights):
-        return(np.ma.average(values,weights=weights))
+        '''Aggregate the (row,col) dimensions of four-dimensional `values`
+        returning an array with shape (time,level,1,1).'''
+        return(spatial_average(values,weights))
     
     def _get_fill_(self,values):
         fill = np.empty((len(self.groups),values.shape[1],values.shape[2],values.shape[3]),dtype=self.dtype)
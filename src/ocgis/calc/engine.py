@@ -1,6 +1,7 @@
 from base import OcgCvArgFunction
 from ocgis.calc.library import SampleSize
 from ocgis.api.dataset.collection.collection import OcgMultivariateCalculationVariable
+from ocgis.util.helpers import spatial_average
 
 
 class OcgCalculationEngine(object):
@@ -30,6 +31,9 @@ class OcgCalculationEngine(object):
             self.use_agg = True
         else:
             self.use_agg = False
+        ## aggregated values are already area-weighted. functions only
+        ## aggregate spatially when calculating on raw values.
+        self.agg_funcs = self.agg and not self.use_agg
         
 #    def set_funcs(self,funcs):
 #        potentials = OcgFunctionTree.get_potentials()
@@ -44,6 +48,16 @@ class OcgCalculationEngine(object):
 #                f['kwds'] = {}
 #        return(funcs)
 
+    @property
+    def mergeable(self):
+        '''`True` if all calculations may be performed on time chunks of
+        streamed variables.'''
+        if self.grouping is None:
+            ret = False
+        else:
+            ret = all([f['ref'].mergeable for f in self.funcs])
+        return(ret)
+    
     def _get_value_(self,ocg_variable):
         ## select the value source based on raw or aggregated switches
         if not self.use_agg and ocg_variable.raw_value is not None:
@@ -60,6 +74,10 @@ class OcgCalculationEngine(object):
             for ocg_variable in coll.variables.itervalues():
                 ocg_variable.group(self.grouping)
         
+        ## streamed variables are calculated one time chunk at a time
+        if any([var.value is None for var in coll.variables.itervalues()]):
+            return(self._execute_chunked_(coll))
+        
 #        ## flag used for sample size calculation for multivariate calculations
 #        has_multi = False
         ## iterate over functions
@@ -88,7 +106,7 @@ class OcgCalculationEngine(object):
                     ## update dict with properly reference data
                     kwds.update({key:value})
                 ## function object instance
-                ref = f['ref'](agg=self.agg,groups=dgroups,kwds=kwds,weights=weights)
+                ref = f['ref'](agg=self.agg_funcs,groups=dgroups,kwds=kwds,weights=weights)
                 calc = ref.calculate()
                 ## store calculation value
                 var = OcgMultivariateCalculationVariable(f['name'],calc,arch.temporal,arch.spatial,arch.level)
@@ -100,7 +118,7 @@ class OcgCalculationEngine(object):
                     value = self._get_value_(var)
                     ## make the function instance
                     try:
-                        ref = f['ref'](values=value,agg=self.agg,
+                        ref = f['ref'](values=value,agg=self.agg_funcs,
                                        groups=var.temporal_group.dgroups,
                                        kwds=f['kwds'],weights=var.spatial.weights)
                     except AttributeError:
@@ -126,3 +144,20 @@ class OcgCalculationEngine(object):
 #                    n += value.calc_value['n_'+key]
 #            coll.calc_multi['n_multi'] = n
 #            coll.cid.add('n_multi')
+
+    def _execute_chunked_(self,coll):
+        for var in coll.variables.itervalues():
+            refs = []
+            for f in self.funcs:
+                ref = f['ref'](agg=self.agg_funcs,groups=var.temporal_group.dgroups,
+                               kwds=f['kwds'],weights=var.spatial.weights)
+                refs.append((f['name'],ref))
+            ## read each chunk once and update all calculations
+            for start,value in var.chunks:
+                if self.use_agg:
+                    value = spatial_average(value,var.spatial.weights)
+                for _,ref in refs:
+                    ref.update(value,start)
+            for name,ref in refs:
+                var.calc_value.update({name:ref.finalize()})
+            coll.add_calculation(var)
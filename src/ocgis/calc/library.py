@@ -1,7 +1,53 @@
 import groups
 from base import OcgFunction, OcgCvArgFunction, OcgArgFunction
 import numpy as np
-from ocgis.util.helpers import iter_array
+
+
+def reduce_count(values,starts):
+    '''Count unmasked values in each temporal group segment.'''
+    valid = np.invert(np.ma.getmaskarray(values))
+    return(np.add.reduceat(valid,starts,axis=0,dtype=int))
+
+def reduce_mean(values,starts):
+    '''Return the masked mean and unmasked count of each temporal group
+    segment.'''
+    n = reduce_count(values,starts)
+    total = np.add.reduceat(np.ma.filled(values,0),starts,axis=0,dtype=float)
+    mean = np.ma.array(total/np.maximum(n,1),mask=(n == 0))
+    return(mean,n)
+
+def get_occurrences(values,threshold,operation):
+    '''Return a boolean array that is `True` where the logical `operation`
+    ("gt", "lt", "gte", or "lte") against `threshold` is satisfied. Masked
+    values are never occurrences.'''
+    if operation == 'gt':
+        arr = values > threshold
+    elif operation == 'lt':
+        arr = values < threshold
+    elif operation == 'gte':
+        arr = values >= threshold
+    elif operation == 'lte':
+        arr = values <= threshold
+    else:
+        raise(ValueError('logical operation "{0}" not recognized'.format(operation)))
+    return(np.ma.filled(arr,False))
+
+def get_run_lengths(arr,starts=None):
+    '''Return the length of the run of `True` values ending at each position
+    along the first axis of the boolean array `arr`. All other axes are
+    computed simultaneously. If segment `starts` are provided, runs restart at
+    the beginning of each segment.
+    
+    >>> get_run_lengths(np.array([True,True,False,True]))
+    array([1, 2, 0, 1])'''
+    csum = np.cumsum(arr,axis=0,dtype=int)
+    ## the cumulative sum at the last non-occurrence is subtracted to restart
+    ## the count after each break
+    reset = np.where(arr,0,csum)
+    if starts is not None:
+        reset[starts] = csum[starts] - arr[starts]
+    np.maximum.accumulate(reset,axis=0,out=reset)
+    return(csum - reset)
 
 
 class SampleSize(OcgFunction):
@@ -14,6 +60,8 @@ class SampleSize(OcgFunction):
     description = 'Statistical sample size.'
     Group = groups.BasicStatistics
     dtype = int
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values):
@@ -22,9 +70,29 @@ class SampleSize(OcgFunction):
         ret = np.ma.array(ret,mask=values.mask[0,0,:])
         return(ret)
     
+    @staticmethod
+    def _partial_(values,starts,counts):
+        ## the sample is masked using the first time step of each group
+        return(counts,np.ma.getmaskarray(values)[starts])
+    
+    @staticmethod
+    def _merge_(a,b):
+        return(a[0]+b[0],a[1])
+    
+    @staticmethod
+    def _finalize_(partial):
+        counts,first = partial
+        ret = np.empty(first.shape,dtype=int)
+        ret[:] = counts.reshape(-1,1,1,1)
+        mask = np.empty(first.shape,dtype=bool)
+        mask[:] = first[:,0:1]
+        return(np.ma.array(ret,mask=mask))
+    
     @staticmethod
     def _aggregate_spatial_(values,weights):
-        return(np.ma.sum(values))
+        shp = values.shape
+        ret = np.ma.sum(values.reshape(shp[0],shp[1],-1),axis=2)
+        return(ret.reshape(shp[0],shp[1],1,1))
 
 
 class Median(OcgFunction):
@@ -41,41 +109,115 @@ class Mean(OcgFunction):
     description = 'Mean value for the series.'
     Group = groups.BasicStatistics
     dtype = float
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values):
         return(np.mean(values,axis=0))
     
+    @staticmethod
+    def _partial_(values,starts,counts):
+        total = np.add.reduceat(np.ma.filled(values,0),starts,axis=0,dtype=float)
+        return(total,reduce_count(values,starts))
+    
+    @staticmethod
+    def _merge_(a,b):
+        return(a[0]+b[0],a[1]+b[1])
+    
+    @staticmethod
+    def _finalize_(partial):
+        total,n = partial
+        return(np.ma.array(total/np.maximum(n,1),mask=(n == 0)))
+    
     
 class Max(OcgFunction):
     description = 'Max value for the series.'
     Group = groups.BasicStatistics
     dtype = float
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values):
         return(np.max(values,axis=0))
     
+    @staticmethod
+    def _partial_(values,starts,counts):
+        filled = np.ma.filled(values,np.ma.maximum_fill_value(values))
+        return(np.maximum.reduceat(filled,starts,axis=0),reduce_count(values,starts))
+    
+    @staticmethod
+    def _merge_(a,b):
+        return(np.maximum(a[0],b[0]),a[1]+b[1])
+    
+    @staticmethod
+    def _finalize_(partial):
+        return(np.ma.array(partial[0],mask=(partial[1] == 0)))
+    
     
 class Min(OcgFunction):
     description = 'Min value for the series.'
     Group = groups.BasicStatistics
     dtype = float
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values):
         return(np.min(values,axis=0))
     
+    @staticmethod
+    def _partial_(values,starts,counts):
+        filled = np.ma.filled(values,np.ma.minimum_fill_value(values))
+        return(np.minimum.reduceat(filled,starts,axis=0),reduce_count(values,starts))
+    
+    @staticmethod
+    def _merge_(a,b):
+        return(np.minimum(a[0],b[0]),a[1]+b[1])
+    
+    @staticmethod
+    def _finalize_(partial):
+        return(np.ma.array(partial[0],mask=(partial[1] == 0)))
+    
     
 class StandardDeviation(OcgFunction):
     description = 'Standard deviation for the series.'
     Group = groups.BasicStatistics
     dtype = float
     name = 'std'
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values):
         return(np.std(values,axis=0))
+    
+    @staticmethod
+    def _partial_(values,starts,counts):
+        ## two-pass calculation using deviations from the group means
+        mean,n = reduce_mean(values,starts)
+        mean = mean.data
+        dev = np.ma.filled(values,0) - np.repeat(mean,counts,axis=0)
+        dev[np.ma.getmaskarray(values)] = 0
+        return(n,mean,np.add.reduceat(dev**2,starts,axis=0))
+    
+    @staticmethod
+    def _merge_(a,b):
+        ## combine counts, means, and sums of squared deviations
+        na,mean_a,ssd_a = a
+        nb,mean_b,ssd_b = b
+        n = na + nb
+        nn = np.maximum(n,1)
+        delta = mean_b - mean_a
+        mean = mean_a + delta*nb/nn
+        ssd = ssd_a + ssd_b + delta**2*na*nb/nn
+        return(n,mean,ssd)
+    
+    @staticmethod
+    def _finalize_(partial):
+        n,_,ssd = partial
+        return(np.ma.array(np.sqrt(ssd/np.maximum(n,1)),mask=(n == 0)))
 
 
 class MaxConsecutive(OcgArgFunction):
@@ -85,48 +227,60 @@ class MaxConsecutive(OcgArgFunction):
     dtype = int
     description = ('Maximum number of consecutive occurrences in the sequence'
                    ' where the logical operation returns TRUE.')
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values,threshold=None,operation=None):
-        ## time index reference
-        ref = np.arange(0,values.shape[0])
-        ## storage array for counts
-        store = np.empty(list(values.shape)[1:])
-        ## perform requested logical operation
-        if operation == 'gt':
-            arr = values > threshold
-        elif operation == 'lt':
-            arr = values < threshold
-        elif operation == 'gte':
-            arr = values >= threshold
-        elif operation == 'lte':
-            arr = values <= threshold
-
-        ## find longest sequence for each geometry across time dimension
-        for xidx,yidx in iter_array(values[0,:]):
-            vec = arr[:,xidx,yidx]
-#            ## collapse data if no axis provided
-#            if axis is None:
-#                vec = vec.reshape(-1)
-            ## check first if there is a longer series than 1
-            if np.any(np.diff(ref[vec]) == 1):
-                split_idx = ref[np.diff(vec)] + 1
-                splits = np.array_split(vec,split_idx)
-                sums = [a.sum() for a in splits if np.all(a)]
-                fill = np.max(sums)
-            ## case of only a singular occurrence
-            elif np.any(vec):
-                fill = 1
-            ## case for no occurrence
-            else:
-                fill = 0
-            store[xidx,yidx] = fill
-        
-#        ## summarize across geometries if axis is collapsed
-#        if axis is None:
-#            store = np.max(store)
-            
-        return(store)
+        ## length of the run ending at each time step
+        runs = get_run_lengths(get_occurrences(values,threshold,operation))
+        return(runs.max(axis=0))
+    
+    @staticmethod
+    def _partial_(values,starts,counts,threshold=None,operation=None):
+        arr = get_occurrences(values,threshold,operation)
+        runs = get_run_lengths(arr,starts=starts)
+        ## time steps, leading run, trailing run, and longest run per group
+        steps = counts.reshape((-1,)+(1,)*(arr.ndim-1))
+        pos = np.arange(arr.shape[0]) - np.repeat(starts,counts)
+        pos = np.where(arr,arr.shape[0],pos.reshape((-1,)+(1,)*(arr.ndim-1)))
+        lead = np.minimum(np.minimum.reduceat(pos,starts,axis=0),steps)
+        trail = runs[starts+counts-1]
+        longest = np.maximum.reduceat(runs,starts,axis=0)
+        return(steps,lead,trail,longest)
+    
+    @staticmethod
+    def _merge_(a,b):
+        steps_a,lead_a,trail_a,longest_a = a
+        steps_b,lead_b,trail_b,longest_b = b
+        ## runs spanning the whole earlier or later part continue across the
+        ## boundary
+        lead = np.where(lead_a == steps_a,steps_a+lead_b,lead_a)
+        trail = np.where(trail_b == steps_b,steps_b+trail_a,trail_b)
+        longest = np.maximum(np.maximum(longest_a,longest_b),trail_a+lead_b)
+        return(steps_a+steps_b,lead,trail,longest)
+    
+    @staticmethod
+    def _finalize_(partial):
+        return(partial[3])
+    
+    
+class CountConsecutive(OcgArgFunction):
+    name = 'count_cons'
+    nargs = 3
+    Group = groups.Thresholds
+    dtype = int
+    description = ('Number of sequences of consecutive occurrences longer than'
+                   ' length where the logical operation returns TRUE.')
+    
+    @staticmethod
+    def _calculate_(values,threshold=None,operation=None,length=None):
+        arr = get_occurrences(values,threshold,operation)
+        runs = get_run_lengths(arr)
+        ## a run ends where the next time step is not an occurrence
+        ends = arr.copy()
+        ends[:-1] &= np.invert(arr[1:])
+        return(np.sum(ends & (runs > length),axis=0))
         
 
 class Between(OcgArgFunction):
@@ -134,11 +288,26 @@ class Between(OcgArgFunction):
     description = 'Count of values falling within the limits lower and upper (inclusive).'
     Group = groups.Thresholds
     dtype = int
+    reducible = True
+    mergeable = True
     
     @staticmethod
     def _calculate_(values,lower=None,upper=None):
         idx = (values >= lower)*(values <= upper)
         return(np.sum(idx,axis=0))
+    
+    @staticmethod
+    def _partial_(values,starts,counts,lower=None,upper=None):
+        idx = np.ma.filled((values >= lower)*(values <= upper),False)
+        return(np.add.reduceat(idx,starts,axis=0,dtype=int),reduce_count(values,starts))
+    
+    @staticmethod
+    def _merge_(a,b):
+        return(a[0]+b[0],a[1]+b[1])
+    
+    @staticmethod
+    def _finalize_(partial):
+        return(np.ma.array(partial[0],mask=(partial[1] == 0)))
 
 
 #class FooMulti(OcgCvArgFunction):
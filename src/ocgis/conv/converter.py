@@ -17,6 +17,9 @@ class OcgConverter(object):
     '''
     _ext = None
     _create_directory = True
+    ## if False, the output does not contain geometries and aggregated
+    ## geometries are not constructed
+    _use_geometry = True
     
     def __init__(self,so,mode='raw',prefix='ocg',wd=None,ops=None,add_meta=True,nest=True):
         self.so = so
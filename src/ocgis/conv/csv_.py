@@ -9,6 +9,7 @@ class OcgDialect(excel):
 
 class CsvConverter(OcgConverter):
     _ext = 'csv'
+    _use_geometry = False
     
     def __init__(self,*args,**kwds):
 #        self.wkt = kwds.pop('wkt')
@@ -2,6 +2,7 @@ from ocgis.conv.converter import OcgConverter
 import netCDF4 as nc
 from ocgis.interface.interface import SpatialInterfacePoint
 import numpy as np
+from ocgis.util.ncpool import close_handles
 
     
 class NcConverter(OcgConverter):
@@ -136,7 +137,9 @@ class NcConverter(OcgConverter):
         for ii,coll in enumerate(self):
             if ii > 0:
                 raise(ValueError('only one collection should be returned for NC conversion'))
-        ## dataset object to write to
+        ## dataset object to write to. a pooled read handle on the output path
+        ## (e.g. from inspecting an earlier result) would block the write.
+        close_handles(self.path)
         ds = nc.Dataset(self.path,'w')
         ## reference the interfaces
         arch = coll._arch
@@ -157,33 +160,35 @@ class NcConverter(OcgConverter):
         
         ## spatial variable calculation ########################################
         
-        ## first construct values from the stored geometry array
-        geom = arch.spatial._value
-        
-#        ##tdk
-#        from ocgis.util.helpers import iter_array
-#        lc = np.empty(geom.shape,dtype=float)
-#        for idx,g in iter_array(geom,return_value=True,use_mask=False):
-#            lc[idx] = g.centroid.x
-#        import ipdb;ipdb.set_trace()
-#        ##tdk
-        
-        latitude_values = np.empty(geom.shape[0],dtype=float)
-        longitude_values = np.empty(geom.shape[1],dtype=float)
-        if is_poly:
-            latitude_bounds_values = np.empty((geom.shape[0],2),dtype=float)
-            longitude_bounds_values = np.empty((geom.shape[1],2),dtype=float)
-        ## iterate geometries filling in updated geometry values
-        for row_idx in range(len(geom[:,0])):
-            latitude_values[row_idx] = geom[row_idx,0].centroid.y
-            lon_min,lat_min,lon_max,lat_max = geom[row_idx,0].bounds
+        ## first construct values from the stored cell bounds. fall back to the
+        ## geometry array if the bounds are not available.
+        bounds = arch.spatial.bounds
+        if bounds is not None:
+            row_bounds = np.sort(np.column_stack((bounds[:,0,1],bounds[:,0,3])),axis=1)
+            col_bounds = np.sort(np.column_stack((bounds[0,:,0],bounds[0,:,2])),axis=1)
+            latitude_values = row_bounds.mean(axis=1)
+            longitude_values = col_bounds.mean(axis=1)
             if is_poly:
-                latitude_bounds_values[row_idx,:] = [lat_min,lat_max]
-        for col_idx in range(len(geom[0,:])):
-            longitude_values[col_idx] = geom[0,col_idx].centroid.x
-            lon_min,lat_min,lon_max,lat_max = geom[0,col_idx].bounds
+                latitude_bounds_values = row_bounds
+                longitude_bounds_values = col_bounds
+        else:
+            geom = arch.spatial._value
+            latitude_values = np.empty(geom.shape[0],dtype=float)
+            longitude_values = np.empty(geom.shape[1],dtype=float)
             if is_poly:
-                longitude_bounds_values[col_idx,:] = [lon_min,lon_max]
+                latitude_bounds_values = np.empty((geom.shape[0],2),dtype=float)
+                longitude_bounds_values = np.empty((geom.shape[1],2),dtype=float)
+            ## iterate geometries filling in updated geometry values
+            for row_idx in range(len(geom[:,0])):
+                latitude_values[row_idx] = geom[row_idx,0].centroid.y
+                lon_min,lat_min,lon_max,lat_max = geom[row_idx,0].bounds
+                if is_poly:
+                    latitude_bounds_values[row_idx,:] = [lat_min,lat_max]
+            for col_idx in range(len(geom[0,:])):
+                longitude_values[col_idx] = geom[0,col_idx].centroid.x
+                lon_min,lat_min,lon_max,lat_max = geom[0,col_idx].bounds
+                if is_poly:
+                    longitude_bounds_values[col_idx,:] = [lon_min,lon_max]
 
         ## make dimensions #####################################################
         
@@ -15,6 +15,20 @@ DIR_SHPCABINET = os.path.expanduser('~/links/ocgis/bin/shp')
 #: chosen.
 DIR_DATA = None
 
+#: Directory for the on-disk cache of parsed dataset interfaces (dimensions, 
+#: decoded time vectors, bounds and projection). Entries are keyed by the file's
+#: location, modification time, size and interface overloads and are written to
+#: a private subdirectory for each user. Defaults to the `OCGIS_DIR_INTERFACE_CACHE`
+#: environment variable. Use :func:`ocgis.interface.cache.clear_cache` to remove
+#: entries. If `None`, interfaces are not cached.
+DIR_INTERFACE_CACHE = os.environ.get('OCGIS_DIR_INTERFACE_CACHE')
+
+#: Directory for the on-disk cache of overlays between :class:`~ocgis.ShpCabinet` geometries and dataset grids (selected cells and clipped cell areas). Entries are keyed by the grid, shapefile key and version, geometry identifier and spatial operation. Use :func:`ocgis.interface.overlay.invalidate` if a shapefile is modified in place. If `None`, overlays are not cached.
+DIR_OVERLAY_CACHE = None
+
+#: Maximum size of the overlay cache in megabytes. The least recently used overlays are removed first. If `None`, the cache is not limited.
+OVERLAY_CACHE_SIZE = 512
+
 #: The fill value for masked data in NetCDF output.
 #: If `True`, execute in serial. Only set to `False` if you are confident in your grasp of the software and operation.
 SERIAL = True
@@ -22,8 +36,32 @@ SERIAL = True
 #: If operating in parallel (i.e. :attr:`~ocgis.env.SERIAL` = `False`), specify the number of cores to use.
 CORES = 6
 
+#: If operating in parallel, the maximum number of selection geometries in flight. Results are only produced as fast as they are consumed keeping memory bounded. If `None`, it defaults to twice the number of cores.
+PARALLEL_WINDOW = None
+
+#: If operating in parallel and `True`, return results in the order of the selection geometries.
+PARALLEL_ORDERED = False
+
+#: Number of tasks a worker of a long-lived :class:`~ocgis.api.pool.WorkerPool` completes before it is replaced. If `None`, workers are never replaced.
+WORKER_MAX_TASKS = 500
+
+#: If operating in parallel, the number of time partitions each selection geometry is split into. Partitions do not split calculation groups and are only used if groups are contiguous in time. If `None`, work is only distributed across selection geometries.
+TIME_PARTITIONS = None
+
+#: If `True`, serial operations aggregating many selection geometries without raw calculations read each dataset once. Area weights for all geometries are collected in a sparse weight matrix applied to each time chunk of the data (see :attr:`~ocgis.OcgOperations.memory_budget`).
+AGGREGATE_BATCH = False
+
+#: If `True`, serial operations read the grid window of neighbouring selection geometries once and subset each geometry from it. Geometries are clustered so a window is never larger than the separate reads of its members.
+SHARED_WINDOW = False
+
+#: Megabytes of data read for a shared window if :attr:`~ocgis.OcgOperations.memory_budget` is not set. Geometries whose windows do not fit are read individually.
+SHARED_WINDOW_BUDGET = 256
+
 MODE = 'raw'
 
+#: Maximum number of open NetCDF handles kept by the process-local handle pool.
+NC_POOL_SIZE = 8
+
 #: The default prefix to apply to output files.
 PREFIX = 'ocg'
 
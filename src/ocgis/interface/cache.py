@@ -0,0 +1,149 @@
+import os
+import stat
+import cPickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+from warnings import warn
+from ocgis import env
+from ocgis.interface.interface import GlobalInterface
+from ocgis.util.ncpool import get_handle
+
+
+## version of the pickled interface layout. it is part of the cache key and
+## must be incremented when attributes of the interfaces are added or changed.
+CACHE_VERSION = 2
+
+## attributes cached interfaces must provide. entries written by older code
+## without them are rebuilt.
+_required = {'temporal':['_value64','_bounds64'],
+             'spatial':['index']}
+
+## interfaces loaded in this process keyed by cache path. long-lived worker
+## processes reuse them between operations.
+_loaded = OrderedDict()
+_loaded_size = 8
+
+
+def get_interface(uri,target_var,overload={}):
+    '''Return a :class:`GlobalInterface` for `target_var` in `uri`. If
+    `env.DIR_INTERFACE_CACHE` is set, parsed interfaces for local files are
+    stored on disk and reused while the file and the overloads are unchanged.
+    Entries are only read from a private directory owned by the current user.
+    The most recently used interfaces are also kept in memory.
+
+    uri :: str or sequence of str
+    target_var :: str
+    overload={} :: dict
+
+    returns
+
+    GlobalInterface'''
+
+    path = get_cache_path(uri,target_var,overload=overload)
+    ret = _loaded.pop(path,None)
+    if ret is None and path is not None and _is_private_(os.path.dirname(path)):
+        try:
+            with open(path,'rb') as f:
+                ret = cPickle.load(f)
+            _check_interface_(ret)
+        except IOError:
+            ret = None
+        ## a stale or unreadable entry is simply rebuilt
+        except Exception as e:
+            warn('unable to load cached interface "{0}": {1}'.format(path,e))
+            ret = None
+    if ret is None:
+        ret = GlobalInterface(get_handle(uri),target_var,overload=overload)
+        if path is not None:
+            _dump_(ret,path)
+    if path is not None:
+        _loaded[path] = ret
+        while len(_loaded) > _loaded_size:
+            _loaded.popitem(last=False)
+    return(ret)
+
+def get_cache_path(uri,target_var,overload={}):
+    '''Return the cache file location for an interface or `None` if the
+    interface may not be cached.'''
+
+    if env.DIR_INTERFACE_CACHE is None:
+        return(None)
+    if isinstance(uri,basestring):
+        uris = [uri]
+    else:
+        uris = list(uri)
+    ## remote datasets cannot be checked for modification
+    key = [CACHE_VERSION,target_var,sorted(overload.iteritems())]
+    for u in uris:
+        try:
+            st = os.stat(u)
+        except OSError:
+            return(None)
+        key.append((os.path.abspath(u),st.st_mtime,st.st_size))
+    name = hashlib.sha1(repr(key)).hexdigest() + '.pkl'
+    return(os.path.join(get_cache_dir(),name))
+
+def get_cache_dir():
+    '''Return the current user's directory inside `env.DIR_INTERFACE_CACHE`
+    or `None` if interfaces are not cached.'''
+
+    if env.DIR_INTERFACE_CACHE is None:
+        return(None)
+    return(os.path.join(env.DIR_INTERFACE_CACHE,'user-{0}'.format(os.getuid())))
+
+def clear_cache():
+    '''Remove all entries from the current user's interface cache directory.'''
+
+    _loaded.clear()
+    dirname = get_cache_dir()
+    if dirname is None or not _is_private_(dirname):
+        return
+    for name in os.listdir(dirname):
+        if name.endswith('.pkl'):
+            os.remove(os.path.join(dirname,name))
+
+def _check_interface_(interface):
+    if not isinstance(interface,GlobalInterface):
+        raise(TypeError('cached object is not an interface'))
+    for name,attrs in _required.iteritems():
+        for attr in attrs:
+            getattr(getattr(interface,name),attr)
+
+def _is_private_(dirname):
+    ## the directory must be a real directory owned by this user and not
+    ## accessible to anyone else. entries in other directories are ignored.
+    try:
+        st = os.lstat(dirname)
+    except OSError:
+        return(False)
+    return(stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+           not st.st_mode & (stat.S_IRWXG | stat.S_IRWXO))
+
+def _dump_(interface,path):
+    dirname = os.path.dirname(path)
+    tmp = None
+    try:
+        ## other processes may create the directories concurrently
+        try:
+            os.makedirs(env.DIR_INTERFACE_CACHE)
+        except OSError:
+            if not os.path.isdir(env.DIR_INTERFACE_CACHE):
+                raise
+        try:
+            os.mkdir(dirname,0700)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+        if not _is_private_(dirname):
+            raise(OSError('cache directory is not private to the current user'))
+        ## write to a temporary file and rename so concurrent readers never
+        ## see a partial entry.
+        fd,tmp = tempfile.mkstemp(dir=dirname,suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            cPickle.dump(interface,f,cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp,path)
+    except (IOError,OSError,cPickle.PicklingError,TypeError) as e:
+        warn('unable to cache interface "{0}": {1}'.format(path,e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
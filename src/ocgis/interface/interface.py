@@ -3,13 +3,11 @@ from ocgis.interface.ncmeta import NcMetadata
 import inspect
 import netCDF4 as nc
 import datetime
-from ocgis.util.helpers import iter_array, approx_resolution, vprint, contains,\
-    append
+from ocgis.util.helpers import iter_array, approx_resolution, vprint
+from ocgis.util.spatial.select import GridIndex, PointIndex
 import numpy as np
 from ocgis.interface.projection import get_projection
 from shapely.geometry.polygon import Polygon
-from shapely import prepared
-from shapely.geometry.point import Point
 from ocgis.exc import DummyLevelEncountered
 
 
@@ -53,6 +51,13 @@ class GlobalInterface(object):
             self.spatial = SpatialInterfacePolygon(self._row,self._col,projection)
         else:
             self.spatial = SpatialInterfacePoint(self._row,self._col,projection)
+            
+    def __getstate__(self):
+        ## the dimension map holds netCDF4 variables which are only required
+        ## during construction and may not be pickled.
+        state = self.__dict__.copy()
+        state['_dim_map'] = None
+        return(state)
     
     def _get_axis_(self,dimvar,dims,dim):
         try:
@@ -134,6 +139,12 @@ class AbstractInterface(object):
             self.name_bounds = self._ref_bnds._name
         except AttributeError:
             self.name_bounds = None
+            
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_ref','_ref_var','_ref_bnds']:
+            state[key] = None
+        return(state)
         
     def format(self):
         if self._ref_var is None:
@@ -164,6 +175,19 @@ class AbstractInterface(object):
 class TemporalInterface(AbstractInterface):
     _axis = 'T'
     _name = 'temporal'
+    _calendars_datetime64 = ('standard','gregorian','proleptic_gregorian')
+    _calendars_fixed = {'noleap':[31,28,31,30,31,30,31,31,30,31,30,31],
+                        '365_day':[31,28,31,30,31,30,31,31,30,31,30,31],
+                        'all_leap':[31,29,31,30,31,30,31,31,30,31,30,31],
+                        '366_day':[31,29,31,30,31,30,31,31,30,31,30,31],
+                        '360_day':[30]*12}
+    _gregorian_reform = np.datetime64('1582-10-15','s')
+    _datetime_min = np.datetime64('0001-01-01','s')
+    _datetime_max = np.datetime64('9999-12-31T23:59:59','s')
+    _units_seconds = {'days':86400,'day':86400,'d':86400,
+                      'hours':3600,'hour':3600,'hrs':3600,'hr':3600,'h':3600,
+                      'minutes':60,'minute':60,'mins':60,'min':60,
+                      'seconds':1,'second':1,'secs':1,'sec':1,'s':1}
     
     def __init__(self,gi,t_calendar=None,t_units=None):
         super(TemporalInterface,self).__init__(gi)
@@ -174,51 +198,138 @@ class TemporalInterface(AbstractInterface):
         self.format()
         
         self.timeidx = np.arange(0,len(self.value))
+        ## numeric copies of the time vector used for range searches
+        self._value64 = self.value.astype('datetime64[s]')
+        if self.bounds is None:
+            self._bounds64 = None
+        else:
+            self._bounds64 = self.bounds.astype('datetime64[s]')
         self.tid = np.arange(1,len(self.value)+1)
         self.resolution = self.get_approx_res_days()
                 
     def _format_value_(self):
-        ret = nc.num2date(self._ref_var[:],self.units,self.calendar)
-        self._to_datetime_(ret)
-        return(ret)
+        return(self._decode_(self._ref_var[:],self.units,self.calendar))
     
     def _format_bounds_(self):
-        ret = nc.num2date(self._ref_bnds[:],self.units,self.calendar)
-        self._to_datetime_(ret)
+        return(self._decode_(self._ref_bnds[:],self.units,self.calendar))
+    
+    @classmethod
+    def _decode_(cls,values,units,calendar):
+        """Decode numeric time values to an object array of :class:`datetime.datetime`.
+        Gregorian and fixed-length calendars are decoded with array arithmetic.
+        Anything else falls back to `num2date`."""
+        
+        values = np.ma.getdata(values)
+        ret = None
+        try:
+            step = cls._units_seconds[units.split()[0].lower()]
+        except KeyError:
+            step = None
+        if step is not None:
+            calendar_key = calendar.lower()
+            if calendar_key in cls._calendars_datetime64:
+                ret = cls._decode_gregorian_(values,units,calendar_key,step)
+            elif calendar_key in cls._calendars_fixed:
+                ret = cls._decode_fixed_(values,units,calendar_key,step)
+        if ret is None:
+            ret = cls._to_datetime_(nc.num2date(values,units,calendar))
+        else:
+            ret = cls._to_object_(ret)
+        return(ret)
+    
+    @staticmethod
+    def _get_offsets_(values,step):
+        ## offsets are rounded to the millisecond to absorb floating point
+        ## noise and truncated to whole seconds when converted.
+        return(np.round(np.asarray(values,dtype=float)*(step*1000)).astype(np.int64))
+    
+    @classmethod
+    def _decode_gregorian_(cls,values,units,calendar,step):
+        ## let netCDF parse the reference date in the units string
+        origin = nc.num2date(0,units,calendar)
+        origin = np.datetime64(datetime.datetime(origin.year,origin.month,origin.day,
+                                                 origin.hour,origin.minute,origin.second),'ms')
+        ret = origin + cls._get_offsets_(values,step).astype('timedelta64[ms]')
+        ret = ret.astype('datetime64[s]')
+        ## mixed julian/gregorian calendars differ from numpy's proleptic
+        ## gregorian calendar before the reform date.
+        if calendar != 'proleptic_gregorian' and ret.size > 0:
+            if min(origin,ret.min()) < cls._gregorian_reform:
+                ret = None
+        return(ret)
+    
+    @classmethod
+    def _decode_fixed_(cls,values,units,calendar,step):
+        month_days = np.array(cls._calendars_fixed[calendar])
+        month_start = np.cumsum(month_days) - month_days
+        year_days = month_days.sum()
+        ## seconds since the start of year zero in the model calendar
+        origin = nc.num2date(0,units,calendar)
+        origin = ((origin.year*year_days + month_start[origin.month-1] + origin.day-1)*86400 +
+                   origin.hour*3600 + origin.minute*60 + origin.second)
+        seconds = origin + cls._get_offsets_(values,step)//1000
+        days,seconds = np.divmod(seconds,86400)
+        year,doy = np.divmod(days,year_days)
+        month = np.searchsorted(month_start,doy,side='right')
+        day = doy - month_start[month-1]
+        ## assemble the dates and reject days the real calendar does not have
+        ## (e.g. February 30th).
+        ret = (year-1970).astype('datetime64[Y]').astype('datetime64[M]') + (month-1)
+        check = ret
+        ret = ret.astype('datetime64[D]') + day
+        if np.any(ret.astype('datetime64[M]') != check):
+            raise(ValueError('day is out of range for month'))
+        ret = ret.astype('datetime64[s]') + seconds
+        return(ret)
+    
+    @classmethod
+    def _to_object_(cls,arr):
+        if arr.size > 0 and (arr.min() < cls._datetime_min or arr.max() > cls._datetime_max):
+            raise(ValueError('year is out of range'))
+        return(arr.astype(object))
+        
+    @staticmethod
+    def _to_datetime_(arr):
+        ret = np.empty(arr.shape,dtype=object)
+        ret.flat = [datetime.datetime(t.year,t.month,t.day,t.hour,t.minute,t.second)
+                    for t in np.ravel(arr)]
         return(ret)
-        
-    def _to_datetime_(self,arr):
-        for idx,t in iter_array(arr,return_value=True):
-            arr[idx] = datetime.datetime(t.year,t.month,t.day,
-                                         t.hour,t.minute,t.second)
             
     def subset_timeidx(self,time_range):
+        """Return the time indices intersecting `time_range`. Monotonically
+        increasing time axes are searched with :func:`numpy.searchsorted` and
+        return a contiguous slice. Other time axes return an index array."""
+        
         if time_range is None:
-            ret = self.timeidx
+            ret = slice(0,len(self.value))
         else:
+            lower,upper = np.array(time_range,dtype='datetime64[s]')
             if self.bounds is None:
-                ret = self.timeidx[(self.value>=time_range[0])*
-                                   (self.value<=time_range[1])]
+                ref = self._value64
+                if self._is_increasing_(ref):
+                    ret = slice(np.searchsorted(ref,lower,side='left'),
+                                np.searchsorted(ref,upper,side='right'))
+                else:
+                    ret = self.timeidx[(ref>=lower)*(ref<=upper)]
             else:
-                select = np.empty(self.value.shape,dtype=bool)
-                for idx in np.arange(self.bounds.shape[0]):
-                    bnds = self.bounds[idx,:]
-                    idx1 = (time_range[0]>bnds[0])*(time_range[0]<bnds[1])
-                    idx2 = (time_range[0]<=bnds[0])*(time_range[1]>=bnds[1])
-                    idx3 = (time_range[1]>bnds[0])*(time_range[1]<bnds[1])
-                    select[idx] = np.logical_or(np.logical_or(idx1,idx2),idx3)
-                ret = self.timeidx[select]
+                ## a time step is selected if its bounds intersect the range.
+                ## this is the intervals' open overlap.
+                ref_lower,ref_upper = self._bounds64[:,0],self._bounds64[:,1]
+                if self._is_increasing_(ref_lower) and self._is_increasing_(ref_upper):
+                    start = np.searchsorted(ref_upper,lower,side='right')
+                    stop = np.searchsorted(ref_lower,upper,side='left')
+                    ret = slice(start,max(start,stop))
+                else:
+                    ret = self.timeidx[(ref_lower<upper)*(ref_upper>lower)]
         return(ret)
     
+    @staticmethod
+    def _is_increasing_(arr):
+        return(bool(np.all(arr[1:] >= arr[:-1])))
+    
     def get_approx_res_days(self):
-        diffs = np.array([],dtype=float)
-        for tidx,tval in iter_array(self.value,return_value=True):
-            try:
-                diffs = np.append(diffs,
-                                np.abs((tval-self.value[tidx[0]+1]).days))
-            except IndexError:
-                break
-        return(diffs.mean())
+        diffs = np.diff(self.value.astype('datetime64[s]')).astype(float)
+        return(np.abs(diffs).mean()/86400.0)
     
     def calculate(self,values):
         ret = nc.date2num(values,self.units,calendar=self.calendar)
@@ -263,6 +374,7 @@ class ColumnInterface(AbstractInterface):
         
 
 class AbstractSpatialInterface(object):
+    _abstraction = None
     
     def __init__(self,row,col,projection):
         self.row = row
@@ -279,27 +391,52 @@ class AbstractSpatialInterface(object):
         if self._count is None:
             self._count = self.gid.shape[0]*self.gid.shape[1]
         return(self._count)
+    @property
+    def abstraction(self):
+        return(self._abstraction)
         
     def select(self,polygon=None):
         if polygon is None:
-            return(self._get_all_geoms_())
+            return(self._get_all_())
         else:
             return(self._select_(polygon))
         
+    def get_cell_bounds(self,rowidx,colidx):
+        """Return the cell bounds of a grid window without constructing
+        geometries.
+        
+        rowidx :: int ndarray
+        colidx :: int ndarray
+        
+        returns
+        
+        float ndarray (len(rowidx),len(colidx),4) :: (min_col,min_row,max_col,max_row)"""
+        
+        ret = np.empty((len(rowidx),len(colidx),4),dtype=float)
+        for ii,ref in enumerate(self._get_bounds_arrays_()):
+            ret[:,:,ii] = ref[np.ix_(rowidx,colidx)]
+        return(ret)
+        
+    def _get_all_(self):
+        row = self.real_row.reshape(-1)
+        col = self.real_col.reshape(-1)
+        return(row,col)
+        
+    def _get_bounds_arrays_(self):
+        raise(NotImplementedError)
+        
     def _get_resolution_(self):
         return(approx_resolution(self.row.value))
         
     def _select_(self,polygon):
         raise(NotImplementedError)
         
-    def _get_all_geoms_(self):
-        raise(NotImplementedError)
-        
     def _get_wrapping_(self):
         raise(NotImplementedError)
 
 
 class SpatialInterfacePolygon(AbstractSpatialInterface):
+    _abstraction = 'polygon'
     
     def __init__(self,*args,**kwds):
         super(self.__class__,self).__init__(*args,**kwds)
@@ -316,6 +453,8 @@ class SpatialInterfacePolygon(AbstractSpatialInterface):
                                            self.real_col.shape[1]+1)\
                                .reshape(self.shape),
                                mask=False)
+        ## the cell index is built once and cached with the interface
+        self.index = GridIndex(self.row.bounds,self.col.bounds)
         
     def get_bounds(self,colidx):
         col,row = np.meshgrid(self.col.bounds[:,colidx],
@@ -344,6 +483,9 @@ class SpatialInterfacePolygon(AbstractSpatialInterface):
         weight = weight/weight.max()
         return(weight)
     
+    def _get_bounds_arrays_(self):
+        return(self.min_col,self.min_row,self.max_col,self.max_row)
+    
     def _get_wrapping_(self):
         ## check for values over 180 in the bounds variables. if higher values
         ## exists, user geometries will need to be wrapped and data may be 
@@ -363,77 +505,17 @@ class SpatialInterfacePolygon(AbstractSpatialInterface):
             
         return(is_360,pm)
     
-    def _get_all_geoms_(self):
-        geom = np.empty(self.shape,dtype=object)
-        min_col,max_col,min_row,max_row = self.min_col,self.max_col,self.min_row,self.max_row
-        
-        for ii,jj in iter_array(geom,use_mask=False):
-            geom[ii,jj] = Polygon(((min_col[ii,jj],min_row[ii,jj]),
-                                   (max_col[ii,jj],min_row[ii,jj]),
-                                   (max_col[ii,jj],max_row[ii,jj]),
-                                   (min_col[ii,jj],max_row[ii,jj])))
-
-        row = self.real_row.reshape(-1)
-        col = self.real_col.reshape(-1)
-        
-        return(geom,row,col)
-    
     def _select_(self,polygon):
         vprint('entering select...')
-#        prep_polygon = prepared.prep(polygon)
-        emin_col,emin_row,emax_col,emax_row = polygon.envelope.bounds
-        smin_col = contains(self.min_col,
-                            emin_col,emax_col,
-                            self.resolution)
-        smax_col = contains(self.max_col,
-                            emin_col,emax_col,
-                            self.resolution)
-        smin_row = contains(self.min_row,
-                            emin_row,emax_row,
-                            self.resolution)
-        smax_row = contains(self.max_row,
-                            emin_row,emax_row,
-                            self.resolution)
-        include = np.any((smin_col,smax_col),axis=0)*\
-                  np.any((smin_row,smax_row),axis=0)
-        vprint('initial subset complete.')
-        
-        vprint('building spatial index...')
-        from ocgis.util.spatial import index as si
-        grid = si.build_index_grid(30.0,polygon)
-        index = si.build_index(polygon,grid)
-        index_intersects = si.index_intersects
-        
-        ## construct the reference matrices
-        geom = np.empty(self.shape,dtype=object)
-        row = np.array([],dtype=int)
-        col = np.array([],dtype=int)
-        
-        real_row = self.real_row
-        real_col = self.real_col
-        min_row = self.min_row
-        min_col = self.min_col
-        max_row = self.max_row
-        max_col = self.max_col
-#        append = append
-        
-        vprint('starting main loop...')
-        for ii,jj in iter_array(include,use_mask=False):
-            if include[ii,jj]:
-                test_geom = Polygon(((min_col[ii,jj],min_row[ii,jj]),
-                                     (max_col[ii,jj],min_row[ii,jj]),
-                                     (max_col[ii,jj],max_row[ii,jj]),
-                                     (min_col[ii,jj],max_row[ii,jj])))
-                geom[ii,jj] = test_geom
-                if index_intersects(test_geom,index):
-                    append(row,real_row[ii,jj])
-                    append(col,real_col[ii,jj])
-        vprint('main select loop finished.')
-        
-        return(geom,row,col)  
+        ## classify cells in bulk using the cell index. only cells crossed by
+        ## the polygon boundary receive an exact geometry test.
+        row,col = self.index.select(polygon)
+        vprint('cell classification complete.')
+        return(row,col)
 
 
 class SpatialInterfacePoint(AbstractSpatialInterface):
+    _abstraction = 'point'
     
     def __init__(self,*args,**kwds):
         super(self.__class__,self).__init__(*args,**kwds)
@@ -456,37 +538,19 @@ class SpatialInterfacePoint(AbstractSpatialInterface):
         self.gid = np.ma.array(np.arange(1,self.real_col.shape[0]*
                                self.real_col.shape[1]+1).reshape(self.shape),
                                mask=False)
+        ## the point index is built once and cached with the interface
+        self.index = PointIndex(self.col_pt,self.row_pt)
         
     def calc_weights(self,npd,geom):
         weight = np.ma.array(np.ones((npd.shape[2],npd.shape[3]),dtype=float),
                              mask=npd.mask[0,0,:,:])
         return(weight)
+    
+    def _get_bounds_arrays_(self):
+        return(self.col_pt,self.row_pt,self.col_pt,self.row_pt)
 
     def _select_(self,polygon):
-        geom = np.empty(self.shape,dtype=object)
-        row = np.array([],dtype=int)
-        col = np.array([],dtype=int)
-#        append = append
-        
-        prep_polygon = prepared.prep(polygon)
-        for ii,jj in iter_array(self.col_pt,use_mask=False):
-            pt = Point(self.col_pt[ii,jj],self.row_pt[ii,jj])
-            geom[ii,jj] = pt
-            if prep_polygon.intersects(pt):
-                append(row,self.real_row[ii,jj])
-                append(col,self.real_col[ii,jj])
-        
-        return(geom,row,col)
-        
-    def _get_all_geoms_(self):
-        geom = np.empty(self.col_pt.shape,dtype=object)
-        for ii,jj in iter_array(self.col_pt,use_mask=False):
-            geom[ii,jj] = Point(self.col_pt[ii,jj],self.row_pt[ii,jj])
-            
-        row = self.real_row.reshape(-1)
-        col = self.real_col.reshape(-1)
-        
-        return(geom,row,col)
+        return(self.index.select(polygon))
         
     def _get_wrapping_(self):
         if self.col.value.max() > 180:
@@ -501,4 +565,4 @@ class SpatialInterfacePoint(AbstractSpatialInterface):
         miny = self.row.value.min()
         maxy = self.row.value.max()
         poly = Polygon(((minx,miny),(maxx,miny),(maxx,maxy),(minx,maxy)))
-        return(poly)
\ No newline at end of file
+        return(poly)
@@ -3,9 +3,13 @@ from ordereddict import OrderedDict
 
 class NcMetadata(OrderedDict):
     
-    def __init__(self,rootgrp):
+    def __init__(self,rootgrp=None):
         super(NcMetadata,self).__init__()
-        self._parse_(rootgrp)
+        if rootgrp is not None:
+            self._parse_(rootgrp)
+        
+    def __reduce__(self):
+        return(self.__class__,(),None,None,self.iteritems())
         
     def _parse_(self,rootgrp):
         ## get global metadata
@@ -0,0 +1,191 @@
+import os
+import shutil
+import cPickle
+import hashlib
+import tempfile
+import numpy as np
+from warnings import warn
+from shapely import wkb
+from ocgis import env
+
+
+class Overlay(object):
+    '''Overlay of a selection geometry and a grid: the selected cells and, for
+    clip operations, the clipped cell areas and boundary cell geometries.
+    Window indices are relative to the first selected row and column.
+
+    row :: int ndarray :: Native row indices of the selected cells.
+    col :: int ndarray :: Native column indices of the selected cells.'''
+
+    def __init__(self,row,col):
+        self.row = row
+        self.col = col
+        self.area = None
+        self.geoms = None
+
+    def get_select(self):
+        '''Return a boolean array that is `True` for selected cells of the
+        selection window.'''
+
+        row,col = self.row-self.row.min(),self.col-self.col.min()
+        ret = np.zeros((row.max()+1,col.max()+1),dtype=bool)
+        ret[row,col] = True
+        return(ret)
+
+    def set_clip(self,area,geoms):
+        '''Store clip results.
+
+        area :: float ndarray :: Clipped area for each cell of the window.
+        geoms :: dict :: Clipped geometries keyed by window index.'''
+
+        self.area = area
+        self.geoms = dict([(idx,geom.wkb) for idx,geom in geoms.iteritems()])
+
+    def iter_geoms(self):
+        for idx,geom in self.geoms.iteritems():
+            yield(idx,wkb.loads(geom))
+
+
+def get_overlay(spatial,shp_key,ugid,spatial_operation):
+    '''Return the cached :class:`Overlay` of a shapefile geometry and a grid or
+    `None` if it is not cached or `env.DIR_OVERLAY_CACHE` is not set.
+
+    spatial :: AbstractSpatialInterface
+    shp_key :: str :: :class:`~ocgis.ShpCabinet` key of the geometry.
+    ugid :: int
+    spatial_operation :: str
+
+    returns
+
+    Overlay'''
+
+    path = get_cache_path(spatial,shp_key,ugid,spatial_operation)
+    ret = None
+    if path is not None:
+        try:
+            with open(path,'rb') as f:
+                ret = cPickle.load(f)
+            ## mark the entry as recently used for eviction
+            os.utime(path,None)
+        except (IOError,OSError):
+            pass
+        except Exception as e:
+            warn('unable to load cached overlay "{0}": {1}'.format(path,e))
+    return(ret)
+
+def put_overlay(overlay,spatial,shp_key,ugid,spatial_operation):
+    '''Store an :class:`Overlay` in the cache. The least recently used entries
+    are evicted if the cache exceeds `env.OVERLAY_CACHE_SIZE`.'''
+
+    path = get_cache_path(spatial,shp_key,ugid,spatial_operation)
+    if path is None:
+        return
+    ## entries for a previous version of the shapefile are never used again
+    stat_dir = os.path.dirname(path)
+    key_dir = os.path.dirname(stat_dir)
+    if os.path.exists(key_dir):
+        for name in os.listdir(key_dir):
+            if name != os.path.basename(stat_dir):
+                shutil.rmtree(os.path.join(key_dir,name),ignore_errors=True)
+    _dump_(overlay,path)
+    evict()
+
+def get_cache_path(spatial,shp_key,ugid,spatial_operation):
+    '''Return the cache file location for an overlay or `None` if the overlay
+    may not be cached. Entries are stored by shapefile key and version.'''
+
+    if env.DIR_OVERLAY_CACHE is None or shp_key is None:
+        return(None)
+    from ocgis.util.shp_cabinet import ShpCabinet
+    try:
+        st = os.stat(ShpCabinet().get_shp_path(shp_key))
+    except OSError:
+        return(None)
+    version = hashlib.sha1(repr((st.st_mtime,st.st_size))).hexdigest()
+    key = [get_grid_fingerprint(spatial),ugid,spatial_operation]
+    name = hashlib.sha1(repr(key)).hexdigest() + '.pkl'
+    return(os.path.join(env.DIR_OVERLAY_CACHE,shp_key,version,name))
+
+def get_grid_fingerprint(spatial):
+    '''Return a fingerprint of a grid's extent, resolution, cell count, and
+    coordinates. The fingerprint is stored on the interface.'''
+
+    try:
+        return(spatial._fingerprint)
+    except AttributeError:
+        pass
+    key = [spatial.abstraction,spatial.extent().bounds,spatial.resolution,
+           spatial.count]
+    sha = hashlib.sha1(repr(key))
+    for dim in (spatial.row,spatial.col):
+        for arr in (dim.value,dim.bounds):
+            if arr is not None:
+                sha.update(np.ascontiguousarray(arr).data)
+    spatial._fingerprint = sha.hexdigest()
+    return(spatial._fingerprint)
+
+def invalidate(shp_key=None):
+    '''Remove cached overlays for a shapefile. Call this when a shapefile is
+    modified in place. Entries are also not used if the shapefile's
+    modification time or size change.
+
+    shp_key=None :: str :: If `None`, remove all cached overlays.'''
+
+    if env.DIR_OVERLAY_CACHE is None:
+        return
+    if shp_key is None:
+        path = env.DIR_OVERLAY_CACHE
+    else:
+        path = os.path.join(env.DIR_OVERLAY_CACHE,shp_key)
+    if os.path.exists(path):
+        for name in os.listdir(path):
+            target = os.path.join(path,name)
+            if os.path.isdir(target):
+                shutil.rmtree(target,ignore_errors=True)
+            else:
+                os.remove(target)
+
+def evict(size=None):
+    '''Remove the least recently used overlays until the cache holds at most
+    `size` megabytes. Defaults to `env.OVERLAY_CACHE_SIZE`.'''
+
+    size = env.OVERLAY_CACHE_SIZE if size is None else size
+    if env.DIR_OVERLAY_CACHE is None or size is None:
+        return
+    entries = []
+    for dirpath,dirnames,filenames in os.walk(env.DIR_OVERLAY_CACHE):
+        for name in filenames:
+            if name.endswith('.pkl'):
+                path = os.path.join(dirpath,name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime,st.st_size,path))
+    total = sum([entry[1] for entry in entries])
+    limit = size*1024**2
+    for mtime,nbytes,path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= nbytes
+
+def _dump_(overlay,path):
+    dirname = os.path.dirname(path)
+    tmp = None
+    try:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        ## write to a temporary file and rename so concurrent readers never
+        ## see a partial entry.
+        fd,tmp = tempfile.mkstemp(dir=dirname,suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            cPickle.dump(overlay,f,cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp,path)
+    except (IOError,OSError,cPickle.PicklingError,TypeError) as e:
+        warn('unable to cache overlay "{0}": {1}'.format(path,e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
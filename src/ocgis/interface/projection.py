@@ -36,6 +36,17 @@ class OcgSpatialReference(object):
     
     def __init__(self,*args,**kwds):
         self.sr = self.get_sr(*args,**kwds)
+        
+    def __getstate__(self):
+        ## OGR spatial references may not be pickled. they are rebuilt from the
+        ## class definition on load.
+        state = self.__dict__.copy()
+        state.pop('sr')
+        return(state)
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.sr = self.get_sr()
     
     @classmethod
     def _build_(cls,build_str=None):
@@ -4,6 +4,7 @@ import numpy as np
 import os.path
 import netCDF4 as nc
 from ocgis.util.helpers import iter_array
+from ocgis.util.ncpool import close_handles
 
 
 ## using points from |coords| adjust by |res| to provide bounds
@@ -98,6 +99,8 @@ def make_simple():
     ## WRITE THE NC FILE ###########################################################
     
     ## initialize the output file
+    ## release any pooled read handle on the file before overwriting it
+    close_handles(os.path.join(OUTDIR,OUTNAME))
     rootgrp = nc.Dataset(os.path.join(OUTDIR,OUTNAME),'w',format='NETCDF4')
     ## create the dimensions
     level = rootgrp.createDimension(LEVEL['name'],size=LEVEL['n'])
@@ -208,6 +211,8 @@ def make_simple_mask():
     ## WRITE THE NC FILE ###########################################################
     
     ## initialize the output file
+    ## release any pooled read handle on the file before overwriting it
+    close_handles(os.path.join(OUTDIR,OUTNAME))
     rootgrp = nc.Dataset(os.path.join(OUTDIR,OUTNAME),'w',format='NETCDF4')
     ## create the dimensions
     level = rootgrp.createDimension(LEVEL['name'],size=LEVEL['n'])
@@ -314,6 +319,8 @@ def make_simple_360():
     ## WRITE THE NC FILE ###########################################################
     
     ## initialize the output file
+    ## release any pooled read handle on the file before overwriting it
+    close_handles(os.path.join(OUTDIR,OUTNAME))
     rootgrp = nc.Dataset(os.path.join(OUTDIR,OUTNAME),'w',format='NETCDF4')
     ## create the dimensions
     level = rootgrp.createDimension(LEVEL['name'],size=LEVEL['n'])
@@ -8,6 +8,7 @@ from shapely.geometry.polygon import Polygon
 from ocgis import env
 from ocgis.api.interpreter import OcgInterpreter
 from ocgis.util.inspect import Inspect
+from ocgis.util.ncpool import close_handles
 
 
 class NcSpatial(object):
@@ -120,6 +121,7 @@ class Test360(unittest.TestCase):
             values[:,:,ii,:] = col_values
         values = np.ma.array(values,mask=False,fill_value=1e20)
         
+        close_handles(path)
         self.ds = nc.Dataset(path,'w')
         ds = self.ds
         
@@ -1,10 +1,12 @@
 import unittest
 import numpy as np
+import itertools
 from ocgis.calc import library
 from ocgis.api.operations import OcgOperations
 from nose.plugins.skip import SkipTest
 from datetime import datetime as dt
 from ocgis.api.dataset.collection.iterators import MeltedIterator, KeyedIterator
+from ocgis.api.dataset.collection.dimension import TemporalGroups
 
 
 class Test(unittest.TestCase):
@@ -79,6 +81,92 @@ class Test(unittest.TestCase):
         mean = library.Mean(values=values,agg=agg,weights=weights,groups=groups)
         ret = mean.calculate()
 
+    def test_reduce(self):
+        np.random.seed(1)
+        values = np.random.rand(40,2,3,4)
+        mask = np.random.rand(*values.shape) > 0.8
+        mask[:,:,0,0] = True
+        mask[0:5,:,1,1] = True
+        values = np.ma.array(values,mask=mask)
+        labels = np.repeat(np.arange(8),5)
+        np.random.shuffle(labels)
+        dgroups = TemporalGroups(labels,8)
+        ## the time indices for each group used by the looping calculation
+        groups = [np.where(labels == idx)[0] for idx in range(8)]
+        
+        for Func in [library.SampleSize,library.Mean,library.Max,library.Min,
+                     library.StandardDeviation]:
+            self.assertTrue(Func.reducible)
+            actual = Func(values=values,groups=dgroups).calculate()
+            desired = Func(values=values,groups=groups).calculate()
+            self.assertEqual(actual.shape,(8,2,3,4))
+            self.assertTrue(np.all(actual.mask == desired.mask))
+            self.assertTrue(np.allclose(actual.compressed(),desired.compressed()))
+            
+    def test_update(self):
+        np.random.seed(3)
+        values = np.random.rand(50,2,3,4)
+        values = np.ma.array(values,mask=np.random.rand(*values.shape) > 0.8)
+        values[0:20,:,1,1] = np.ma.masked
+        ## groups are not contiguous in time
+        labels = np.arange(50) % 6
+        dgroups = TemporalGroups(labels,6)
+        groups = [np.where(labels == idx)[0] for idx in range(6)]
+        funcs = [(library.SampleSize,{}),(library.Mean,{}),(library.Max,{}),
+                 (library.Min,{}),(library.StandardDeviation,{}),
+                 (library.Between,{'lower':0.2,'upper':0.7}),
+                 (library.MaxConsecutive,{'threshold':0.3,'operation':'gt'})]
+        
+        for Func,kwds in funcs:
+            self.assertTrue(Func.mergeable)
+            desired = Func(values=values,groups=groups,kwds=kwds).calculate()
+            for size in [1,7,50]:
+                func = Func(groups=dgroups,kwds=kwds)
+                for start in range(0,50,size):
+                    func.update(values[start:start+size],start)
+                actual = func.finalize()
+                self.assertTrue(np.all(np.ma.getmaskarray(actual) == np.ma.getmaskarray(desired)))
+                self.assertTrue(np.allclose(np.ma.filled(actual,0),np.ma.filled(desired,0)))
+            
+    def test_consecutive(self):
+        
+        def _get_runs_(vec):
+            ## run lengths for a single time series
+            runs = []
+            count = 0
+            for v in vec:
+                if v:
+                    count += 1
+                elif count > 0:
+                    runs.append(count)
+                    count = 0
+            if count > 0:
+                runs.append(count)
+            return(runs)
+        
+        np.random.seed(2)
+        values = np.random.rand(60,2,3,4)
+        mask = np.random.rand(*values.shape) > 0.9
+        values = np.ma.array(values,mask=mask)
+        values[:,0,0,0] = 0.9
+        groups = [np.arange(0,31),np.arange(31,60)]
+        
+        kwds = {'threshold':0.3,'operation':'gte'}
+        max_cons = library.MaxConsecutive(values=values,groups=groups,kwds=kwds).calculate()
+        kwds = {'threshold':0.3,'operation':'gte','length':2}
+        count_cons = library.CountConsecutive(values=values,groups=groups,kwds=kwds).calculate()
+        self.assertEqual(max_cons.shape,(2,2,3,4))
+        self.assertEqual(count_cons.shape,(2,2,3,4))
+        self.assertEqual(max_cons[0,0,0,0],31)
+        
+        for idx,group in enumerate(groups):
+            for lidx,ridx,cidx in itertools.product(range(2),range(3),range(4)):
+                vec = values[group,lidx,ridx,cidx]
+                runs = _get_runs_(np.ma.filled(vec >= 0.3,False))
+                self.assertEqual(max_cons.data[idx,lidx,ridx,cidx],max(runs + [0]))
+                self.assertEqual(count_cons.data[idx,lidx,ridx,cidx],
+                                 len([r for r in runs if r > 2]))
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -190,7 +190,8 @@ class Test(unittest.TestCase):
                         import ipdb;ipdb.set_trace()
                     else:
                         continue
-                self.assertEqual(np.sum([dgrp.sum() for dgrp in tgdim.dgroups]),len(tdim.value))
+                self.assertEqual(np.sum([len(dgrp) for dgrp in tgdim.dgroups]),len(tdim.value))
+                self.assertTrue(np.array_equal(np.sort(np.hstack(tgdim.dgroups)),np.arange(len(tdim.value))))
 
     def get_SpatialDimension(self):
         y = range(40,45)
@@ -213,6 +214,32 @@ class Test(unittest.TestCase):
         for row in sdim:
             pass
 
+    def test_SpatialDimension_bounds(self):
+        min_col,min_row = np.meshgrid(np.arange(-90,-85),np.arange(40,45))
+        bounds = np.empty((5,5,4),dtype=float)
+        bounds[:,:,0] = min_col
+        bounds[:,:,1] = min_row
+        bounds[:,:,2] = min_col + 1
+        bounds[:,:,3] = min_row + 0.5
+        mask = np.zeros((5,5),dtype=bool)
+        mask[0,:] = True
+        gid = np.ma.array(np.arange(1,26).reshape(5,5),mask=mask)
+        sdim = SpatialDimension(gid,None,mask,bounds=bounds,abstraction='polygon')
+        ## no geometries are constructed until requested
+        self.assertEqual(sdim.geomtype,'polygon')
+        self.assertEqual(sdim.shape,(5,5))
+        self.assertEqual(len(sdim),20)
+        self.assertTrue(np.all(sdim.weights == 1.0))
+        self.assertTrue(np.all(sdim._geoms == None))
+        geom = sdim.get_geom((1,2))
+        self.assertEqual(geom.bounds,(-88.0,41.0,-87.0,41.5))
+        self.assertTrue(sdim.get_geom((1,2)) is geom)
+        self.assertEqual(len(list(sdim)),20)
+        self.assertTrue(np.all(sdim._geoms[0,:] == None))
+        ## full materialization
+        self.assertEqual(sdim.value.compressed().shape[0],20)
+        self.assertEqual(sdim._value[0,0].area,0.5)
+
     def get_LevelDimension(self,add_bounds=True):
         values = np.array([50,150])
         if add_bounds:
@@ -1,6 +1,17 @@
 import unittest
+import os
+import shutil
+import tempfile
+import cPickle
+import warnings
+import datetime
 import netCDF4 as nc
-from ocgis.interface.interface import GlobalInterface
+import numpy as np
+from ocgis import env
+from ocgis.interface.interface import GlobalInterface, TemporalInterface
+from ocgis.interface.cache import get_interface, get_cache_path
+from ocgis.interface import cache
+from ocgis.test.make_test_data import make_simple
 
 
 class TestInterface(unittest.TestCase):
@@ -19,6 +30,123 @@ class TestInterface(unittest.TestCase):
             i = GlobalInterface(self.rootgrp,self.dataset['variable'],overload=overload)
 
 
+
+class TestTemporalInterface(unittest.TestCase):
+    
+    def test_decode(self):
+        values = np.arange(-400,800,0.25).reshape(-1,2)
+        for units in ['days since 1950-01-01','hours since 1800-1-1 06:00:00']:
+            for calendar in ['standard','proleptic_gregorian','noleap','julian']:
+                ret = TemporalInterface._decode_(values,units,calendar)
+                self.assertEqual(ret.shape,values.shape)
+                for value,dt in zip(values.flat,ret.flat):
+                    ref = nc.num2date(value,units,calendar)
+                    self.assertEqual(dt,datetime.datetime(ref.year,ref.month,ref.day,
+                                                          ref.hour,ref.minute,ref.second))
+        ## mixed gregorian dates before the calendar reform fall back to netCDF
+        ret = TemporalInterface._decode_(np.array([0,1]),'days since 1500-01-01','standard')
+        self.assertEqual(ret[1],datetime.datetime(1500,1,2))
+        
+    def test_subset_timeidx(self):
+        make_simple()
+        i = get_interface('/tmp/test_simple_spatial_01.nc','foo')
+        time_range = [datetime.datetime(2000,3,15),datetime.datetime(2000,4,1,12)]
+        idx = i.temporal.subset_timeidx(time_range)
+        self.assertTrue(isinstance(idx,slice))
+        value = i.temporal.value[idx]
+        self.assertEqual((value[0],value[-1]),(datetime.datetime(2000,3,15,12),
+                                               datetime.datetime(2000,4,1,12)))
+        ## bounds select the time steps whose intervals overlap the range
+        i.temporal.bounds = np.column_stack((i.temporal.value-datetime.timedelta(hours=12),
+                                             i.temporal.value+datetime.timedelta(hours=12)))
+        i.temporal._bounds64 = i.temporal.bounds.astype('datetime64[s]')
+        time_range = [datetime.datetime(2000,3,15,6),datetime.datetime(2000,4,1,6)]
+        idx = i.temporal.subset_timeidx(time_range)
+        self.assertEqual(i.temporal.value[idx][0],datetime.datetime(2000,3,15,12))
+        self.assertEqual(i.temporal.value[idx][-1],datetime.datetime(2000,4,1,12))
+        ## descending time axes fall back to an index array
+        i.temporal.bounds = None
+        i.temporal._value64 = i.temporal._value64[::-1]
+        idx = i.temporal.subset_timeidx(time_range)
+        self.assertEqual(len(idx),17)
+
+
+class TestInterfaceCache(unittest.TestCase):
+    uri = '/tmp/test_simple_spatial_01.nc'
+    variable = 'foo'
+    
+    def setUp(self):
+        make_simple()
+        self._dir = env.DIR_INTERFACE_CACHE
+        env.DIR_INTERFACE_CACHE = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(env.DIR_INTERFACE_CACHE)
+        env.DIR_INTERFACE_CACHE = self._dir
+        
+    def test_get_interface(self):
+        path = get_cache_path(self.uri,self.variable)
+        self.assertFalse(os.path.exists(path))
+        i = get_interface(self.uri,self.variable)
+        self.assertTrue(os.path.exists(path))
+        ## interfaces are kept in memory
+        self.assertTrue(get_interface(self.uri,self.variable) is i)
+        ## and loaded from disk in a new process
+        cache._loaded.clear()
+        cached = get_interface(self.uri,self.variable)
+        self.assertFalse(cached is i)
+        self.assertTrue(np.all(cached.temporal.value == i.temporal.value))
+        self.assertTrue(np.all(cached.spatial.gid == i.spatial.gid))
+        self.assertTrue(np.all(cached.spatial.get_cell_bounds(i.spatial.real_row[:,0],i.spatial.real_col[0,:]) ==
+                               i.spatial.get_cell_bounds(i.spatial.real_row[:,0],i.spatial.real_col[0,:])))
+        self.assertEqual(cached.spatial.projection.sr.ExportToProj4(),
+                         i.spatial.projection.sr.ExportToProj4())
+        ## overloads and file modifications produce a new entry
+        self.assertNotEqual(get_cache_path(self.uri,self.variable,overload={'s_abstraction':'point'}),path)
+        os.utime(self.uri,(0,0))
+        self.assertNotEqual(get_cache_path(self.uri,self.variable),path)
+        ## remote datasets are not cached
+        self.assertEqual(get_cache_path('http://foo.nc',self.variable),None)
+        ## the cache format version is part of the key
+        version = cache.CACHE_VERSION
+        try:
+            cache.CACHE_VERSION += 1
+            self.assertNotEqual(get_cache_path(self.uri,self.variable),path)
+        finally:
+            cache.CACHE_VERSION = version
+        
+    def test_private_directory(self):
+        path = get_cache_path(self.uri,self.variable)
+        dirname = os.path.dirname(path)
+        get_interface(self.uri,self.variable)
+        self.assertEqual(os.stat(dirname).st_mode & 0777,0700)
+        ## entries in a directory accessible to others are ignored
+        os.chmod(dirname,0755)
+        self.assertFalse(cache._is_private_(dirname))
+        with open(path,'wb') as f:
+            cPickle.dump('planted',f)
+        cache._loaded.clear()
+        with warnings.catch_warnings(record=True):
+            self.assertTrue(isinstance(get_interface(self.uri,self.variable),GlobalInterface))
+        
+    def test_stale_entry(self):
+        path = get_cache_path(self.uri,self.variable)
+        i = get_interface(self.uri,self.variable)
+        ## entries written before attributes were added are rebuilt
+        del i.temporal._value64
+        with open(path,'wb') as f:
+            cPickle.dump(i,f,cPickle.HIGHEST_PROTOCOL)
+        cache._loaded.clear()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            ret = get_interface(self.uri,self.variable)
+        self.assertEqual(len(w),1)
+        self.assertTrue(hasattr(ret.temporal,'_value64'))
+        ## and the rebuilt interface replaces the entry
+        cache._loaded.clear()
+        self.assertTrue(hasattr(get_interface(self.uri,self.variable).temporal,'_value64'))
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
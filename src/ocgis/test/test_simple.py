@@ -6,12 +6,26 @@ from ocgis.api.interpreter import OcgInterpreter
 import itertools
 import numpy as np
 import datetime
+import time
 from ocgis.util.helpers import make_poly
-from ocgis import exc
+from ocgis import exc, env
 import tempfile
 import os.path
 from ocgis.util.inspect import Inspect
 from warnings import warn
+from multiprocessing import Pool
+from ocgis.api.subset import imap_bounded, SubsetOperation
+from ocgis.api import subset
+from ocgis.api.pool import WorkerPool
+from ocgis.calc.base import OcgFunction
+from ocgis.interface import overlay
+import shutil
+import cPickle
+from copy import deepcopy
+
+
+def _square_(value):
+    return(value**2)
 
 
 class TestBase(unittest.TestCase):
@@ -91,7 +105,27 @@ class TestSimple(TestBase):
         ## test geometry reduction
         ref = ret[1].variables[self.var]
         self.assertEqual(ref.spatial.shape,(1,1))
-        
+
+    def test_aggregate_geom(self):
+        uri = os.path.join(self.outdir,self.fn)
+        dataset = [{'uri':uri,'variable':self.var,'alias':alias} for alias in ['foo1','foo2']]
+        geom = [{'ugid':1,'geom':make_poly((37.5,39.5),(-104.5,-102.5))}]
+        for spatial_operation in ['intersects','clip']:
+            kwds = {'dataset':dataset,'geom':geom,'aggregate':True,
+                    'spatial_operation':spatial_operation}
+            coll = list(SubsetOperation(OcgOperations(**kwds)))[0]
+            ## variables on the same grid share the aggregated geometry
+            geoms = [var.spatial._value[0,0] for var in coll.variables.itervalues()]
+            self.assertTrue(geoms[0] is geoms[1])
+            self.assertAlmostEqual(geoms[0].symmetric_difference(geom[0]['geom']).area,0)
+            ## aggregated geometries are not constructed for outputs without
+            ## geometries
+            kwds['output_format'] = 'csv'
+            coll = list(SubsetOperation(OcgOperations(**kwds)))[0]
+            for var in coll.variables.itervalues():
+                self.assertTrue(var.spatial._value[0,0] is None)
+                self.assertTrue(np.all(var.value == np.ma.average(self.base_value)))
+
     def test_time_level_subset(self):
         ret = self.get_ret(time_range=[datetime.datetime(2000,3,1),
                                        datetime.datetime(2000,3,31,23)],
@@ -140,6 +174,12 @@ class TestSimple(TestBase):
         intersection_areas = [g.area for g in ref.spatial._value.flat]
         for ii in intersection_areas:
             self.assertEqual(ii,0.25)
+        ## clipped cells contained by the selection geometry are weighted by
+        ## their full area
+        geom = [{'ugid':1,'geom':make_poly((37.5,39.5),(-104.5,-102.5))}]
+        ret = self.get_ret(kwds={'geom':geom,'spatial_operation':'clip'})
+        weights = ret[1].variables[self.var].spatial.weights
+        self.assertTrue(np.all(weights == 1.0))
             
         ## intersection + aggregation
         geom = make_poly((38,39),(-104,-103))
@@ -185,6 +225,349 @@ class TestSimple(TestBase):
             self.assertEqual(ref['my_mean'].shape,(2,2,1,1))
             self.assertEqual(ref['my_mean'].flatten().mean(),2.5)
             
+    def test_calc_aggregated_values(self):
+        calc = {'func':'mean','name':'my_mean'}
+        shapes = []
+        _aggregate_spatial_ = OcgFunction._aggregate_spatial_
+        def _record_(values,weights):
+            shapes.append(values.shape)
+            return(_aggregate_spatial_(values,weights))
+        OcgFunction._aggregate_spatial_ = staticmethod(_record_)
+        try:
+            for calc_raw,memory_budget in itertools.product([True,False],[None,0.001]):
+                del shapes[:]
+                kwds = {'calc':calc,'calc_grouping':['month'],'aggregate':True,
+                        'calc_raw':calc_raw,'memory_budget':memory_budget}
+                ref = self.get_ret(kwds=kwds)[1].variables[self.var].calc_value
+                self.assertEqual(ref['my_mean'].shape,(2,2,1,1))
+                ## already aggregated values are not averaged again
+                if calc_raw:
+                    self.assertTrue(all([shape[-2:] == (4,4) for shape in shapes]))
+                    self.assertTrue(len(shapes) > 0)
+                else:
+                    self.assertEqual(shapes,[])
+        finally:
+            OcgFunction._aggregate_spatial_ = staticmethod(_aggregate_spatial_)
+            
+    def test_calc_memory_budget(self):
+        calc = [{'func':'mean','name':'my_mean'},{'func':'std','name':'my_std'},
+                {'func':'between','name':'btw','kwds':{'lower':1,'upper':2}}]
+        for group,aggregate in itertools.product([['month'],['month','year']],[True,False]):
+            kwds = {'calc':calc,'calc_grouping':group,'aggregate':aggregate}
+            desired = self.get_ret(kwds=kwds.copy())[1].variables[self.var]
+            kwds.update({'memory_budget':0.001})
+            actual = self.get_ret(kwds=kwds)[1].variables[self.var]
+            ## the values were streamed in time chunks
+            self.assertEqual(actual.value,None)
+            self.assertTrue(len(actual.chunks) > 1)
+            for key,value in desired.calc_value.iteritems():
+                self.assertTrue(np.all(value.mask == actual.calc_value[key].mask))
+                self.assertTrue(np.allclose(value,actual.calc_value[key]))
+            
+    def test_parallel(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(4)]
+        kwds = {'geom':geom,'calc':[{'func':'mean','name':'my_mean'}],
+                'calc_grouping':['month'],'aggregate':True}
+        desired = self.get_ret(kwds=kwds.copy())
+        cores = env.CORES
+        try:
+            env.SERIAL = False
+            env.CORES = 2
+            actual = self.get_ret(kwds=kwds.copy())
+            ## ordered delivery returns the selection geometries in order
+            so = SubsetOperation(self.get_ops(kwds=kwds),serial=False,ordered=True)
+            self.assertEqual([coll.ugeom['ugid'] for coll in so],[1,2,3,4])
+        finally:
+            env.SERIAL = True
+            env.CORES = cores
+        self.assertEqual(set(desired.keys()),set(actual.keys()))
+        for ugid,coll in desired.iteritems():
+            value = coll.variables[self.var].calc_value['my_mean']
+            self.assertTrue(np.all(value == actual[ugid].variables[self.var].calc_value['my_mean']))
+            
+    def test_time_partitions(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(2)]
+        kwds = {'geom':geom,'calc':[{'func':'mean','name':'my_mean'}],
+                'calc_grouping':['day','month','year'],'aggregate':True}
+        desired = self.get_ret(kwds=kwds.copy())
+        ## partitions follow the calculation groups
+        so = SubsetOperation(self.get_ops(kwds=kwds),serial=False,time_partitions=3)
+        parts = so.get_time_partitions()
+        self.assertEqual(len(parts),3)
+        self.assertEqual(parts[0].start,0)
+        for left,right in zip(parts[:-1],parts[1:]):
+            self.assertEqual(left.stop,right.start)
+        ## groups are not split between partitions
+        kwds_month = kwds.copy()
+        kwds_month['calc_grouping'] = ['month']
+        so = SubsetOperation(self.get_ops(kwds=kwds_month),serial=False,time_partitions=3)
+        self.assertEqual(so.get_time_partitions(),[slice(0,31),slice(31,61)])
+        ## partitioned collections match the serial operation
+        cores = env.CORES
+        try:
+            env.SERIAL = False
+            env.CORES = 2
+            env.TIME_PARTITIONS = 3
+            actual = self.get_ret(kwds=kwds.copy())
+        finally:
+            env.SERIAL = True
+            env.CORES = cores
+            env.TIME_PARTITIONS = None
+        self.assertEqual(set(desired.keys()),set(actual.keys()))
+        for ugid,coll in desired.iteritems():
+            ref = coll.variables[self.var]
+            var = actual[ugid].variables[self.var]
+            self.assertTrue(np.all(ref.calc_value['my_mean'] == var.calc_value['my_mean']))
+            self.assertTrue(np.all(ref.temporal_group.value == var.temporal_group.value))
+            self.assertTrue(np.all(ref.temporal.value == var.temporal.value))
+            for idx in range(len(ref.temporal_group)):
+                self.assertTrue(np.all(ref.temporal_group.dgroups[idx] == var.temporal_group.dgroups[idx]))
+            
+    def test_overlay_cache(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(2)]
+        kwds = {'geom':geom,'spatial_operation':'clip'}
+        desired = self.get_ret(kwds=kwds.copy())
+        ## a shapefile cabinet with a stand-in shapefile for the geometries
+        tdir = tempfile.mkdtemp()
+        shp_path = os.path.join(tdir,'shp','overlay_test','overlay_test.shp')
+        os.makedirs(os.path.dirname(shp_path))
+        open(shp_path,'w').close()
+        os.utime(shp_path,(1000,1000))
+        dir_shpcabinet = env.DIR_SHPCABINET
+        try:
+            env.DIR_SHPCABINET = os.path.join(tdir,'shp')
+            env.DIR_OVERLAY_CACHE = os.path.join(tdir,'overlay')
+            for ii in range(2):
+                so = SubsetOperation(self.get_ops(kwds=kwds.copy()))
+                so.shp_key = 'overlay_test'
+                actual = dict([(coll.ugeom['ugid'],coll) for coll in so])
+                for ugid,coll in desired.iteritems():
+                    ref = coll.variables[self.var].spatial
+                    var = actual[ugid].variables[self.var].spatial
+                    self.assertTrue(np.all(ref.weights == var.weights))
+                    for geom,cached in itertools.izip(ref.value.compressed(),
+                                                      var.value.compressed()):
+                        self.assertAlmostEqual(geom.symmetric_difference(cached).area,0)
+                ## overlays are cached after the first operation
+                spatial = so.ops.dataset[0].ocg_dataset.i.spatial
+                cached = overlay.get_overlay(spatial,'overlay_test',1,'clip')
+                self.assertTrue(cached.area is not None)
+            ## a modified shapefile invalidates its overlays
+            os.utime(shp_path,(0,0))
+            self.assertTrue(overlay.get_overlay(spatial,'overlay_test',1,'clip') is None)
+            os.utime(shp_path,(1000,1000))
+            self.assertTrue(overlay.get_overlay(spatial,'overlay_test',1,'clip') is not None)
+            overlay.invalidate('overlay_test')
+            self.assertTrue(overlay.get_overlay(spatial,'overlay_test',1,'clip') is None)
+            ## eviction removes entries beyond the cache size
+            list(so)
+            overlay.evict(size=0)
+            self.assertTrue(overlay.get_overlay(spatial,'overlay_test',1,'clip') is None)
+        finally:
+            env.DIR_SHPCABINET = dir_shpcabinet
+            env.DIR_OVERLAY_CACHE = None
+            shutil.rmtree(tdir)
+
+    def test_overlay_cache_agg_selection(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(2)]
+        tdir = tempfile.mkdtemp()
+        shp_path = os.path.join(tdir,'shp','overlay_test','overlay_test.shp')
+        os.makedirs(os.path.dirname(shp_path))
+        open(shp_path,'w').close()
+
+        def _get_ops_(**kwds):
+            kwds.update({'geom':geom,'spatial_operation':'clip'})
+            ops = self.get_ops(kwds=kwds)
+            ops._get_object_('geom')._shp_key = 'overlay_test'
+            return(ops)
+
+        desired = {}
+        for agg_selection in [False,True]:
+            desired[agg_selection] = self.get_ret(kwds={'geom':geom,'spatial_operation':'clip',
+                                                        'agg_selection':agg_selection})
+        dir_shpcabinet = env.DIR_SHPCABINET
+        try:
+            env.DIR_SHPCABINET = os.path.join(tdir,'shp')
+            env.DIR_OVERLAY_CACHE = os.path.join(tdir,'overlay')
+            ## the unioned geometry shares the first geometry's identifier but
+            ## may not use its cached overlay
+            for agg_selection in [False,True,False]:
+                actual = OcgInterpreter(_get_ops_(agg_selection=agg_selection)).execute()
+                self.assertEqual(set(actual.keys()),set(desired[agg_selection].keys()))
+                for ugid,coll in desired[agg_selection].iteritems():
+                    ref = coll.variables[self.var].spatial
+                    var = actual[ugid].variables[self.var].spatial
+                    self.assertEqual(ref.uid.tolist(),var.uid.tolist())
+                    self.assertTrue(np.all(ref.weights == var.weights))
+            ## geometries outside the grid fail with cached overlays
+            geom = [{'ugid':1,'geom':make_poly((50,51),(-104.5,-102.5))}]
+            for ii in range(2):
+                with self.assertRaises(exc.ExtentError):
+                    list(SubsetOperation(_get_ops_()))
+        finally:
+            env.DIR_SHPCABINET = dir_shpcabinet
+            env.DIR_OVERLAY_CACHE = None
+            shutil.rmtree(tdir)
+
+    def test_aggregate_batch(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(3)]
+        geom.append({'ugid':4,'geom':make_poly((50,51),(-104.5,-102.5))})
+        for spatial_operation in ['intersects','clip']:
+            for calc in [None,[{'func':'mean','name':'my_mean'}]]:
+                kwds = {'geom':geom,'aggregate':True,'allow_empty':True,
+                        'spatial_operation':spatial_operation,'calc':calc,
+                        'calc_grouping':None if calc is None else ['month']}
+                desired = self.get_ret(kwds=kwds.copy())
+                for memory_budget in [None,0.0001]:
+                    kwds['memory_budget'] = memory_budget
+                    so = SubsetOperation(self.get_ops(kwds=kwds.copy()),batch=True)
+                    self.assertTrue(so.batch)
+                    actual = dict([(coll.ugeom['ugid'],coll) for coll in so])
+                    self.assertEqual(set(desired.keys()),set(actual.keys()))
+                    self.assertTrue(actual[4].is_empty)
+                    for ugid in [1,2,3]:
+                        ref = desired[ugid].variables[self.var]
+                        var = actual[ugid].variables[self.var]
+                        self.assertTrue(np.allclose(ref.value,var.value))
+                        self.assertEqual(ref.spatial.uid.tolist(),var.spatial.uid.tolist())
+                        self.assertTrue(ref.spatial.value[0,0].equals(var.spatial.value[0,0]))
+                        if calc is not None:
+                            self.assertTrue(np.allclose(ref.calc_value['my_mean'],
+                                                        var.calc_value['my_mean']))
+        ## raw calculations require the values of each geometry
+        kwds.update({'calc_raw':True})
+        self.assertFalse(SubsetOperation(self.get_ops(kwds=kwds),batch=True).batch)
+
+    def test_shared_window(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(3)]
+        geom.append({'ugid':4,'geom':make_poly((50,51),(-104.5,-102.5))})
+        for spatial_operation in ['intersects','clip']:
+            kwds = {'geom':geom,'allow_empty':True,
+                    'spatial_operation':spatial_operation}
+            desired = self.get_ret(kwds=kwds.copy())
+            so = SubsetOperation(self.get_ops(kwds=kwds.copy()),shared_window=True)
+            self.assertTrue(so.shared_window)
+            ## the overlapping geometries share a window. the geometry outside
+            ## the grid is read on its own.
+            clusters = so.get_window_clusters()
+            self.assertEqual(sorted([sorted(members) for members,windows in clusters
+                                     if windows is not None]),[[0,1,2]])
+            self.assertEqual(sorted(sum([members for members,windows in clusters],[])),
+                             [0,1,2,3])
+            ## nothing is shared if a window does not fit in the budget
+            self.assertTrue(all([windows is None for members,windows in
+                                 so.get_window_clusters(budget=1e-6)]))
+            actual = dict([(coll.ugeom['ugid'],coll) for coll in so])
+            self.assertEqual(set(desired.keys()),set(actual.keys()))
+            self.assertTrue(actual[4].is_empty)
+            for ugid in [1,2,3]:
+                ref = desired[ugid].variables[self.var]
+                var = actual[ugid].variables[self.var]
+                self.assertEqual(ref.value.shape,var.value.shape)
+                self.assertTrue(np.all(ref.value.mask == var.value.mask))
+                self.assertTrue(np.allclose(ref.value,var.value))
+                self.assertEqual(ref.spatial.uid.tolist(),var.spatial.uid.tolist())
+            ## geometries in the same window do not share data
+            actual[1].variables[self.var].value[:] = 100
+            actual[1].variables[self.var].value.mask[:] = True
+            for ugid in [2,3]:
+                ref = desired[ugid].variables[self.var].value
+                var = actual[ugid].variables[self.var].value
+                self.assertTrue(np.all(ref.mask == var.mask))
+                self.assertTrue(np.allclose(ref,var))
+
+    def test_worker_pool(self):
+        geom = [{'ugid':ii+1,'geom':make_poly((37.5+ii*0.5,39.5),(-104.5,-102.5+ii*0.5))}
+                for ii in range(4)]
+        pool = WorkerPool(processes=2,maxtasks=3)
+        try:
+            ## the pool is reused across requests
+            for calc in [{'func':'mean','name':'my_calc'},{'func':'std','name':'my_calc'}]:
+                kwds = {'geom':geom,'calc':[calc],'calc_grouping':['month'],
+                        'aggregate':True}
+                desired = self.get_ret(kwds=kwds.copy())
+                actual = OcgInterpreter(self.get_ops(kwds=kwds),pool=pool).execute()
+                self.assertEqual(set(desired.keys()),set(actual.keys()))
+                for ugid,coll in desired.iteritems():
+                    value = coll.variables[self.var].calc_value['my_calc']
+                    self.assertTrue(np.allclose(value,actual[ugid].variables[self.var].calc_value['my_calc']))
+                self.assertTrue(pool.check())
+            self.assertEqual(pool.restarts,0)
+        finally:
+            pool.close()
+            
+    def test_worker_plan(self):
+        geom = {'ugid':1,'geom':make_poly((37.5,39.5),(-104.5,-102.5))}
+        so = SubsetOperation(self.get_ops(kwds={'geom':[geom]}))
+        ## loaded datasets survive copies and are only removed from plans
+        rd = so.ops.dataset[0]
+        rd.ocg_dataset = 'loaded'
+        self.assertEqual(deepcopy(rd).ocg_dataset,'loaded')
+        self.assertEqual(rd.to_plan().ocg_dataset,None)
+        plan = so.get_plan()
+        self.assertEqual(rd.ocg_dataset,'loaded')
+        self.assertEqual(cPickle.loads(plan).dataset[0].ocg_dataset,None)
+        
+        subset._worker_plans.clear()
+        try:
+            args = (plan,1,None,None)
+            desired = subset._get_planned_collection_(args)[1]
+            cached = subset._worker_plans[plan][0]
+            subset._get_planned_collection_(args)
+            self.assertTrue(subset._worker_plans[plan][0] is cached)
+            ## a modified dataset file rebuilds the operation
+            subset._worker_plans[plan] = (cached,[None])
+            actual = subset._get_planned_collection_(args)[1]
+            self.assertFalse(subset._worker_plans[plan][0] is cached)
+            self.assertTrue(np.all(desired.variables[self.var].raw_value ==
+                                   actual.variables[self.var].raw_value))
+        finally:
+            subset._worker_plans.clear()
+            
+    def test_worker_pool_check(self):
+        pool = WorkerPool(processes=2)
+        try:
+            self.assertTrue(pool.check())
+            ## busy workers are not checked or restarted
+            result = pool.apply_async(time.sleep,(1,))
+            self.assertTrue(pool.busy)
+            self.assertEqual(pool.check(timeout=0.1),None)
+            result.get()
+            self.assertFalse(pool.busy)
+            self.assertTrue(pool.check())
+            self.assertEqual(pool.restarts,0)
+        finally:
+            pool.close()
+            
+    def test_imap_bounded(self):
+        submitted = []
+        def _tasks_():
+            for ii in range(20):
+                submitted.append(ii)
+                yield(ii)
+        pool = Pool(processes=2)
+        try:
+            for ordered in [True,False]:
+                del submitted[:]
+                ret = []
+                for value in imap_bounded(pool,_square_,_tasks_(),3,ordered=ordered):
+                    ## no more than the window is submitted ahead of the consumer
+                    self.assertTrue(len(submitted) <= len(ret)+1+3)
+                    ret.append(value)
+                desired = [ii**2 for ii in range(20)]
+                if ordered:
+                    self.assertEqual(ret,desired)
+                else:
+                    self.assertEqual(sorted(ret),desired)
+        finally:
+            pool.terminate()
+            
     def test_inspect(self):
         uri = self.get_dataset()['uri']
         for variable in [self.get_dataset()['variable'],None]:
@@ -1,6 +1,18 @@
 import unittest
+import os
 import numpy as np
-from ocgis.util.helpers import iter_array
+from ocgis.util.helpers import iter_array, make_poly, keep, spatial_average
+from ocgis.util.spatial.select import select_cells, GridIndex, PointIndex,\
+    clip_cells, union_cells
+from ocgis.util.spatial.index import QuadTree
+from shapely.geometry.point import Point
+from shapely import prepared
+from shapely.ops import cascaded_union
+from ocgis.util.spatial.wrap import wrap_bounds, _wrap_geom_
+from ocgis.api.dataset.collection.dimension import SpatialDimension
+from ocgis.util.ncpool import NcHandlePool
+from ocgis.util.readplan import ReadPlan
+from ocgis.test.make_test_data import make_simple
 
 
 class Test(unittest.TestCase):
@@ -13,6 +25,191 @@ class Test(unittest.TestCase):
             self.assertFalse(values.mask[idx])
         self.assertEqual(len(list(iter_array(values,use_mask=True))),len(values.compressed()))
         self.assertEqual(len(list(iter_array(values,use_mask=False))),len(values.data.flatten()))
+        
+    def test_spatial_average(self):
+        values = np.random.rand(3,2,4,5)
+        values = np.ma.array(values,mask=np.random.rand(*values.shape) > 0.7)
+        values[1,1] = np.ma.masked
+        weights = np.random.rand(4,5)
+        weights = np.ma.array(weights,mask=np.random.rand(4,5) > 0.8)
+        avg = spatial_average(values,weights)
+        self.assertEqual(avg.shape,(3,2,1,1))
+        for tidx,lidx in iter_array(values[:,:,0,0],use_mask=False):
+            desired = np.ma.average(values[tidx,lidx],weights=weights)
+            if desired is np.ma.masked:
+                self.assertTrue(avg.mask[tidx,lidx,0,0])
+            else:
+                self.assertAlmostEqual(avg[tidx,lidx,0,0],desired)
+        
+    def test_read_plan(self):
+        ## a selection crossing the 0/360 seam plus a small separate region
+        select = np.zeros((90,360),dtype=bool)
+        select[10:30,0:6] = True
+        select[12:28,350:360] = True
+        select[70:75,100:110] = True
+        data = np.ma.array(np.random.rand(3,90,360),mask=False)
+        plan = ReadPlan(select,cell_bytes=3*8,read_cost=1024)
+        self.assertEqual(len(plan),3)
+        ## every selected cell is read
+        covered = np.zeros(select.shape,dtype=bool)
+        for r0,r1,c0,c1 in plan.blocks:
+            covered[r0:r1,c0:c1] = True
+        self.assertTrue(covered[select].all())
+        self.assertEqual(plan.nbytes_saved,plan.nbytes_window-covered.sum()*3*8)
+        ret = plan.read(lambda rslice,cslice: data[:,rslice,cslice])
+        self.assertEqual(ret.shape,data.shape)
+        self.assertTrue(np.all(ret.mask[0] == np.invert(covered)))
+        self.assertTrue(np.all(ret[:,covered] == data[:,covered]))
+        ## a high cost per read keeps a single block
+        plan = ReadPlan(select,cell_bytes=3*8,read_cost=1024**3)
+        self.assertEqual(plan.blocks,[(10,75,0,360)])
+        
+    def test_select_cells(self):
+        def _bounds_(lower,upper,res):
+            edges = np.arange(lower,upper+res*0.5,res)
+            return(np.hstack((edges[:-1].reshape(-1,1),edges[1:].reshape(-1,1))))
+        
+        polygons = [Point(0.3,0.2).buffer(7.3),
+                    Point(0,0).buffer(9).difference(Point(1,1).buffer(3)),
+                    make_poly((-3,4),(-2,5))]
+        col_bounds = _bounds_(-12,12,0.5)
+        for row_bounds in [_bounds_(-12,12,1.0),_bounds_(-12,12,1.0)[::-1]]:
+            for polygon in polygons:
+                select = select_cells(polygon,row_bounds,col_bounds)
+                prep_polygon = prepared.prep(polygon)
+                for ii,jj in iter_array(select):
+                    test_geom = make_poly(row_bounds[ii],col_bounds[jj])
+                    self.assertEqual(select[ii,jj],keep(prep_polygon,polygon,test_geom))
+
+    def test_spatial_index(self):
+        col_bounds = np.hstack((np.arange(-12,12,0.5).reshape(-1,1),
+                                np.arange(-11.5,12.5,0.5).reshape(-1,1)))
+        row_bounds = np.hstack((np.arange(-12,12,1.0).reshape(-1,1),
+                                np.arange(-11,13,1.0).reshape(-1,1)))[::-1]
+        grid_index = GridIndex(row_bounds,col_bounds)
+        x,y = np.meshgrid(col_bounds.mean(axis=1),row_bounds.mean(axis=1))
+        point_index = PointIndex(x,y)
+        polygons = [Point(0.3,0.2).buffer(7.3),make_poly((-3,4),(-2,5)),
+                    make_poly((20,30),(20,30))]
+        ## the same index answers repeated selections
+        for polygon in polygons:
+            row,col = grid_index.select(polygon)
+            select = select_cells(polygon,row_bounds,col_bounds)
+            self.assertTrue(np.all(np.argwhere(select) == np.column_stack((row,col))))
+            row,col = point_index.select(polygon)
+            prep_polygon = prepared.prep(polygon)
+            select = np.zeros(x.shape,dtype=bool)
+            for ii,jj in iter_array(x):
+                select[ii,jj] = prep_polygon.intersects(Point(x[ii,jj],y[ii,jj]))
+            self.assertTrue(np.all(np.argwhere(select) == np.column_stack((row,col))))
+
+    def test_quadtree(self):
+        polygon = Point(0.3,0.2).buffer(7.3).difference(Point(1,1).buffer(3))
+        tree = QuadTree(polygon,min_size=2.0)
+        states = set([node.state for node in tree.iter_leaves()])
+        self.assertEqual(states,set([0,1,2]))
+        prep_polygon = prepared.prep(polygon)
+        for y in np.arange(-9,9,0.7):
+            for x in np.arange(-9,9,0.7):
+                cell = make_poly((y,y+0.7),(x,x+0.7))
+                self.assertEqual(tree.keep(cell),keep(prep_polygon,polygon,cell))
+                self.assertEqual(tree.contains(cell),prep_polygon.contains(cell))
+                self.assertAlmostEqual(tree.intersection(cell).area,
+                                       polygon.intersection(cell).area)
+
+    def test_clip_cells(self):
+        polygon = Point(0.3,0.2).buffer(7.3).difference(Point(1,1).buffer(3))
+        y = np.arange(9,-9,-0.7).reshape(-1,1)
+        x = np.arange(-9,9,0.7).reshape(1,-1)
+        bounds = np.empty((y.shape[0],x.shape[1],4))
+        bounds[:,:,0],bounds[:,:,1] = x,y-0.7
+        bounds[:,:,2],bounds[:,:,3] = x+0.7,y
+        select = np.ones(bounds.shape[0:2],dtype=bool)
+        select[0:3,:] = False
+        area,geoms = clip_cells(polygon,bounds,select=select,leaf_size=4)
+        for idx in np.ndindex(*area.shape):
+            min_col,min_row,max_col,max_row = bounds[idx]
+            cell = make_poly((min_row,max_row),(min_col,max_col))
+            if not select[idx]:
+                self.assertEqual(area[idx],0)
+                self.assertTrue(idx not in geoms)
+            else:
+                self.assertAlmostEqual(area[idx],polygon.intersection(cell).area)
+                ## only cells inside the polygon keep their geometry
+                if idx in geoms:
+                    diff = geoms[idx].symmetric_difference(polygon.intersection(cell))
+                    self.assertAlmostEqual(diff.area,0)
+                else:
+                    self.assertTrue(polygon.contains(cell))
+
+    def test_union_cells(self):
+        polygon = Point(0.3,0.2).buffer(7.3).difference(Point(1,1).buffer(3))
+        y = np.arange(9,-9,-0.7).reshape(-1,1)
+        x = np.arange(-9,9,0.7).reshape(1,-1)
+        bounds = np.empty((y.shape[0],x.shape[1],4))
+        bounds[:,:,0],bounds[:,:,1] = x,y-0.7
+        bounds[:,:,2],bounds[:,:,3] = x+0.7,y
+        ## a gap between columns is not merged
+        bounds[:,10:,0] += 0.1
+        bounds[:,10:,2] += 0.1
+        select = select_cells(polygon,bounds[:,0][:,[1,3]],bounds[0][:,[0,2]])
+        select[5,:] = False
+        cells = [make_poly((bounds[idx][1],bounds[idx][3]),(bounds[idx][0],bounds[idx][2]))
+                 for idx in zip(*np.nonzero(select))]
+        for clip in [None,polygon]:
+            actual = union_cells(bounds,select,polygon=clip)
+            if clip is None:
+                desired = cascaded_union(cells)
+            else:
+                desired = cascaded_union([clip.intersection(cell) for cell in cells])
+            self.assertAlmostEqual(actual.symmetric_difference(desired).area,0)
+            self.assertAlmostEqual(actual.area,desired.area)
+        self.assertTrue(union_cells(bounds,np.zeros(select.shape,dtype=bool)).is_empty)
+
+    def test_wrap_bounds(self):
+        y = np.arange(40,30,-2.0).reshape(-1,1)
+        x = np.arange(170,200,3.0).reshape(1,-1)
+        bounds = np.empty((y.shape[0],x.shape[1],4))
+        bounds[:,:,0],bounds[:,:,1] = x,y-2
+        bounds[:,:,2],bounds[:,:,3] = x+3,y
+        uid = np.ma.array(np.arange(1,bounds[:,:,0].size+1).reshape(bounds.shape[0:2]),mask=False)
+        mask = np.zeros(uid.shape,dtype=bool)
+        cache = {}
+        for ii in range(2):
+            spatial = SpatialDimension(uid,None,mask,bounds=bounds.copy(),abstraction='polygon')
+            ## a clipped geometry is wrapped individually
+            clipped = Point(185,35).buffer(1)
+            spatial.set_geom((2,5),clipped)
+            wrap_bounds(spatial,cache=cache)
+            for idx in np.ndindex(*uid.shape):
+                if idx == (2,5):
+                    desired = _wrap_geom_(clipped)
+                else:
+                    min_col,min_row,max_col,max_row = bounds[idx]
+                    desired = _wrap_geom_(make_poly((min_row,max_row),(min_col,max_col)))
+                actual = spatial.get_geom(idx)
+                self.assertAlmostEqual(actual.symmetric_difference(desired).area,0)
+                self.assertTrue(actual.bounds[0] >= -180 and actual.bounds[2] <= 180)
+            ## split cells are reused for the same grid
+            self.assertEqual(len(cache),y.shape[0])
+            if ii == 0:
+                split = spatial.get_geom((0,3))
+            else:
+                self.assertTrue(spatial.get_geom((0,3)) is split)
+
+    def test_nc_handle_pool(self):
+        make_simple()
+        uri = '/tmp/test_simple_spatial_01.nc'
+        pool = NcHandlePool(maxsize=1)
+        rootgrp = pool.get(uri)
+        self.assertTrue(pool.get(uri) is rootgrp)
+        self.assertEqual(pool.counters,{'hits':1,'opens':1,'closes':0,'size':1})
+        ## a modified file is reopened
+        os.utime(uri,(0,0))
+        self.assertFalse(pool.get(uri) is rootgrp)
+        self.assertEqual(pool.opens,2)
+        pool.close()
+        self.assertEqual(len(pool),0)
 
 
 if __name__ == "__main__":
@@ -185,16 +185,34 @@ def approx_resolution(vec):
     >>> approx_resolution(vec)
     1.0
     """
-    diff = []
-    for i in range(len(vec)):
-        curr = vec[i]
-        try:
-            nxt = vec[i+1]
-            diff.append(abs(curr-nxt))
-        except IndexError:
-            break
+    diff = np.abs(np.diff(np.asarray(vec,dtype=float)))
     return(np.mean(diff))
 
+def spatial_average(values,weights=None):
+    """
+    Weighted average over the last two (row, column) dimensions of `values`
+    computed for all leading dimensions at once. Masked values and masked
+    weights are excluded from the average. The spatial dimensions are kept
+    with length one.
+    
+    values :: masked ndarray
+    weights=None :: ndarray or masked ndarray :: broadcastable to the spatial
+        dimensions of `values`. `None` weights all values equally.
+    """
+    values = np.ma.asarray(values)
+    if weights is None:
+        weights = np.ones(values.shape[-2:])
+    ## zero weights wherever either the value or the weight is masked
+    mask = np.logical_or(np.ma.getmaskarray(values),np.ma.getmaskarray(weights))
+    w = np.where(mask,0.0,np.ma.filled(weights,0.0))
+    ## flatten the spatial dimensions and reduce them in one pass
+    flat = w.shape[:-2] + (-1,)
+    total = (np.ma.filled(values,0)*w).reshape(flat).sum(axis=-1)
+    wsum = w.reshape(flat).sum(axis=-1)
+    empty = wsum == 0
+    ret = np.ma.array(total/np.where(empty,1.0,wsum),mask=empty)
+    return(ret.reshape(w.shape[:-2] + (1,1)))
+
 def keep(prep_igeom=None,igeom=None,target=None):
     test_geom = prep_igeom or igeom
     if test_geom.intersects(target) and not target.touches(igeom):
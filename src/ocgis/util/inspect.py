@@ -1,4 +1,4 @@
-import netCDF4 as nc
+from ocgis.util.ncpool import get_handle
 from ocgis.api.dataset.dataset import OcgDataset
 from ocgis.interface.ncmeta import NcMetadata
 
@@ -31,12 +31,8 @@ class Inspect(object):
         self.uri = uri
         self.variable = variable
         if self.variable is None:
-            try:
-                self.ds = None
-                rootgrp = nc.Dataset(uri)
-                self.meta = NcMetadata(rootgrp)
-            finally:
-                rootgrp.close()
+            self.ds = None
+            self.meta = NcMetadata(get_handle(uri))
         else:
             self.ds = OcgDataset({'uri':uri,'variable':variable},
                                  interface_overload=interface_overload)
@@ -0,0 +1,150 @@
+import os
+import atexit
+import threading
+from collections import OrderedDict
+import netCDF4 as nc
+from ocgis import env
+
+
+class NcHandlePool(object):
+    """
+    Process-local, bounded pool of open netCDF4 `Dataset`/`MFDataset` handles
+    keyed by URI. The least recently used handle is closed when the pool is
+    full. Local files are reopened if they change on disk, and the pool is
+    emptied without closing handles when used from a forked process.
+
+    >>> pool = NcHandlePool(maxsize=4)
+    >>> rootgrp = pool.get('/path/to/dataset.nc')
+    >>> pool.close('/path/to/dataset.nc')
+
+    maxsize=None -- maximum number of open handles. Defaults to
+        `env.NC_POOL_SIZE`. At least one handle is always kept open.
+    """
+
+    def __init__(self,maxsize=None):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self.hits = 0
+        self.opens = 0
+        self.closes = 0
+
+    def __len__(self):
+        return(len(self._handles))
+
+    def __contains__(self,uri):
+        return(self._get_key_(uri) in self._handles)
+
+    @property
+    def counters(self):
+        return({'hits':self.hits,'opens':self.opens,'closes':self.closes,
+                'size':len(self)})
+
+    def get(self,uri):
+        '''Return an open handle for `uri` opening it if necessary.'''
+
+        key = self._get_key_(uri)
+        with self._lock:
+            self._check_pid_()
+            stamp = self._get_stamp_(uri)
+            try:
+                rootgrp,handle_stamp = self._handles.pop(key)
+                if handle_stamp != stamp:
+                    self._close_handle_(rootgrp)
+                    raise(KeyError(key))
+                self.hits += 1
+            except KeyError:
+                rootgrp = self._open_(uri)
+                self.opens += 1
+            self._handles[key] = (rootgrp,stamp)
+            self._evict_()
+        return(rootgrp)
+
+    def close(self,uri=None):
+        '''Close the handle for `uri` or all handles if `uri` is `None`.'''
+
+        with self._lock:
+            self._check_pid_()
+            if uri is None:
+                keys = self._handles.keys()
+            else:
+                keys = [self._get_key_(uri)]
+            for key in keys:
+                try:
+                    rootgrp,_ = self._handles.pop(key)
+                except KeyError:
+                    continue
+                self._close_handle_(rootgrp)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.opens = 0
+        self.closes = 0
+
+    def _check_pid_(self):
+        ## handles inherited across a fork must not be shared with the parent.
+        ## drop the references without closing the underlying files.
+        pid = os.getpid()
+        if pid != self._pid:
+            self._handles = OrderedDict()
+            self._pid = pid
+            self.reset_counters()
+
+    def _close_handle_(self,rootgrp):
+        try:
+            rootgrp.close()
+        except RuntimeError:
+            pass
+        self.closes += 1
+
+    def _evict_(self):
+        maxsize = self.maxsize
+        if maxsize is None:
+            maxsize = env.NC_POOL_SIZE
+        maxsize = max(maxsize,1)
+        while len(self._handles) > maxsize:
+            _,(rootgrp,_) = self._handles.popitem(last=False)
+            self._close_handle_(rootgrp)
+
+    @staticmethod
+    def _get_key_(uri):
+        if isinstance(uri,basestring):
+            ret = uri
+        else:
+            ret = tuple(uri)
+        return(ret)
+
+    @staticmethod
+    def _get_stamp_(uri):
+        ## remote and multi-file datasets are not checked for modification
+        try:
+            st = os.stat(uri)
+            ret = (st.st_ino,st.st_size,st.st_mtime)
+        except (OSError,TypeError):
+            ret = None
+        return(ret)
+
+    @staticmethod
+    def _open_(uri):
+        try:
+            ret = nc.Dataset(uri,'r')
+        except TypeError:
+            ret = nc.MFDataset(uri)
+        return(ret)
+
+
+_pool = NcHandlePool()
+atexit.register(_pool.close)
+
+def get_pool():
+    '''Return the process-local :class:`NcHandlePool`.'''
+    return(_pool)
+
+def get_handle(uri):
+    '''Return an open handle for `uri` from the process-local pool.'''
+    return(_pool.get(uri))
+
+def close_handles(uri=None):
+    '''Close pooled handles for `uri` or all handles if `uri` is `None`.'''
+    _pool.close(uri=uri)
@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class ReadPlan(object):
+    """
+    Plan for reading the selected cells of a grid window as a set of
+    rectangular blocks. Blocks are found by cutting the window along empty
+    bands of rows or columns (e.g. the ocean between the parts of a
+    MultiPolygon or the unselected longitudes of a selection crossing the
+    0/360 seam). A cut is kept if the cost of reading the trimmed parts is
+    lower than reading the window at once. The cost of a block is the bytes it
+    reads plus a fixed cost per read.
+
+    >>> select = np.zeros((4,10),dtype=bool)
+    >>> select[:,[0,1,9]] = True
+    >>> plan = ReadPlan(select,cell_bytes=1024**2)
+    >>> plan.blocks
+    [(0, 4, 0, 2), (0, 4, 9, 10)]
+
+    select -- boolean array (row,col) that is `True` for cells to read
+    cell_bytes -- bytes read for a single cell (all time steps and levels)
+    read_cost=None -- cost of a read in bytes. Defaults to `ReadPlan.read_cost`.
+    """
+    #: Fixed cost of a single read expressed in bytes.
+    read_cost = 1024**2
+
+    def __init__(self,select,cell_bytes,read_cost=None):
+        self.shape = select.shape
+        self.cell_bytes = cell_bytes
+        if read_cost is not None:
+            self.read_cost = read_cost
+        self.blocks = self._plan_(select,0,select.shape[0],0,select.shape[1])
+
+    def __len__(self):
+        return(len(self.blocks))
+
+    @property
+    def nbytes(self):
+        '''Bytes read by the plan.'''
+        return(sum([(r1-r0)*(c1-c0) for r0,r1,c0,c1 in self.blocks])*self.cell_bytes)
+
+    @property
+    def nbytes_window(self):
+        '''Bytes read by a single read of the whole window.'''
+        return(self.shape[0]*self.shape[1]*self.cell_bytes)
+
+    @property
+    def nbytes_saved(self):
+        return(self.nbytes_window - self.nbytes)
+
+    def read(self,get_block):
+        '''Read and assemble the blocks. Cells outside the blocks are masked.
+
+        get_block -- function taking row and column slices and returning a
+            masked array with the spatial dimensions last
+        '''
+        ret = None
+        for r0,r1,c0,c1 in self.blocks:
+            block = get_block(slice(r0,r1),slice(c0,c1))
+            if ret is None:
+                ret = np.ma.masked_all(block.shape[:-2]+self.shape,dtype=block.dtype)
+                ret.set_fill_value(np.ma.array(block).fill_value)
+            ret[...,r0:r1,c0:c1] = block
+        return(ret)
+
+    def _get_cost_(self,blocks):
+        return(sum([(r1-r0)*(c1-c0)*self.cell_bytes + self.read_cost
+                    for r0,r1,c0,c1 in blocks]))
+
+    def _plan_(self,select,r0,r1,c0,c1):
+        ## trim the window to the selected cells
+        window = select[r0:r1,c0:c1]
+        rows = np.flatnonzero(window.any(axis=1))
+        if len(rows) == 0:
+            return([])
+        cols = np.flatnonzero(window.any(axis=0))
+        r0,r1,c0,c1 = [int(ii) for ii in (r0+rows[0],r0+rows[-1]+1,c0+cols[0],c0+cols[-1]+1)]
+        ret = [(r0,r1,c0,c1)]
+        ## candidate cuts along the widest empty band of rows and of columns
+        cuts = []
+        for axis,lines in ((0,rows-rows[0]),(1,cols-cols[0])):
+            gaps = np.diff(lines) - 1
+            if len(gaps) > 0 and gaps.max() > 0:
+                idx = gaps.argmax()
+                cuts.append((axis,lines[idx]+1,lines[idx+1]))
+        best = None
+        for axis,stop,start in cuts:
+            if axis == 0:
+                parts = [(r0,r0+stop,c0,c1),(r0+start,r1,c0,c1)]
+            else:
+                parts = [(r0,r1,c0,c0+stop),(r0,r1,c0+start,c1)]
+            ## compare the trimmed parts read as single blocks
+            parts = [self._trim_(select,*part) for part in parts]
+            cost = self._get_cost_(parts)
+            if best is None or cost < best[0]:
+                best = (cost,parts)
+        if best is not None and best[0] < self._get_cost_(ret):
+            ret = []
+            for part in best[1]:
+                ret += self._plan_(select,*part)
+        return(ret)
+
+    @staticmethod
+    def _trim_(select,r0,r1,c0,c1):
+        window = select[r0:r1,c0:c1]
+        rows = np.flatnonzero(window.any(axis=1))
+        cols = np.flatnonzero(window.any(axis=0))
+        return(tuple([int(ii) for ii in (r0+rows[0],r0+rows[-1]+1,c0+cols[0],c0+cols[-1]+1)]))
@@ -1,6 +1,10 @@
+import time
 import numpy as np
+from shapely import prepared
 from shapely.geometry.multipolygon import MultiPolygon
+from shapely.geometry.collection import GeometryCollection
 from ocgis.util.helpers import make_poly
+from ocgis.util import helpers
 
     
 def shapely_grid(dim,rtup,ctup,target=None):
@@ -55,6 +59,254 @@ def index_intersects(target,index):
                 break
     return(ret)
 
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+
+class QuadNode(object):
+    '''Node of a :class:`QuadTree`. Boundary nodes carry the part of the
+    selection geometry within their bounds as a prepared geometry.'''
+    
+    __slots__ = ('bounds','state','geom','prepared','children')
+    
+    def __init__(self,bounds,state,geom=None,children=None):
+        self.bounds = bounds
+        self.state = state
+        self.geom = geom
+        self.prepared = None if geom is None else prepared.prep(geom)
+        self.children = children
+
+
+class QuadTree(object):
+    '''Adaptive quadtree decomposition of a selection geometry. The envelope
+    of the geometry is subdivided until each node is fully inside, fully
+    outside, or smaller than `min_size`. Each subdivision only operates on the
+    part of the geometry within the parent node.
+    
+    Tests against a target geometry are answered by the smallest node
+    containing the target's envelope. Targets within an inside or outside
+    node need no geometry operation, and targets within a boundary node
+    only operate on that node's part of the geometry.
+    
+    geom :: Shapely Polygon or MultiPolygon
+    min_size=None :: float :: Nodes smaller than this size are not
+        subdivided. Defaults to 1/64th of the geometry's envelope.
+    max_depth=16 :: int'''
+    
+    def __init__(self,geom,min_size=None,max_depth=16):
+        self.geom = geom
+        self.prepared = prepared.prep(geom)
+        minx,miny,maxx,maxy = geom.bounds
+        if min_size is None:
+            min_size = max(maxx-minx,maxy-miny)/64.0
+        self.min_size = min_size
+        self.max_depth = max_depth
+        self.nodes = 0
+        self.root = self._build_((minx,miny,maxx,maxy),geom,self.prepared,0)
+        
+    def find(self,bounds):
+        '''Return the smallest leaf node containing `bounds` or `None` if the
+        bounds span multiple leaves or extend beyond the tree.'''
+        
+        minx,miny,maxx,maxy = bounds
+        node = self.root
+        while True:
+            nminx,nminy,nmaxx,nmaxy = node.bounds
+            if minx < nminx or miny < nminy or maxx > nmaxx or maxy > nmaxy:
+                return(None)
+            if node.children is None:
+                return(node)
+            for child in node.children:
+                cminx,cminy,cmaxx,cmaxy = child.bounds
+                if minx >= cminx and miny >= cminy and maxx <= cmaxx and maxy <= cmaxy:
+                    node = child
+                    break
+            else:
+                return(None)
+            
+    def keep(self,target):
+        '''Equivalent to :func:`ocgis.util.helpers.keep` for the tree's
+        geometry: `True` if `target` intersects the geometry and does not only
+        touch it.'''
+        
+        node = self.find(target.bounds)
+        if node is None:
+            ret = helpers.keep(self.prepared,self.geom,target)
+        elif node.state == INSIDE:
+            ret = True
+        elif node.state == OUTSIDE:
+            ret = False
+        else:
+            ret = helpers.keep(node.prepared,node.geom,target)
+        return(ret)
+    
+    def contains(self,target):
+        '''Return `True` if the tree's geometry contains `target`.'''
+        
+        node = self.find(target.bounds)
+        if node is None:
+            ret = self.prepared.contains(target)
+        elif node.state == INSIDE:
+            ret = True
+        elif node.state == OUTSIDE:
+            ret = False
+        else:
+            ret = node.prepared.contains(target)
+        return(ret)
+    
+    def intersection(self,target):
+        '''Return the intersection of the tree's geometry and `target`.
+        `target` itself is returned if it lies within an inside node.'''
+        
+        node = self.find(target.bounds)
+        if node is None:
+            ret = self.geom.intersection(target)
+        elif node.state == INSIDE:
+            ret = target
+        elif node.state == OUTSIDE:
+            ret = GeometryCollection()
+        else:
+            ret = node.geom.intersection(target)
+        return(ret)
+    
+    def iter_leaves(self):
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.children is None:
+                yield(node)
+            else:
+                stack.extend(node.children)
+    
+    def _build_(self,bounds,geom,prep_geom,depth):
+        self.nodes += 1
+        minx,miny,maxx,maxy = bounds
+        box = make_poly((miny,maxy),(minx,maxx))
+        if prep_geom.contains(box):
+            return(QuadNode(bounds,INSIDE))
+        if not prep_geom.intersects(box):
+            return(QuadNode(bounds,OUTSIDE))
+        ## the root geometry is already within its bounds
+        if depth > 0:
+            geom = geom.intersection(box)
+        node = QuadNode(bounds,BOUNDARY,geom=geom)
+        if max(maxx-minx,maxy-miny) > self.min_size and depth < self.max_depth:
+            midx,midy = (minx+maxx)/2.0,(miny+maxy)/2.0
+            node.children = [self._build_(child,node.geom,node.prepared,depth+1)
+                             for child in ((minx,miny,midx,midy),(midx,miny,maxx,midy),
+                                           (minx,midy,midx,maxy),(midx,midy,maxx,maxy))]
+            ## the parent's geometry is only needed to build its children
+            node.geom = None
+            node.prepared = None
+        return(node)
+
+
+def benchmark(geoms,res=0.25,dim=30.0):
+    '''Compare selection and clipping of grid cells covering each geometry's
+    envelope using the fixed-grid index and the adaptive quadtree.
+    
+    geoms :: sequence of Shapely Polygon or MultiPolygon
+    res=0.25 :: float :: Grid cell size.
+    dim=30.0 :: float :: Tile size of the fixed-grid index.
+    
+    returns
+    
+    dict :: Total seconds for each method and step and the number of cells
+        selected differently by the two indices.'''
+    
+    ret = dict.fromkeys(['grid_build','grid_select','quad_build','quad_select',
+                         'full_clip','quad_clip','mismatch'],0.0)
+    def _tic_(key,t):
+        ret[key] += time.time()-t
+        return(time.time())
+    for geom in geoms:
+        minx,miny,maxx,maxy = geom.bounds
+        cells = [make_poly((y,y+res),(x,x+res))
+                 for y in np.arange(miny,maxy,res) for x in np.arange(minx,maxx,res)]
+        
+        t = time.time()
+        index = build_index(geom,build_index_grid(dim,geom))
+        t = _tic_('grid_build',t)
+        selected = [cell for cell in cells if index_intersects(cell,index)]
+        t = _tic_('grid_select',t)
+        tree = QuadTree(geom,min_size=res*8)
+        t = _tic_('quad_build',t)
+        quad_selected = [cell for cell in cells if tree.keep(cell)]
+        t = _tic_('quad_select',t)
+        ret['mismatch'] += len(set(map(id,selected)).symmetric_difference(map(id,quad_selected)))
+        for cell in selected:
+            geom.intersection(cell)
+        t = _tic_('full_clip',t)
+        for cell in selected:
+            tree.intersection(cell)
+        t = _tic_('quad_clip',t)
+    return(ret)
+
+
+def benchmark_clip(geoms,res=0.25):
+    '''Compare clipping the grid cells covering each geometry's envelope cell
+    by cell against the full geometry with boundary-only clipping.
+    
+    geoms :: sequence of Shapely Polygon or MultiPolygon
+    res=0.25 :: float :: Grid cell size.
+    
+    returns
+    
+    dict :: Total seconds for each method and the largest difference in
+        clipped cell area.'''
+    
+    from ocgis.util.spatial.select import clip_cells
+    
+    ret = dict.fromkeys(['cell_clip','boundary_clip','max_diff'],0.0)
+    for geom in geoms:
+        minx,miny,maxx,maxy = geom.bounds
+        y = np.arange(miny,maxy,res).reshape(-1,1)
+        x = np.arange(minx,maxx,res).reshape(1,-1)
+        bounds = np.empty((y.shape[0],x.shape[1],4))
+        bounds[:,:,0],bounds[:,:,1] = x,y
+        bounds[:,:,2],bounds[:,:,3] = x+res,y+res
+        
+        t = time.time()
+        prep_geom = prepared.prep(geom)
+        area = np.zeros(bounds.shape[0:2])
+        for idx in np.ndindex(*area.shape):
+            min_col,min_row,max_col,max_row = bounds[idx]
+            cell = make_poly((min_row,max_row),(min_col,max_col))
+            if prep_geom.contains(cell):
+                area[idx] = cell.area
+            elif prep_geom.intersects(cell):
+                area[idx] = geom.intersection(cell).area
+        ret['cell_clip'] += time.time()-t
+        
+        t = time.time()
+        boundary_area,_ = clip_cells(geom,bounds)
+        ret['boundary_clip'] += time.time()-t
+        ret['max_diff'] = max(ret['max_diff'],np.abs(area-boundary_area).max())
+    return(ret)
+
+
+def main(keys=('state_boundaries','world_countries','mi_watersheds')):
+    from ocgis.util.shp_cabinet import ShpCabinet
+    
+    sc = ShpCabinet()
+    for key in keys:
+        geoms = [row['geom'] for row in sc.get_geoms(key)]
+        ret = benchmark(geoms)
+        print(key)
+        for k in sorted(ret):
+            print('  {0}: {1:.3f}'.format(k,ret[k]))
+    ## clipping uses the state boundaries only
+    geoms = [row['geom'] for row in sc.get_geoms('state_boundaries')]
+    ret = benchmark_clip(geoms)
+    print('state_boundaries (clip)')
+    for k in sorted(ret):
+        print('  {0}: {1:.3f}'.format(k,ret[k]))
+            
+            
+if __name__ == '__main__':
+    main()
+
 ################################################################################
 
 #sc = ShpCabinet()
@@ -0,0 +1,425 @@
+import numpy as np
+from shapely import prepared
+from shapely.geometry.point import Point
+from shapely.geometry.polygon import Polygon
+from shapely.ops import cascaded_union
+from ocgis.util.helpers import make_poly, keep
+from ocgis.util.spatial.index import QuadTree
+
+
+def get_rings(geom):
+    '''Return coordinate arrays for every exterior and interior ring of a
+    Polygon or MultiPolygon.
+
+    geom :: Shapely Polygon or MultiPolygon
+
+    returns
+
+    list of float ndarray with shape (n,2)'''
+
+    try:
+        polygons = list(geom)
+    except TypeError:
+        polygons = [geom]
+    ret = []
+    for polygon in polygons:
+        ret.append(np.array(polygon.exterior.coords))
+        for interior in polygon.interiors:
+            ret.append(np.array(interior.coords))
+    return(ret)
+
+def get_edges(geom):
+    '''Return the start and end coordinates of every ring segment.
+
+    returns
+
+    float ndarray (m,2)
+    float ndarray (m,2)'''
+
+    rings = get_rings(geom)
+    starts = np.vstack([ring[:-1,0:2] for ring in rings])
+    ends = np.vstack([ring[1:,0:2] for ring in rings])
+    return(starts,ends)
+
+
+class GridAxis(object):
+    '''Sorted view of a one-dimensional bounds array used for range searches.
+    Cell order in the source grid may be ascending or descending.
+
+    bounds :: float ndarray (n,2)'''
+
+    def __init__(self,bounds):
+        bounds = np.asarray(bounds,dtype=float)
+        lower = bounds.min(axis=1)
+        upper = bounds.max(axis=1)
+        self.order = np.argsort(lower,kind='mergesort')
+        self.lower = lower[self.order]
+        self.upper = upper[self.order]
+        self.center = (self.lower + self.upper)/2.0
+
+    def __len__(self):
+        return(self.lower.shape[0])
+
+    def touching(self,lower,upper):
+        '''Return the sorted-space index ranges [start,stop) of cells touching
+        the closed intervals [lower,upper]. Both arguments may be arrays.'''
+
+        start = np.searchsorted(self.upper,lower,side='left')
+        stop = np.searchsorted(self.lower,upper,side='right')
+        return(start,stop)
+
+    def overlapping(self,lower,upper):
+        '''Return the sorted-space index range [start,stop) of cells whose
+        interiors overlap the open interval (lower,upper).'''
+
+        start = np.searchsorted(self.upper,lower,side='right')
+        stop = np.searchsorted(self.lower,upper,side='left')
+        return(start,stop)
+
+
+def get_boundary_mask(starts,ends,row_axis,col_axis,window):
+    '''Conservatively flag the cells of a window that may be crossed by a ring
+    segment. Every segment marks the cells touching its bounding box.
+
+    window :: tuple :: (row_start,row_stop,col_start,col_stop) in sorted space.
+
+    returns
+
+    bool ndarray with the window's shape'''
+
+    rstart,rstop,cstart,cstop = window
+    nrow,ncol = rstop-rstart,cstop-cstart
+    r0,r1 = row_axis.touching(np.minimum(starts[:,1],ends[:,1]),
+                              np.maximum(starts[:,1],ends[:,1]))
+    c0,c1 = col_axis.touching(np.minimum(starts[:,0],ends[:,0]),
+                              np.maximum(starts[:,0],ends[:,0]))
+    ## move to window coordinates and drop segments outside the window
+    r0 = np.clip(r0-rstart,0,nrow)
+    r1 = np.clip(r1-rstart,0,nrow)
+    c0 = np.clip(c0-cstart,0,ncol)
+    c1 = np.clip(c1-cstart,0,ncol)
+    valid = (r1 > r0)*(c1 > c0)
+    r0,r1,c0,c1 = r0[valid],r1[valid],c0[valid],c1[valid]
+    ## two-dimensional difference array. the cumulative sums recover the
+    ## number of segment boxes covering each cell.
+    diff = np.zeros((nrow+1,ncol+1),dtype=int)
+    np.add.at(diff,(r0,c0),1)
+    np.add.at(diff,(r0,c1),-1)
+    np.add.at(diff,(r1,c0),-1)
+    np.add.at(diff,(r1,c1),1)
+    ret = diff.cumsum(axis=0).cumsum(axis=1)[0:nrow,0:ncol] > 0
+    return(ret)
+
+def get_inside_mask(starts,ends,y,x):
+    '''Even-odd point-in-polygon test for the points formed by the coordinate
+    vectors `y` and `x` using one horizontal scanline per `y` value.
+
+    returns
+
+    bool ndarray (len(y),len(x))'''
+
+    x0,y0 = starts[:,0],starts[:,1]
+    x1,y1 = ends[:,0],ends[:,1]
+    ret = np.zeros((y.shape[0],x.shape[0]),dtype=bool)
+    for idx,yc in enumerate(y):
+        cross = (y0 > yc) != (y1 > yc)
+        if not cross.any():
+            continue
+        cx0,cy0,cx1,cy1 = x0[cross],y0[cross],x1[cross],y1[cross]
+        xs = cx0 + (yc-cy0)*(cx1-cx0)/(cy1-cy0)
+        xs.sort()
+        ret[idx,:] = np.searchsorted(xs,x,side='left') % 2 == 1
+    return(ret)
+
+class GridIndex(object):
+    '''Spatial index over the cells of a rectilinear grid. The index is built
+    once and answers repeated selections. Work for a selection is limited to
+    the grid window overlapping the polygon's envelope.
+
+    row_bounds :: float ndarray (nrow,2)
+    col_bounds :: float ndarray (ncol,2)'''
+
+    #: Minimum number of boundary cells for testing against a quadtree.
+    quadtree_threshold = 64
+
+    def __init__(self,row_bounds,col_bounds):
+        self.row_bounds = np.asarray(row_bounds,dtype=float)
+        self.col_bounds = np.asarray(col_bounds,dtype=float)
+        self.row_axis = GridAxis(self.row_bounds)
+        self.col_axis = GridAxis(self.col_bounds)
+
+    @property
+    def shape(self):
+        return(len(self.row_axis),len(self.col_axis))
+
+    def get_window(self,polygon):
+        '''Return the sorted-space window (row_start,row_stop,col_start,col_stop)
+        of cells whose interiors overlap the envelope of `polygon` or `None`
+        if no cells overlap.'''
+
+        minx,miny,maxx,maxy = polygon.bounds
+        rstart,rstop = self.row_axis.overlapping(miny,maxy)
+        cstart,cstop = self.col_axis.overlapping(minx,maxx)
+        if rstop <= rstart or cstop <= cstart:
+            ret = None
+        else:
+            ret = (int(rstart),int(rstop),int(cstart),int(cstop))
+        return(ret)
+
+    def classify(self,polygon):
+        '''Classify the cells of the envelope window against `polygon`.
+
+        returns
+
+        tuple :: window as returned by `get_window`
+        int8 ndarray :: window classification (0 = outside, 1 = inside, 2 = boundary)'''
+
+        window = self.get_window(polygon)
+        if window is None:
+            return(None,np.zeros((0,0),dtype=np.int8))
+        rstart,rstop,cstart,cstop = window
+        starts,ends = get_edges(polygon)
+        boundary = get_boundary_mask(starts,ends,self.row_axis,self.col_axis,window)
+        inside = get_inside_mask(starts,ends,
+                                 self.row_axis.center[rstart:rstop],
+                                 self.col_axis.center[cstart:cstop])
+        ret = np.zeros(boundary.shape,dtype=np.int8)
+        ret[inside] = 1
+        ret[boundary] = 2
+        return(window,ret)
+
+    def select(self,polygon):
+        '''Return the native row and column indices of cells whose interiors
+        intersect `polygon` in row-major order. Only cells on the polygon
+        boundary receive an exact geometry test.
+
+        returns
+
+        int ndarray
+        int ndarray'''
+
+        window,cls = self.classify(polygon)
+        if window is None:
+            return(np.array([],dtype=int),np.array([],dtype=int))
+        rstart,cstart = window[0],window[2]
+        ii,jj = np.nonzero(cls == 1)
+        boundary = np.argwhere(cls == 2)
+        if boundary.shape[0] > 0:
+            row_order,col_order = self.row_axis.order,self.col_axis.order
+            row_bounds,col_bounds = self.row_bounds,self.col_bounds
+            ## many boundary cells are tested against a quadtree decomposition
+            ## of the polygon with leaves a few cells wide
+            if boundary.shape[0] >= self.quadtree_threshold:
+                res = max(np.max(self.row_axis.upper-self.row_axis.lower),
+                          np.max(self.col_axis.upper-self.col_axis.lower))
+                _keep_ = QuadTree(polygon,min_size=8*res).keep
+            else:
+                prep_polygon = prepared.prep(polygon)
+                _keep_ = lambda test_geom: keep(prep_polygon,polygon,test_geom)
+            keep_boundary = np.zeros(boundary.shape[0],dtype=bool)
+            for idx,(bi,bj) in enumerate(boundary):
+                test_geom = make_poly(row_bounds[row_order[rstart+bi]],
+                                      col_bounds[col_order[cstart+bj]])
+                keep_boundary[idx] = _keep_(test_geom)
+            ii = np.concatenate((ii,boundary[keep_boundary,0]))
+            jj = np.concatenate((jj,boundary[keep_boundary,1]))
+        ## map the sorted window back to the grid's native ordering
+        row = self.row_axis.order[rstart+ii]
+        col = self.col_axis.order[cstart+jj]
+        sort = np.lexsort((col,row))
+        return(row[sort],col[sort])
+
+
+class PointIndex(object):
+    '''Spatial index over grid points. Points are sorted by their x-coordinate
+    so a selection only tests the points within the polygon's envelope.
+
+    x :: float ndarray (nrow,ncol)
+    y :: float ndarray (nrow,ncol)'''
+
+    def __init__(self,x,y):
+        x = np.asarray(x,dtype=float)
+        self.shape = x.shape
+        self.order = np.argsort(x.reshape(-1),kind='mergesort')
+        self.x = x.reshape(-1)[self.order]
+        self.y = np.asarray(y,dtype=float).reshape(-1)[self.order]
+
+    def select(self,polygon):
+        '''Return the row and column indices of points intersecting `polygon`
+        in row-major order.'''
+
+        minx,miny,maxx,maxy = polygon.bounds
+        start = np.searchsorted(self.x,minx,side='left')
+        stop = np.searchsorted(self.x,maxx,side='right')
+        y = self.y[start:stop]
+        candidates = np.flatnonzero((y >= miny)*(y <= maxy))
+        prep_polygon = prepared.prep(polygon)
+        x = self.x[start:stop]
+        select = np.zeros(candidates.shape[0],dtype=bool)
+        for idx,cidx in enumerate(candidates):
+            select[idx] = prep_polygon.intersects(Point(x[cidx],y[cidx]))
+        flat = np.sort(self.order[start+candidates[select]])
+        row,col = np.unravel_index(flat,self.shape)
+        return(row,col)
+
+
+def classify_cells(polygon,row_bounds,col_bounds):
+    '''Classify rectilinear grid cells against a selection polygon without
+    constructing cell geometries.
+
+    polygon :: Shapely Polygon or MultiPolygon
+    row_bounds :: float ndarray (nrow,2)
+    col_bounds :: float ndarray (ncol,2)
+
+    returns
+
+    int8 ndarray (nrow,ncol) :: 0 = outside, 1 = inside, 2 = boundary
+    '''
+
+    index = GridIndex(row_bounds,col_bounds)
+    ret = np.zeros(index.shape,dtype=np.int8)
+    window,cls = index.classify(polygon)
+    if window is not None:
+        rstart,rstop,cstart,cstop = window
+        sorted_ret = np.zeros(ret.shape,dtype=np.int8)
+        sorted_ret[rstart:rstop,cstart:cstop] = cls
+        ret[np.ix_(index.row_axis.order,index.col_axis.order)] = sorted_ret
+    return(ret)
+
+def select_cells(polygon,row_bounds,col_bounds):
+    '''Return a boolean selection mask for cells whose interiors intersect
+    `polygon`. Only cells on the polygon boundary receive an exact geometry
+    test.
+
+    returns
+
+    bool ndarray (nrow,ncol)'''
+
+    index = GridIndex(row_bounds,col_bounds)
+    ret = np.zeros(index.shape,dtype=bool)
+    ret[index.select(polygon)] = True
+    return(ret)
+
+def clip_cells(polygon,bounds,select=None,leaf_size=8):
+    '''Clip rectilinear grid cells to a polygon. Cells inside the polygon are
+    classified in bulk and keep their rectangular geometry. The remaining
+    cells are intersected with the part of the polygon within a grid-aligned
+    block of at most `leaf_size` cells per side. Blocks are found by
+    recursively bisecting the grid with each bisection only operating on the
+    part of the polygon within its parent block.
+
+    polygon :: Shapely Polygon or MultiPolygon
+    bounds :: float ndarray (nrow,ncol,4) :: Cell bounds with the last
+        dimension ordered as (min_col,min_row,max_col,max_row).
+    select=None :: bool ndarray (nrow,ncol) :: Cells to clip. Defaults to all
+        cells.
+    leaf_size=8 :: int
+
+    returns
+
+    float ndarray (nrow,ncol) :: Clipped cell areas. Cells not selected are
+        zero.
+    dict :: Clipped geometries of selected cells not inside the polygon keyed
+        by (row,col) index.'''
+
+    nrow,ncol = bounds.shape[0:2]
+    if select is None:
+        select = np.ones((nrow,ncol),dtype=bool)
+    cls = classify_cells(polygon,bounds[:,0][:,[1,3]],bounds[0][:,[0,2]])
+    ret = np.zeros((nrow,ncol),dtype=float)
+    inside = select*(cls == 1)
+    ret[inside] = np.abs((bounds[:,:,2]-bounds[:,:,0])*
+                         (bounds[:,:,3]-bounds[:,:,1]))[inside]
+    exact = select*(cls != 1)
+    geoms = {}
+
+    def _clip_(piece,r0,r1,c0,c1):
+        if r1-r0 <= leaf_size and c1-c0 <= leaf_size:
+            for ii,jj in np.argwhere(exact[r0:r1,c0:c1]):
+                idx = (int(r0+ii),int(c0+jj))
+                min_col,min_row,max_col,max_row = bounds[idx]
+                cell = Polygon(((min_col,min_row),
+                                (max_col,min_row),
+                                (max_col,max_row),
+                                (min_col,max_row)))
+                geom = piece.intersection(cell)
+                geoms[idx] = geom
+                ret[idx] = geom.area
+            return
+        if r1-r0 >= c1-c0:
+            mid = (r0+r1)//2
+            children = ((r0,mid,c0,c1),(mid,r1,c0,c1))
+        else:
+            mid = (c0+c1)//2
+            children = ((r0,r1,c0,mid),(r0,r1,mid,c1))
+        for cr0,cr1,cc0,cc1 in children:
+            if not exact[cr0:cr1,cc0:cc1].any():
+                continue
+            block = bounds[cr0:cr1,cc0:cc1]
+            box = make_poly((block[:,:,1].min(),block[:,:,3].max()),
+                            (block[:,:,0].min(),block[:,:,2].max()))
+            _clip_(piece.intersection(box),cr0,cr1,cc0,cc1)
+
+    if exact.any():
+        _clip_(polygon,0,nrow,0,ncol)
+    return(ret,geoms)
+
+def union_cells(bounds,select,polygon=None):
+    '''Union the selected cells of a rectilinear grid without constructing
+    cell geometries. Runs of touching cells in each row are merged into
+    rectangles and identical runs in touching rows are merged into a single
+    rectangle. Only the rectangles are unioned.
+
+    bounds :: float ndarray (nrow,ncol,4) :: Cell bounds with the last
+        dimension ordered as (min_col,min_row,max_col,max_row).
+    select :: bool ndarray (nrow,ncol) :: Cells to union.
+    polygon=None :: Shapely Polygon or MultiPolygon :: If provided, the union
+        is intersected with `polygon` (i.e. the union of clipped cells).
+
+    returns
+
+    Shapely Polygon or MultiPolygon'''
+
+    nrow,ncol = select.shape
+    row_lower = bounds[:,0][:,[1,3]].min(axis=1)
+    row_upper = bounds[:,0][:,[1,3]].max(axis=1)
+    col_lower = bounds[0][:,[0,2]].min(axis=1)
+    col_upper = bounds[0][:,[0,2]].max(axis=1)
+    ## neighbouring rows and columns are only merged if they share an edge
+    def _touching_(lower,upper):
+        return(np.maximum(lower[:-1],lower[1:]) == np.minimum(upper[:-1],upper[1:]))
+    row_touch = _touching_(row_lower,row_upper)
+    col_touch = _touching_(col_lower,col_upper)
+
+    rects = []
+    def _add_(r0,r1,(c0,c1)):
+        rects.append(make_poly((row_lower[r0:r1].min(),row_upper[r0:r1].max()),
+                               (col_lower[c0:c1].min(),col_upper[c0:c1].max())))
+
+    ## runs of each row keyed by column range with the row the run started
+    active = {}
+    for ii in range(nrow):
+        sel = select[ii]
+        joined = sel[:-1]*sel[1:]*col_touch
+        starts = np.flatnonzero(sel*np.concatenate(([True],np.invert(joined))))
+        stops = np.flatnonzero(sel*np.concatenate((np.invert(joined),[True])))+1
+        runs = {}
+        for run in zip(starts,stops):
+            if ii > 0 and row_touch[ii-1] and run in active:
+                runs[run] = active.pop(run)
+            else:
+                runs[run] = ii
+        for run,r0 in active.iteritems():
+            _add_(r0,ii,run)
+        active = runs
+    for run,r0 in active.iteritems():
+        _add_(r0,nrow,run)
+
+    ret = cascaded_union(rects)
+    if polygon is not None:
+        ret = polygon.intersection(ret)
+        ## edges shared with the polygon are not part of the union
+        if ret.geom_type == 'GeometryCollection':
+            ret = cascaded_union([geom for geom in ret
+                                  if geom.geom_type in ('Polygon','MultiPolygon')])
+    return(ret)
@@ -18,44 +18,98 @@ def wrap_coll(coll):
         wrap_var(var)
 
 def wrap_var(var):
-    right_clip = make_poly((-90,90),(180,360))
-    left_clip = make_poly((-90,90),(-180,180))
-    
-    def _shift_(geom):
+    spatial = var.spatial
+    ## geometries constructed on demand from the cell bounds are wrapped by
+    ## shifting the bounds
+    if spatial.bounds is not None:
         try:
-            coords = np.array(geom.exterior.coords)
-            coords[:,0] = coords[:,0] - 360
-            ret = Polygon(coords)
+            cache = var._i.spatial._wrap_cache
         except AttributeError:
-            polygons = np.empty(len(geom),dtype=object)
-            for ii,polygon in enumerate(geom):
-                coords = np.array(polygon.exterior.coords)
-                coords[:,0] = coords[:,0] - 360
-                polygons[ii] = Polygon(coords)
-            ret = MultiPolygon(polygons)
-        return(ret)
+            cache = {}
+            if var._i is not None:
+                var._i.spatial._wrap_cache = cache
+        wrap_bounds(spatial,cache=cache)
+        return
     
-    geoms = var.spatial._value
-    if not isinstance(geoms[0,0],Point):
-        for idx,geom in iter_array(geoms,return_value=True):
-            bounds = np.array(geom.bounds)
-            if np.all([bounds[0] > 180,bounds[2] > 180]):
-                geoms[idx] = _shift_(geom)
-            elif bounds[1] <= 180 and bounds[2] > 180:
-                left = [poly for poly in _get_iter_(geom.intersection(left_clip))]
-                right = [poly for poly in _get_iter_(_shift_(geom.intersection(right_clip)))]
-                try:
-                    geoms[idx] = MultiPolygon(left+right)
-                except TypeError:
-                    left = filter(lambda x: type(x) != LineString,left)
-                    right = filter(lambda x: type(x) != LineString,right)
-                    geoms[idx] = MultiPolygon(left+right)
-            else:
-                continue
-    else:
-        for idx,geom in iter_array(geoms,return_value=True):
-            if geom.x > 180:
-                geoms[idx] = Point(geom.x-360,geom.y)
+    geoms = spatial._value
+    ## aggregated geometries are not constructed for some output formats
+    if geoms[0,0] is None:
+        return
+    for idx,geom in iter_array(geoms,return_value=True):
+        geoms[idx] = _wrap_geom_(geom)
+        
+def wrap_bounds(spatial,cache=None):
+    '''Wrap a spatial dimension constructing its geometries from cell bounds.
+    Cells east of 180 are shifted by -360 in a single array operation and are
+    only constructed when requested. Cells crossing 180 are split. Geometries
+    already constructed (e.g. clipped cells) are wrapped individually.
+    
+    spatial :: SpatialDimension
+    cache=None :: dict :: Split cell geometries keyed by geometry identifier.
+        Use one cache per grid to reuse split cells across subsets.'''
+    
+    cache = {} if cache is None else cache
+    bounds = spatial.bounds.copy()
+    min_col,max_col = bounds[:,:,0],bounds[:,:,2]
+    straddle = (min_col < 180)*(max_col > 180)
+    shift = (min_col >= 180)*(max_col > 180)
+    
+    geoms = spatial._geoms
+    constructed = np.frompyfunc(lambda geom: geom is not None,1,1)(geoms).astype(bool)
+    for idx in zip(*np.nonzero(constructed)):
+        geoms[idx] = _wrap_geom_(geoms[idx])
+    uid = np.ma.getdata(spatial.uid)
+    for idx in zip(*np.nonzero(straddle*np.invert(constructed))):
+        key = int(uid[idx])
+        try:
+            geom = cache[key]
+        except KeyError:
+            min_x,min_y,max_x,max_y = bounds[idx]
+            geom = MultiPolygon([make_poly((min_y,max_y),(min_x,180)),
+                                 make_poly((min_y,max_y),(-180,max_x-360))])
+            cache[key] = geom
+        geoms[idx] = geom
+    
+    bounds[:,:,0][shift] -= 360
+    bounds[:,:,2][shift] -= 360
+    spatial._bounds = bounds
+
+def _shift_(geom):
+    try:
+        coords = np.array(geom.exterior.coords)
+        coords[:,0] = coords[:,0] - 360
+        ret = Polygon(coords)
+    except AttributeError:
+        polygons = np.empty(len(geom),dtype=object)
+        for ii,polygon in enumerate(geom):
+            coords = np.array(polygon.exterior.coords)
+            coords[:,0] = coords[:,0] - 360
+            polygons[ii] = Polygon(coords)
+        ret = MultiPolygon(polygons)
+    return(ret)
+
+## regions east and west of 180 used to split geometries crossing it
+_right_clip = make_poly((-90,90),(180,360))
+_left_clip = make_poly((-90,90),(-180,180))
+
+def _wrap_geom_(geom):
+    if isinstance(geom,Point):
+        if geom.x > 180:
+            geom = Point(geom.x-360,geom.y)
+        return(geom)
+    bounds = np.array(geom.bounds)
+    if np.all([bounds[0] > 180,bounds[2] > 180]):
+        geom = _shift_(geom)
+    elif bounds[1] <= 180 and bounds[2] > 180:
+        left = [poly for poly in _get_iter_(geom.intersection(_left_clip))]
+        right = [poly for poly in _get_iter_(_shift_(geom.intersection(_right_clip)))]
+        try:
+            geom = MultiPolygon(left+right)
+        except TypeError:
+            left = filter(lambda x: type(x) != LineString,left)
+            right = filter(lambda x: type(x) != LineString,right)
+            geom = MultiPolygon(left+right)
+    return(geom)
 
 def unwrap_geoms(geoms,left_max_x_bound):
     clip1 = make_poly((-90,90),(-180,left_max_x_bound))
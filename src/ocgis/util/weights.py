@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class WeightMatrix(object):
+    """
+    Sparse (geometry x cell) weight matrix stored by geometry (compressed rows).
+    Weighted averages for every geometry are computed for all leading
+    dimensions of the data at once. Masked values are excluded from the
+    averages as in :func:`ocgis.util.helpers.spatial_average`.
+
+    >>> matrix = WeightMatrix(3)
+    >>> matrix.add(np.array([0,1]),np.array([1.0,1.0]))
+    >>> matrix.add(np.array([1,2]),np.array([1.0,3.0]))
+    >>> matrix.average(np.array([[2.0,4.0,8.0]])).tolist()
+    [[3.0, 7.0]]
+
+    ncell -- number of cells in the flattened grid window
+    """
+
+    def __init__(self,ncell):
+        self.ncell = ncell
+        self._cells = []
+        self._weights = []
+        self._cache = None
+
+    def __len__(self):
+        return(len(self._cells))
+
+    @property
+    def nnz(self):
+        return(sum([cells.shape[0] for cells in self._cells]))
+
+    def add(self,cells,weights):
+        '''Add a geometry row.
+
+        cells -- int array of flattened cell indices. May be empty.
+        weights -- float array of weights for each cell
+        '''
+        self._cells.append(np.asarray(cells,dtype=int))
+        self._weights.append(np.asarray(weights,dtype=float))
+        self._cache = None
+
+    def average(self,values):
+        '''Return weighted averages for each geometry.
+
+        values -- masked array (...,ncell)
+        return -- masked array (...,ngeom). Geometries without unmasked
+            values are masked.
+        '''
+        cells,weights,starts,nonempty = self._get_csr_()
+        lead = values.shape[:-1]
+        flat = values.reshape(-1,self.ncell)
+        total = np.zeros((flat.shape[0],len(self)),dtype=float)
+        wsum = np.zeros((flat.shape[0],len(self)),dtype=float)
+        if cells.shape[0] > 0:
+            ## one product of the data with the sparse matrix. rows of the
+            ## product are summed for each geometry with a single reduction.
+            w = np.invert(np.ma.getmaskarray(flat)[:,cells])*weights
+            x = np.ma.filled(flat,0)[:,cells]*w
+            total[:,nonempty] = np.add.reduceat(x,starts,axis=1)
+            wsum[:,nonempty] = np.add.reduceat(w,starts,axis=1)
+        empty = wsum == 0
+        ret = np.ma.array(total/np.where(empty,1.0,wsum),mask=empty)
+        return(ret.reshape(lead+(len(self),)))
+
+    def _get_csr_(self):
+        if self._cache is None:
+            counts = np.array([c.shape[0] for c in self._cells],dtype=int)
+            nonempty = np.flatnonzero(counts > 0)
+            starts = np.concatenate(([0],np.cumsum(counts)[:-1]))[nonempty]
+            if len(self) > 0:
+                cells = np.concatenate(self._cells)
+                weights = np.concatenate(self._weights)
+            else:
+                cells,weights = np.array([],dtype=int),np.array([],dtype=float)
+            self._cache = (cells,weights,starts,nonempty)
+        return(self._cache)